@@ -0,0 +1,201 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import csv
+import io
+import json
+import os
+import traceback
+from glob import glob
+from pathlib import Path
+from time import perf_counter
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
+
+
+CONFIG_SUFFIXES = ('.yaml', '.yml')
+
+
+def find_configs(sources: List[str]) -> List[Path]:
+  configs = []
+  for source in sources:
+    path = Path(source)
+    if path.is_dir():
+      for suffix in CONFIG_SUFFIXES:
+        configs += sorted(path.glob(f"*{suffix}"))
+    elif path.is_file():
+      configs.append(path)
+    else:
+      matches = sorted(glob(source))
+      if len(matches) == 0:
+        print(f"WARNING: No configuration files found for {source}")
+      configs += map(Path, matches)
+  return configs
+
+
+def warm_up(render: bool) -> None:
+  # Runs once per worker process, so every config after the first one on a worker only pays for its own work
+  if render:
+    import matplotlib
+    matplotlib.use('Agg')
+    import graphing.plot  # noqa: F401
+  import hormone_levels  # noqa: F401
+
+
+def parse_config(config_file: Path) -> Any:
+  # Parse errors are left to run_config, which reports them like any other failure
+  from parser.yaml_parser import YAMLparser
+  try:
+    return YAMLparser(config_file)
+  except Exception:
+    return None
+
+
+def run_config(config_file: Path, output_dir: Optional[Path], config: Any = None) -> Dict[str, Any]:
+  from hormone_levels import HormoneLevels
+
+  start = perf_counter()
+  log = io.StringIO()
+  try:
+    with contextlib.redirect_stdout(log):
+      levels = HormoneLevels(config_file, render=False, parallel=False, config=config)
+      if output_dir is not None:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        # The batch is already spread over the cores
+        levels.render_jobs = 1
+        levels.render(output_dir)
+      result = levels.summary()
+    result['ok'] = True
+  except Exception as e:
+    result = {'config': str(config_file),
+              'ok': False,
+              'error': f"{type(e).__name__}: {e}",
+              'traceback': traceback.format_exc()}
+  result['seconds'] = perf_counter() - start
+  result['log'] = log.getvalue()
+  return result
+
+
+async def evaluate_config(config_file: Path, output_dir: Optional[Path],
+                          pool: concurrent.futures.Executor) -> Dict[str, Any]:
+  # Reading and parsing runs on a thread, the calculation and rendering on the process pool, so the event loop
+  # only ever waits
+  start = perf_counter()
+  config = await asyncio.to_thread(parse_config, config_file)
+  parse_seconds = perf_counter() - start
+  result = await asyncio.get_running_loop().run_in_executor(pool, run_config, config_file, output_dir, config)
+  result['seconds'] += parse_seconds
+  return result
+
+
+async def stream_batch(configs: List[Path],
+                       workers: int,
+                       output_dir: Optional[Path] = None) -> AsyncIterator[Dict[str, Any]]:
+  # Yields the results in the order the configurations finish. At most two configurations per worker are in
+  # flight, the next ones are parsed while the pool is busy and the rest wait, however many there are.
+  pending = iter(configs)
+  running = set()
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                              initializer=warm_up,
+                                              initargs=(output_dir is not None,)) as pool:
+    while True:
+      while len(running) < 2 * workers:
+        config = next(pending, None)
+        if config is None:
+          break
+        running.add(asyncio.ensure_future(evaluate_config(config, output_dir, pool)))
+      if len(running) == 0:
+        break
+      done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        yield task.result()
+
+
+async def collect_batch(configs: List[Path], workers: int, output_dir: Optional[Path]) -> List[Dict[str, Any]]:
+  results = []
+  async for result in stream_batch(configs, workers, output_dir):
+    status = "ok" if result['ok'] else f"FAILED ({result['error']})"
+    print(f"{result['seconds']:7.2f}s  {result['config']}: {status}")
+    results.append(result)
+  results.sort(key=lambda r: r['config'])
+  return results
+
+
+def run_batch(configs: List[Path],
+              workers: Optional[int] = None,
+              output_dir: Optional[Path] = None) -> List[Dict[str, Any]]:
+  if workers is None:
+    workers = os.cpu_count() or 1
+  workers = max(1, min(workers, len(configs)))
+  return asyncio.run(collect_batch(configs, workers, output_dir))
+
+
+CSV_FIELDS = ('config', 'ok', 'seconds', 'drug', 'name', 'estimate', 'estimate_stddev', 'factor',
+              'average', 'average_stddev', 'mean_abs_error', 'lab_count', 'error')
+
+
+def summary_rows(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+  rows = []
+  for result in results:
+    base = {'config': result['config'], 'ok': result['ok'], 'seconds': f"{result['seconds']:.3f}",
+            'error': result.get('error', '')}
+    drugs: Dict[str, Dict[str, Any]] = result.get('drugs', {})
+    if len(drugs) == 0:
+      rows.append(base)
+    for drug_key, drug in drugs.items():
+      row = dict(base, drug=drug_key, lab_count=len(drug.get('prediction_errors', [])))
+      for field in CSV_FIELDS:
+        if field in drug:
+          row[field] = drug[field]
+      rows.append(row)
+  return rows
+
+
+def write_summary(results: List[Dict[str, Any]], summary_file: Path) -> None:
+  with summary_file.open('w', newline='') as out:
+    if summary_file.suffix.lower() == '.csv':
+      writer = csv.DictWriter(out, fieldnames=CSV_FIELDS)
+      writer.writeheader()
+      writer.writerows(summary_rows(results))
+    else:
+      json.dump(results, out, indent=2)
+
+
+def parse_arguments() -> Tuple[List[Path], Optional[int], Path, Optional[Path]]:
+  arg_parser = argparse.ArgumentParser(description="Evaluate many configuration files on a process pool")
+  arg_parser.add_argument('configs', nargs='+', help="configuration files, directories or glob patterns")
+  arg_parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: core count)")
+  arg_parser.add_argument('-o', '--output', type=Path, default=Path('summary.json'),
+                          help="summary file, .json or .csv")
+  arg_parser.add_argument('--render', type=Path, default=None, metavar='DIR',
+                          help="also render all plots into this directory")
+  args = arg_parser.parse_args()
+  return find_configs(args.configs), args.jobs, args.output, args.render
+
+
+if __name__ == '__main__':
+  config_files, jobs, summary_path, render_dir = parse_arguments()
+  if len(config_files) == 0:
+    raise SystemExit("ERROR: no configuration files to process")
+  batch_start = perf_counter()
+  batch_results = run_batch(config_files, jobs, render_dir)
+  write_summary(batch_results, summary_path)
+  failed = len(list(filter(lambda r: not r['ok'], batch_results)))
+  print(f"Processed {len(batch_results)} configurations ({failed} failed) "
+        f"in {perf_counter() - batch_start:.2f}s, summary written to {summary_path}")
@@ -14,12 +14,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import drugs.drug as drug
-from datetime import timedelta
+import os
+from pathlib import Path
 
 
-class Testosterone(drug.Drug):
-  def __init__(self):
-    half_life = timedelta(hours=3)
-    super().__init__("Testosterone", half_life)
-
+def cache_directory(name: str) -> Path:
+  if 'HORMONE_LEVELS_CACHE' in os.environ:
+    base = Path(os.environ['HORMONE_LEVELS_CACHE'])
+  elif 'XDG_CACHE_HOME' in os.environ:
+    base = Path(os.environ['XDG_CACHE_HOME']) / 'hormone_levels'
+  else:
+    base = Path.home() / '.cache' / 'hormone_levels'
+  directory = base / name
+  directory.mkdir(parents=True, exist_ok=True)
+  return directory
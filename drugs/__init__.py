@@ -14,13 +14,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-# from .estradiol import Estradiol
-from .estradiol import Estradiol
-from .estradiol_valerate import EstradiolValerate
-from .estradiol_cypionate import EstradiolCypionate
-from .testosterone import Testosterone
-from .testosterone_cypionate import TestosteroneCypionate
-from .metylphenidate import Methylphenidate
-from .lisdex import Lisdexamphetamine, Dexamphetamine
 from .drug import Drug
+from .registry import DrugDefinition, DrugRegistry, drug_registry
 from .drug_db import drug_db
+
+
+def __getattr__(name: str):
+  # The drug classes of earlier versions, e.g. drugs.EstradiolValerate(), are the definitions of the same name
+  definition = drug_registry.lookup(name) if not name.startswith('_') else None
+  if definition is None:
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+  return definition
@@ -14,45 +14,75 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Optional, List, Tuple
+from functools import lru_cache
+from typing import Any, List, Optional, Sequence, Tuple
 from drugs.drug_classes import DrugClass
 from datetime import timedelta
-from funcy import map
+
+# Derived values kept per (drug parameters, step)
+DERIVED_CACHE_SIZE = 1024
 
 
 class Drug(object):
+  # Parameters of a drug. They cannot be changed after construction and are compared and hashed by value, so
+  # everything derived from them can be cached. How a configuration scales the blood levels is not part of them,
+  # see BodyModel.drug_factors.
+  __slots__ = ('name', 'name_blood', 'half_life', 'drug_class', 'flood_in', 'flood_in_timedelta', 'metabolites',
+               'hash_value')
   name:                   str
   name_blood:             str
   half_life:              timedelta
   drug_class:             Optional[DrugClass]
-  flood_in:               Optional[List[float]]
+  flood_in:               Optional[Tuple[float, ...]]
   flood_in_timedelta:     timedelta
-  blood_value_factor:     float
-  metabolites:            List[Tuple[str, float]]
-  factor:                 float
-
-  def __init__(self, name: str, half_life: timedelta, drug_class: Optional[DrugClass] = None):
-    self.name               = name
-    self.name_blood         = name
-    self.half_life          = half_life
-    self.drug_class         = drug_class
-    self.flood_in           = None
-    self.flood_in_timedelta = timedelta(hours=1)
-    self.metabolites        = []
-    self.factor             = 1.0
-
-  def set_flood_in(self, flood_in: List[float]):
-    self.flood_in = flood_in
-    total = sum(flood_in)
-    self.flood_in = list(map(lambda x: x/total, self.flood_in))
-
-  def add_metabolite(self, drug_in: str, factor: float):
-    self.metabolites.append((drug_in, factor))
+  metabolites:            Tuple[Tuple[str, float], ...]
+  hash_value:             int
+
+  def __init__(self,
+               name:                str,
+               half_life:           timedelta,
+               drug_class:          Optional[DrugClass] = None,
+               name_blood:          Optional[str] = None,
+               flood_in:            Optional[Sequence[float]] = None,
+               flood_in_timedelta:  timedelta = timedelta(hours=1),
+               metabolites:         Sequence[Tuple[str, float]] = ()):
+    # flood_in are the fractions of a dose released every flood_in_timedelta, see normalize_flood_in()
+    values = {'name':               name,
+              'name_blood':         name if name_blood is None else name_blood,
+              'half_life':          half_life,
+              'drug_class':         drug_class,
+              'flood_in':           None if flood_in is None else tuple(map(float, flood_in)),
+              'flood_in_timedelta': flood_in_timedelta,
+              'metabolites':        tuple(map(lambda m: (str(m[0]), float(m[1])), metabolites))}
+    for key, value in values.items():
+      object.__setattr__(self, key, value)
+    object.__setattr__(self, 'hash_value', hash(self.values()))
+
+  def __setattr__(self, key: str, value: Any):
+    raise AttributeError(f"Drug parameters cannot be changed, tried to set {key} of {self.name}")
+
+  def __delattr__(self, key: str):
+    raise AttributeError(f"Drug parameters cannot be changed, tried to delete {key} of {self.name}")
+
+  def values(self) -> Tuple:
+    return (self.name, self.name_blood, self.half_life, self.drug_class, self.flood_in, self.flood_in_timedelta,
+            self.metabolites)
+
+  def __eq__(self, other: Any) -> bool:
+    return isinstance(other, Drug) and self.hash_value == other.hash_value and self.values() == other.values()
+
+  def __hash__(self):
+    return self.hash_value
+
+  def __reduce__(self):
+    return Drug, (self.name, self.half_life, self.drug_class, self.name_blood, self.flood_in,
+                  self.flood_in_timedelta, self.metabolites)
+
+  def __repr__(self) -> str:
+    return f"Drug({self.name!r}, half_life={self.half_life})"
 
   def get_metabolism_factor(self, step: timedelta) -> float:
-    hl_step = self.half_life.total_seconds() / step.total_seconds()
-    factor = 2 ** (-1.0 / hl_step)
-    return factor
+    return decay_factor(self, step)
 
   def get_metabolites(self, decay_amount: float) -> List[Tuple[str, float]]:
     out = []
@@ -63,5 +93,15 @@ class Drug(object):
   def get_name(self) -> str:
     return self.name
 
-  def __hash__(self):
-    return hash(self.name)
+
+def normalize_flood_in(flood_in: Sequence[float]) -> Tuple[float, ...]:
+  total = sum(flood_in)
+  return tuple(map(lambda x: x/total, flood_in))
+
+
+@lru_cache(maxsize=DERIVED_CACHE_SIZE)
+def decay_factor(drug: Drug, step: timedelta) -> float:
+  # Fraction of the drug left after one step
+  hl_step = drug.half_life.total_seconds() / step.total_seconds()
+  factor = 2 ** (-1.0 / hl_step)
+  return factor
@@ -1,30 +0,0 @@
-# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
-# Copyright (C) 2021  Nina Alexandra Klama
-#
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, either version 3 of the License, or
-# (at your option) any later version.
-#
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program.  If not, see <https://www.gnu.org/licenses/>.
-
-
-import drugs.drug as drug
-from datetime import timedelta
-# from drugs import Estradiol
-
-
-class EstradiolValerate(drug.Drug):
-  def __init__(self):
-    super().__init__("Estradiol valerate", timedelta(days=4, hours=12))
-    self.set_flood_in([1, 2, 3, 4, 5, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7,
-                       7, 7, 7, 7, 6, 6, 6, 6, 5, 5, 5, 4, 4, 4, 3, 3, 3, 2, 2, 2, 1, 1, .5, .5])
-    self.flood_in_timedelta = timedelta(hours=1)
-    self.add_metabolite("Estradiol", (272.38 / 356.506))
-    # self.name_blood = "Estradiol[EV]"
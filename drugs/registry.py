@@ -0,0 +1,218 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import importlib.metadata
+import os
+import re
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from yaml import load
+try:
+  from yaml import CLoader as Loader
+except ImportError:
+  from yaml import Loader
+
+from drugs.drug import Drug, normalize_flood_in
+
+DEFINITIONS_DIRECTORY = Path(__file__).parent / "definitions"
+ENTRY_POINT_GROUP = 'hormone_levels.drugs'
+DEFINITION_KEYS = {'aliases', 'name_blood', 'half_life', 'flood_in', 'flood_in_timedelta', 'metabolites'}
+
+
+def normalize_alias(alias: str) -> str:
+  # Case, spaces, dashes and underscores don't matter, "Estradiol valerate" is "EstradiolValerate" is "estradiolvalerate"
+  return re.sub(r"[\s_\-]+", "", str(alias).casefold())
+
+
+def parse_duration(name: str, field: str, value: Any) -> timedelta:
+  if not isinstance(value, dict):
+    raise Exception(f"ERROR: {field} of drug {name} has to be a duration like {{hours: 3}}, got {value}")
+  return timedelta(**value)
+
+
+def parse_flood_in(name: str, value: Any) -> Optional[List[float]]:
+  # Either the relative amounts of every flood_in_timedelta, or a trapezoid of delay, rise, plateau and fall steps
+  if value is None or isinstance(value, list):
+    return value
+  if not isinstance(value, dict) or not set(value.keys()) <= {'delay', 'rise', 'plateau', 'fall'}:
+    raise Exception(f"ERROR: flood_in of drug {name} has to be a list or delay, rise, plateau and fall, got {value}")
+  delay, rise, plateau, fall = map(lambda k: int(value.get(k, 0)), ('delay', 'rise', 'plateau', 'fall'))
+  return [0.0] * delay + \
+    list(map(lambda i: (i + 1) / rise, range(rise))) + \
+    [1.0] * plateau + \
+    list(map(lambda i: (fall - i) / fall, range(fall)))
+
+
+class DrugDefinition(object):
+  # Parameters of a drug as given in a definition file, calling it constructs the Drug
+  name:               str
+  source:             str
+  aliases:            List[str]
+  name_blood:         str
+  half_life:          timedelta
+  flood_in:           Optional[List[float]]
+  flood_in_timedelta: timedelta
+  metabolites:        List[Tuple[str, float]]
+  drug:               Optional[Drug]
+
+  def __init__(self, name: str, values: Dict[str, Any], source: str):
+    unknown = set(values.keys()) - DEFINITION_KEYS
+    if len(unknown) > 0:
+      print(f"WARNING: Ignoring {', '.join(sorted(unknown))} of drug {name} in {source}")
+    if 'half_life' not in values:
+      raise Exception(f"ERROR: Drug {name} in {source} has no half_life")
+    self.name               = name
+    self.source             = source
+    self.aliases            = list(map(str, values.get('aliases', [])))
+    self.name_blood         = values.get('name_blood', name)
+    self.half_life          = parse_duration(name, 'half_life', values['half_life'])
+    self.flood_in           = parse_flood_in(name, values.get('flood_in'))
+    self.flood_in_timedelta = parse_duration(name, 'flood_in_timedelta', values.get('flood_in_timedelta', {'hours': 1}))
+    self.metabolites        = list(map(lambda m: (str(m[0]), float(m[1])), (values.get('metabolites') or {}).items()))
+    self.drug               = None
+
+  def __call__(self) -> Drug:
+    # Drugs cannot be changed, so every configuration shares the one of the definition
+    if self.drug is None:
+      self.drug = Drug(self.name, self.half_life,
+                       name_blood=self.name_blood,
+                       flood_in=None if self.flood_in is None else normalize_flood_in(self.flood_in),
+                       flood_in_timedelta=self.flood_in_timedelta,
+                       metabolites=self.metabolites)
+    return self.drug
+
+
+class DrugIndex(object):
+  # Normalized aliases of the drugs to their names, the aliases of every name and the values they are defined by
+  aliases: Dict[str, str]
+  names:   Dict[str, List[str]]
+  values:  Dict[str, Tuple[Dict[str, Any], str]]
+
+  def __init__(self):
+    self.aliases = {}
+    self.names   = {}
+    self.values  = {}
+
+  def copy(self) -> 'DrugIndex':
+    index = DrugIndex()
+    index.aliases = dict(self.aliases)
+    index.names   = dict(self.names)
+    index.values  = dict(self.values)
+    return index
+
+  def add_all(self, definitions: Optional[Dict[str, Dict[str, Any]]], source: str) -> None:
+    if definitions is None:
+      return
+    if not isinstance(definitions, dict):
+      raise Exception(f"ERROR: {source} has to map drug names to their definitions")
+    for name, values in definitions.items():
+      self.add(str(name), values or {}, source)
+
+  def add(self, name: str, values: Dict[str, Any], source: str) -> None:
+    aliases = list(dict.fromkeys(map(normalize_alias, [name] + list(values.get('aliases', [])))))
+    for alias in aliases:
+      if self.aliases.get(alias, name) != name:
+        raise Exception(f"ERROR: Alias {alias} of drug {name} in {source} is already used by {self.aliases[alias]}")
+    for alias in self.names.pop(name, []):
+      del self.aliases[alias]
+    for alias in aliases:
+      self.aliases[alias] = name
+    self.names[name]  = aliases
+    self.values[name] = (values, source)
+
+
+class DrugRegistry(object):
+  # Drug definitions from the YAML files in drugs/definitions, then the directories in $HORMONE_LEVELS_DRUGS and
+  # the hormone_levels.drugs entry points, which return a dict of definitions like a file. A later definition of the
+  # same name replaces the earlier one. The alias index of the files is built on the first lookup, a definition is
+  # only parsed once a configuration uses it. Entry points are only loaded when an alias is not found in the files,
+  # except for one named like the alias, which is loaded first and so can replace a definition of the files.
+  directories:  List[Path]
+  index:        Optional[DrugIndex]
+  entry_points: Optional[List[importlib.metadata.EntryPoint]]
+  definitions:  Dict[str, DrugDefinition]
+
+  def __init__(self, directories: Optional[List[Path]] = None):
+    if directories is None:
+      directories = [DEFINITIONS_DIRECTORY] + \
+        list(map(Path, filter(len, os.environ.get('HORMONE_LEVELS_DRUGS', '').split(os.pathsep))))
+    self.directories  = directories
+    self.index        = None
+    self.entry_points = None
+    self.definitions  = {}
+
+  def load_index(self) -> DrugIndex:
+    # Assigned only once every file was read, so a broken one fails every lookup instead of leaving a partial index
+    if self.index is None:
+      index = DrugIndex()
+      for directory in self.directories:
+        for file in sorted(directory.glob("*.yaml")) + sorted(directory.glob("*.yml")):
+          with file.open('r') as yaml_file:
+            index.add_all(load(yaml_file, Loader=Loader), str(file))
+      self.index = index
+      self.entry_points = list(importlib.metadata.entry_points(group=ENTRY_POINT_GROUP))
+    return self.index
+
+  def load_entry_points(self, alias: Optional[str] = None) -> None:
+    # All pending entry points, or only the ones named like alias
+    self.load_index()
+    for entry_point in list(self.entry_points):
+      if alias is not None and normalize_alias(entry_point.name) != alias:
+        continue
+      definitions = entry_point.load()
+      index = self.index.copy()
+      index.add_all(definitions() if callable(definitions) else definitions, f"entry point {entry_point.name}")
+      self.replace_index(index)
+      self.entry_points.remove(entry_point)
+
+  def replace_index(self, index: DrugIndex) -> None:
+    # Parsed definitions of names that are now defined differently are parsed again
+    for name in list(self.definitions.keys()):
+      if index.values.get(name) is not self.index.values.get(name):
+        del self.definitions[name]
+    self.index = index
+
+  def add_all(self, definitions: Optional[Dict[str, Dict[str, Any]]], source: str) -> None:
+    index = self.load_index().copy()
+    index.add_all(definitions, source)
+    self.replace_index(index)
+
+  def add(self, name: str, values: Dict[str, Any], source: str) -> None:
+    # A single definition is checked before the index is changed, so it needs no copy
+    self.load_index().add(name, values, source)
+    self.definitions.pop(name, None)
+
+  def lookup(self, alias: str) -> Optional[DrugDefinition]:
+    alias = normalize_alias(alias)
+    self.load_entry_points(alias)
+    name = self.index.aliases.get(alias)
+    if name is None and len(self.entry_points) > 0:
+      self.load_entry_points()
+      name = self.index.aliases.get(alias)
+    if name is None:
+      return None
+    if name not in self.definitions:
+      self.definitions[name] = DrugDefinition(name, *self.index.values[name])
+    return self.definitions[name]
+
+  def names(self) -> List[str]:
+    self.load_entry_points()
+    return sorted(self.index.values.keys())
+
+
+drug_registry = DrugRegistry()
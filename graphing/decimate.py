@@ -0,0 +1,129 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+
+from graphing.window import select_samples
+
+DECIMATION_METHODS = ('minmax', 'lttb')
+# Width of matplotlib's default figure in inches, the plots are drawn at that size
+FIGURE_WIDTH = 6.4
+DECIMATION_CACHE_SIZE = 64
+
+
+def figure_buckets(dpi: int, width: float = FIGURE_WIDTH) -> int:
+  # One bucket per pixel column of the figure
+  return max(int(dpi * width), 1)
+
+
+def min_max_indices(values: np.ndarray, buckets: int) -> np.ndarray:
+  # Index of the smallest and of the largest value in every bucket, plus the first and last sample, so the peaks
+  # and troughs of every injection cycle survive
+  values = np.asarray(values, dtype=float)
+  size   = int(math.ceil(len(values) / buckets))
+  rows   = int(math.ceil(len(values) / size))
+  blocks = np.full(rows * size, np.nan)
+  blocks[:len(values)] = values
+  blocks = blocks.reshape(rows, size)
+  base   = np.arange(rows) * size
+  return np.unique(np.concatenate((base + np.nanargmin(blocks, axis=1),
+                                   base + np.nanargmax(blocks, axis=1),
+                                   [0, len(values) - 1])))
+
+
+def lttb_indices(values: np.ndarray, points: int) -> np.ndarray:
+  # Largest-Triangle-Three-Buckets over equally spaced samples, keeps the sample of every bucket spanning the largest
+  # triangle with the one kept before and the average of the next bucket. Slower than min_max_indices, as every
+  # bucket depends on the one before, but smoother at low resolutions.
+  values = np.asarray(values, dtype=float)
+  if points >= len(values) or points < 3:
+    return np.arange(len(values))
+  edges   = np.unique(np.linspace(1, len(values) - 1, points - 1).astype(int))
+  edges   = np.append(edges, len(values))
+  means_x = (edges[1:] + edges[:-1] - 1) / 2.0
+  means_y = np.add.reduceat(values, edges[:-1]) / np.diff(edges)
+  indices = [0]
+  for n in range(len(edges) - 2):
+    low, high = edges[n], edges[n + 1]
+    kept      = indices[-1]
+    area      = np.abs((kept - means_x[n + 1]) * (values[low:high] - values[kept]) -
+                       (kept - np.arange(low, high)) * (means_y[n + 1] - values[kept]))
+    indices.append(low + int(np.argmax(area)))
+  indices.append(len(values) - 1)
+  return np.array(indices)
+
+
+def figure_series(figure: Dict[str, Any]) -> List[np.ndarray]:
+  # Every line and band edge drawn along the time axis of plot_drugs() arguments
+  series = []
+  for drug_plot in figure['data'][1].values():
+    series += list(drug_plot[:3])
+  averages   = figure.get('moving_average') or {}
+  deviations = figure.get('moving_deviation') or {}
+  for name, average in averages.items():
+    series += list(average)
+    if name in deviations:
+      series += list(map(lambda a: a[0] - a[1], zip(average, deviations[name])))
+      series += list(map(lambda a: a[0] + a[1], zip(average, deviations[name])))
+  return series
+
+
+def decimation_indices(figure: Dict[str, Any], buckets: int, method: str = 'minmax') -> Optional[np.ndarray]:
+  # Samples to keep so every series of the figure looks the same at the given width, None if all of them are
+  # needed anyway. The series share the time axis, so the samples kept for any of them are kept for all.
+  samples = len(figure['data'][0])
+  if samples <= 2 * buckets:
+    return None
+  if method == 'minmax':
+    pick = lambda values: min_max_indices(values, buckets)
+  elif method == 'lttb':
+    pick = lambda values: lttb_indices(values, 2 * buckets)
+  else:
+    raise Exception(f"ERROR: Unknown decimation {method}, use one of {', '.join(DECIMATION_METHODS)}")
+  indices = np.unique(np.concatenate(list(map(pick, figure_series(figure)))))
+  return indices if len(indices) < samples else None
+
+
+def decimate_figure(figure: Dict[str, Any], indices: Optional[np.ndarray]) -> Dict[str, Any]:
+  return figure if indices is None else select_samples(figure, indices)
+
+
+class DecimationCache(object):
+  # Kept samples per figure, in LRU order. The key has to change with anything the figure is drawn from, the window
+  # and the width.
+  size:     int
+  indices:  'OrderedDict[Hashable, Optional[np.ndarray]]'
+
+  def __init__(self, size: int = DECIMATION_CACHE_SIZE):
+    self.size    = size
+    self.indices = OrderedDict()
+
+  def decimate(self, figure: Dict[str, Any], buckets: int, method: str = 'minmax',
+               key: Optional[Hashable] = None) -> Dict[str, Any]:
+    if key is None:
+      return decimate_figure(figure, decimation_indices(figure, buckets, method))
+    key = (key, buckets, method)
+    if key in self.indices:
+      self.indices.move_to_end(key)
+    else:
+      self.indices[key] = decimation_indices(figure, buckets, method)
+      while len(self.indices) > self.size:
+        self.indices.popitem(last=False)
+    return decimate_figure(figure, self.indices[key])
@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import sys
-from typing import Optional, Tuple, Dict, List, Union
+import time
+from pathlib import Path
+from typing import Any, Optional, Tuple, Dict, List, Union
 
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
@@ -42,21 +44,30 @@ def plot_drugs(data:              Tuple[np.ndarray, Dict[str, plot_data]],
                plot_markers:      bool = False,
                no_avg_label:      bool = True,
                plot_dates:        bool = False,
-               avg_length:        Optional[Tuple[int, int, int]] = None):
+               avg_length:        Optional[Tuple[int, int, int]] = None,
+               dpi:               int = 800,
+               zoom:              bool = False,
+               save_to:           Optional[Path] = None,
+               windows:           Optional[List[Dict[str, Any]]] = None):
+  # With zoom the axes only get as many samples as they have pixel columns, taken again from the full resolution
+  # series whenever the view is zoomed or panned. Every entry of windows (x_window, y_window, x_ticks, title and
+  # save_to) is saved from the same figure after the first one, only the limits, ticks and title change.
   avg_colors = ["#A00000", "#006000", "#000000"]
   avg_style  = [":", "-.", "--"]
   if avg_length is None:
     avg_length = (5, 30, 90)
-  plt.figure(dpi=800, tight_layout=True)
+  plt.figure(dpi=dpi, tight_layout=True)
   plt.rc('xtick', labelsize=6)
   plt.rc('ytick', labelsize=6)
   plt.rc('legend', fontsize=6)
   plt.rc('axes', labelsize=6, titlesize=10)
   plt.rc('figure', titlesize=10)
   plt.margins(x=0)
-  if title is not None:
-    plt.title(title)
   d_t, drugs = data
+  view = None
+  if zoom:
+    from graphing.zoom import ZoomView
+    view = ZoomView(d_t)
   if avg_levels is not None:
     for name, avg_level in avg_levels.items():
       avg, std_dev, color = avg_level
@@ -139,26 +150,18 @@ def plot_drugs(data:              Tuple[np.ndarray, Dict[str, plot_data]],
                            'linestyle': avg_style[i],
                            'zorder': 5})
 
-    if plot_dates:
-      if moving_average is not None and name in moving_average:
-        for i in range(3):
-          plt.plot_date(d_t, moving_average[name][i], **keys_avg[i],
-                        linewidth=2,
-                        label=f'{name} {avg_length[i]}d average')
-          if moving_deviation is not None and name in moving_deviation:
-            plt.plot_date(d_t, moving_average[name][i] - moving_deviation[name][i], **keys_avg[i], linewidth=1)
-            plt.plot_date(d_t, moving_average[name][i] + moving_deviation[name][i], **keys_avg[i], linewidth=1)
-      plt.plot_date(d_t, value, **keys_main_plot)
-    else:
-      if moving_average is not None and name in moving_average:
-        for i in range(3):
-          plt.plot(d_t, moving_average[name][i], **keys_avg[i],
-                   linewidth=2,
-                   label=f'{name} {avg_length[i]}d average')
-          if moving_deviation is not None and name in moving_deviation:
-            plt.plot(d_t, moving_average[name][i] - moving_deviation[name][i], **keys_avg[i], linewidth=1)
-            plt.plot(d_t, moving_average[name][i] + moving_deviation[name][i], **keys_avg[i], linewidth=1)
-      plt.plot(d_t, value, **keys_main_plot)
+    plot_line = plt.plot_date if plot_dates else plt.plot
+    track_line = view.add_line if view is not None else lambda lines, values: None
+    if moving_average is not None and name in moving_average:
+      for i in range(3):
+        average = moving_average[name][i]
+        track_line(plot_line(d_t, average, **keys_avg[i],
+                             linewidth=2,
+                             label=f'{name} {avg_length[i]}d average'), average)
+        if moving_deviation is not None and name in moving_deviation:
+          for edge in (average - moving_deviation[name][i], average + moving_deviation[name][i]):
+            track_line(plot_line(d_t, edge, **keys_avg[i], linewidth=1), edge)
+    track_line(plot_line(d_t, value, **keys_main_plot), value)
 
     # if color is not None:
     #   if plot_markers:
@@ -277,12 +280,14 @@ def plot_drugs(data:              Tuple[np.ndarray, Dict[str, plot_data]],
     #       plt.plot(d_t, value, label=f'{name}', zorder=4)
 
     if confidence_val is not None and plot_cofidence:
+      keys_band = {'label': f'{name} {confidence_val}% confidence interval',
+                   'alpha': 0.5,
+                   'zorder': 3}
       if color is not None:
-        plt.fill_between(d_t, minimum, maximum, label=f'{name} {confidence_val}% confidence interval',
-                         alpha=0.5, color=color, zorder=3)
-      else:
-        plt.fill_between(d_t, minimum, maximum, label=f'{name} {confidence_val}% confidence interval',
-                         alpha=0.5, zorder=3)
+        keys_band['color'] = color
+      band = plt.fill_between(d_t, minimum, maximum, **keys_band)
+      if view is not None:
+        view.add_band(band, minimum, maximum, keys_band)
     if lab_data is not None and name in lab_data:
       if color is not None:
         plt.scatter(lab_data[name][0], lab_data[name][1], label=f'{name} lab values',
@@ -290,20 +295,25 @@ def plot_drugs(data:              Tuple[np.ndarray, Dict[str, plot_data]],
       else:
         plt.scatter(lab_data[name][0], lab_data[name][1], label=f'{name} lab values',
                     marker='.', zorder=6)
-  if x_window is not None:
-    plt.xlim(left=x_window[0], right=x_window[1])
-    if plot_dates:
-      # x_axis = axis.get_xaxis()
-      axis = plt.gca()
-      axis.xaxis.axis_date()
-      axis.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-      axis.xaxis.set_major_locator(mdates.AutoDateLocator())
-      plt.gcf().autofmt_xdate()
-    else:
-      plt.xticks(range(int(x_window[0]), int(x_window[1]) + 1, x_ticks))
+  def frame(x_window: Optional[Tuple[float, float]], y_window: Optional[Tuple[float, float]], x_ticks: int,
+            title: Optional[str]) -> None:
+    plt.title(title if title is not None else "")
+    if x_window is not None:
+      plt.xlim(left=x_window[0], right=x_window[1])
+      if plot_dates:
+        # x_axis = axis.get_xaxis()
+        axis = plt.gca()
+        axis.xaxis.axis_date()
+        axis.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+        axis.xaxis.set_major_locator(mdates.AutoDateLocator())
+        plt.gcf().autofmt_xdate()
+      else:
+        plt.xticks(range(int(x_window[0]), int(x_window[1]) + 1, x_ticks))
+
+    if y_window is not None:
+      plt.ylim(bottom=y_window[0], top=y_window[1])
 
-  if y_window is not None:
-    plt.ylim(bottom=y_window[0], top=y_window[1])
+  frame(x_window, y_window, x_ticks, title)
   plt.grid()
   plt.axhline(y=0.0, color='k', zorder=0)
   if now is not None:
@@ -317,4 +327,30 @@ def plot_drugs(data:              Tuple[np.ndarray, Dict[str, plot_data]],
   else:
     plt.ylabel(y_label)
   plt.legend(loc="lower center")
-  plt.show()
+  if view is not None:
+    view.connect(plt.gca())
+  if save_to is not None:
+    plt.savefig(save_to)
+    for window in windows or []:
+      frame(window['x_window'], window['y_window'], window['x_ticks'], window['title'])
+      plt.savefig(window['save_to'])
+    plt.close()
+  else:
+    plt.show()
+
+
+def interactive_plots() -> None:
+  # plt.show() returns right away, the figures stay open while the caller keeps running
+  plt.ion()
+
+
+def close_plots() -> None:
+  plt.close('all')
+
+
+def wait_for_plots(seconds: float) -> None:
+  # Keeps open figures responsive while waiting
+  if len(plt.get_fignums()) > 0:
+    plt.pause(seconds)
+  else:
+    time.sleep(seconds)
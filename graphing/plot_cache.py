@@ -0,0 +1,57 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import importlib.metadata
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy as np
+
+from graphing.window import slice_to_window
+from modelling.result_cache import ResultCache, result_key
+
+PLOT_CACHE_SIZE = 256 * 1024 * 1024
+PLOT_CACHE_AGE  = 30 * 24 * 3600.0
+
+
+class PlotCache(ResultCache):
+  # Rendered image files, stored under the hash of everything that ends up in them, so windows over data that did
+  # not change since the last run, like the ones of the history, are copied instead of drawn again
+  matplotlib_version: str
+
+  def __init__(self, max_bytes: int = PLOT_CACHE_SIZE, max_age: float = PLOT_CACHE_AGE):
+    super().__init__(max_bytes, 'plots', max_age)
+    self.matplotlib_version = importlib.metadata.version('matplotlib')
+
+  def figure_key(self, figure: Dict[str, Any], options: Any = None) -> str:
+    # The samples of the window, every plot_drugs() argument except where it is saved and the options of how it is
+    # drawn. The line of now moves with every run and only counts while it is inside the window.
+    sliced = slice_to_window(figure)
+    inputs = dict(filter(lambda i: i[0] not in ('save_to', 'zoom', 'windows'), sliced.items()))
+    x_window = inputs.get('x_window')
+    if inputs.get('now') is not None and x_window is not None and not x_window[0] <= inputs['now'] <= x_window[1]:
+      inputs['now'] = None
+    return result_key('plot', (inputs, Path(figure['save_to']).suffix, self.matplotlib_version, options))
+
+  def restore(self, key: str, save_to: Path) -> bool:
+    cached = self.get(key)
+    if cached is None or 'image' not in cached:
+      return False
+    save_to.write_bytes(cached['image'].tobytes())
+    return True
+
+  def store(self, key: str, save_to: Path) -> None:
+    self.put(key, {'image': np.fromfile(save_to, dtype=np.uint8)})
@@ -0,0 +1,65 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+def use_agg() -> None:
+  # Files only, no windows, so the workers never need a display
+  import matplotlib
+  matplotlib.use('Agg')
+
+
+def render_figure(figure: Dict[str, Any]) -> List[Path]:
+  from graphing.plot import plot_drugs
+  plot_drugs(**figure)
+  return [figure['save_to']] + list(map(lambda w: w['save_to'], figure.get('windows') or []))
+
+
+WINDOW_KEYS = ('x_window', 'y_window', 'x_ticks', 'title', 'save_to')
+
+
+def render_processes(processes: Optional[int], jobs: int) -> int:
+  if processes is None:
+    processes = os.cpu_count() or 1
+  return max(1, min(processes, jobs))
+
+
+def share_figures(figures: List[Dict[str, Any]], processes: Optional[int] = None) -> List[Dict[str, Any]]:
+  # Figures of the same data that only differ in WINDOW_KEYS are drawn once per process, the first of every share
+  # is drawn and the others are saved from it as windows
+  parts = render_processes(processes, len(figures))
+  shared = []
+  for part in filter(len, np.array_split(np.arange(len(figures)), parts)):
+    figure = dict(figures[part[0]])
+    figure['windows'] = list(map(lambda n: dict(map(lambda k: (k, figures[n][k]), WINDOW_KEYS)), part[1:]))
+    shared.append(figure)
+  return shared
+
+
+def render_figures(figures: List[Dict[str, Any]], processes: Optional[int] = None) -> List[Path]:
+  # Every figure is a dict of plot_drugs() arguments with save_to set, the workers get the arrays of their figure
+  processes = render_processes(processes, len(figures))
+  if processes == 1:
+    use_agg()
+    return sum(map(render_figure, figures), [])
+  with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=use_agg) as pool:
+    return sum(pool.map(render_figure, figures), [])
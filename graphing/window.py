@@ -0,0 +1,63 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Any, Dict, Optional, Tuple, Union
+
+import numpy as np
+
+# Samples kept on each side of the window, so the lines run up to its edges
+WINDOW_MARGIN = 1
+
+
+def window_slice(times: np.ndarray, x_window: Optional[Tuple[Any, Any]], margin: int = WINDOW_MARGIN) -> slice:
+  # times has to be sorted, it is either numbers or datetimes like the window
+  if x_window is None or len(times) == 0:
+    return slice(0, len(times))
+  low  = max(int(np.searchsorted(times, x_window[0], side='left')) - margin, 0)
+  high = min(int(np.searchsorted(times, x_window[1], side='right')) + margin, len(times))
+  return slice(low, max(low, high))
+
+
+def select_samples(figure: Dict[str, Any], samples: Union[slice, np.ndarray]) -> Dict[str, Any]:
+  # plot_drugs() arguments with only the given samples of the time axis and of every series drawn along it
+  figure = dict(figure)
+  times, series = figure['data']
+  selected = {}
+  for name, drug_plot in series.items():
+    selected[name] = tuple(map(lambda a: a[samples], drug_plot[:3])) + tuple(drug_plot[3:])
+  figure['data'] = (times[samples], selected)
+  for key in ('moving_average', 'moving_deviation'):
+    if figure.get(key) is not None:
+      figure[key] = dict(map(lambda s: (s[0], tuple(map(lambda a: a[samples], s[1]))), figure[key].items()))
+  return figure
+
+
+def slice_to_window(figure: Dict[str, Any], margin: int = WINDOW_MARGIN) -> Dict[str, Any]:
+  # Cuts the timelines, bands, running statistics and labs of plot_drugs() arguments down to the x_window, so
+  # drawing a window costs as much as the window and not the whole history
+  times = figure['data'][0]
+  window = window_slice(times, figure.get('x_window'), margin)
+  if window.stop - window.start in (0, len(times)):
+    return figure
+  figure = select_samples(figure, window)
+  if figure.get('lab_data') is not None:
+    first, last = times[window.start], times[window.stop - 1]
+    lab_data = {}
+    for name, (lab_times, lab_values) in figure['lab_data'].items():
+      inside = list(filter(lambda n: first <= lab_times[n] <= last, range(len(lab_times))))
+      lab_data[name] = (list(map(lab_times.__getitem__, inside)), list(map(lab_values.__getitem__, inside)))
+    figure['lab_data'] = lab_data
+  return figure
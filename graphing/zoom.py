@@ -0,0 +1,85 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Any, Dict, List, Tuple
+
+import matplotlib.dates as mdates
+import numpy as np
+
+from modelling.timeline_pyramid import TimelinePyramid
+
+
+class ZoomView(object):
+  # Keeps the full resolution series of the axes and only hands them the decimated samples of the visible range,
+  # again whenever the x limits change by zooming or panning
+  times:    np.ndarray
+  numbers:  np.ndarray
+  lines:    List[Tuple[Any, TimelinePyramid]]
+  bands:    List[Tuple[Any, TimelinePyramid, TimelinePyramid, Dict[str, Any]]]
+  updating: bool
+
+  def __init__(self, times: np.ndarray):
+    self.times    = np.asarray(times)
+    self.numbers  = self.times if self.times.dtype != object else mdates.date2num(self.times)
+    self.lines    = []
+    self.bands    = []
+    self.updating = False
+
+  def add_line(self, lines: List[Any], values: np.ndarray) -> None:
+    self.lines.append((lines[0], TimelinePyramid(values)))
+
+  def add_band(self, band: Any, minimum: np.ndarray, maximum: np.ndarray, keys: Dict[str, Any]) -> None:
+    self.bands.append((band, TimelinePyramid(minimum), TimelinePyramid(maximum), keys))
+
+  def visible(self, axes: Any) -> np.ndarray:
+    # Kept samples of all series in the visible range, plus one on each side
+    left, right = axes.get_xlim()
+    first = max(int(np.searchsorted(self.numbers, left, side='left')) - 1, 0)
+    last  = min(int(np.searchsorted(self.numbers, right, side='right')) + 1, len(self.times))
+    if last <= first:
+      return np.array([], dtype=int)
+    buckets = max(int(axes.bbox.width), 1)
+    pyramids = list(map(lambda line: line[1], self.lines)) + \
+      sum(map(lambda band: [band[1], band[2]], self.bands), [])
+    indices = np.concatenate([[first, last - 1]] + list(map(lambda p: p.extreme_indices(first, last, buckets), pyramids)))
+    return np.unique(indices)
+
+  def update(self, axes: Any) -> None:
+    if self.updating:
+      return
+    self.updating = True
+    try:
+      indices = self.visible(axes)
+      times = self.times[indices]
+      for line, pyramid in self.lines:
+        line.set_data(times, pyramid.values[indices])
+      bands = []
+      for band, minimum, maximum, keys in self.bands:
+        # Filled areas cannot be given new data, they are replaced
+        band.remove()
+        limits = axes.get_xlim(), axes.get_ylim()
+        band = axes.fill_between(times, minimum.values[indices], maximum.values[indices], **keys)
+        axes.set_xlim(limits[0])
+        axes.set_ylim(limits[1])
+        bands.append((band, minimum, maximum, keys))
+      self.bands = bands
+    finally:
+      self.updating = False
+
+  def connect(self, axes: Any) -> None:
+    self.update(axes)
+    # Bound methods are only weakly referenced by the callbacks, the lambda keeps the view alive with the axes
+    axes.callbacks.connect('xlim_changed', lambda changed: self.update(changed))
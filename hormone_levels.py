@@ -1,28 +1,47 @@
+import json
 import math
+import re
+import sys
+from contextlib import redirect_stdout
 
 import numpy as np
 
-from drugs import *
+from drugs import Drug, drug_db
 from modelling import *
-from graphing.plot import plot_drugs
 
 import datetime
 from parser.yaml_parser import *
+from parser.dose_journal import DoseJournal
 from graphing.color_list import get_color
+from graphing.window import slice_to_window
+from graphing.decimate import DecimationCache, figure_buckets
+from graphing.render import share_figures
+from graphing.plot_cache import PlotCache
 
-from sys import argv
+import argparse
 
 
 STEP_DAYS = (5, 30, 90)
 
 
 class HormoneLevels:
+  config_file:        Path
+  use_cache:          bool
+  parallel:           bool
+  output_dir:         Optional[Path]
+  export_path:        Optional[Path]
+  plot_format:        str
+  dpi:                int
+  render_jobs:        Optional[int]
+  decimation:         Optional[str]
+  decimation_cache:   DecimationCache
+  pipeline:           Pipeline
+  model_doses:        Dict[str, Tuple[np.ndarray, np.ndarray]]
   config:             YAMLparser
   drugs:              Dict[str, Drug]
   std_dev_count:      int
   p_confidence:       str
   model:              BodyModel
-  lab_data_list:      List[LabData]
   days_into_future:   int
   now:                Union[datetime, float]
   duration_factor:    float
@@ -35,27 +54,134 @@ class HormoneLevels:
   xticks:             int
   start_model:        datetime
 
-  def __init__(self):
+  def __init__(self, config_file: Path, render: bool = True, parallel: bool = True, use_cache: bool = True,
+               config: Optional[YAMLparser] = None):
     # starttime = datetime.now()
 
-    self.config = YAMLparser(Path(argv[1]))
+    self.config_file = config_file
+    self.use_cache = use_cache
+    self.parallel = parallel
+    self.output_dir = None
+    self.export_path = None
+    self.plot_format = 'png'
+    self.dpi = 800
+    self.render_jobs = None
+    self.decimation = 'minmax'
+    self.decimation_cache = DecimationCache()
+    self.plot_cache = None
+    # An already parsed configuration can be handed over, e.g. by a process parsing while others calculate
+    self.config = config if config is not None else YAMLparser(config_file, use_cache)
+    self.pipeline = self.build_pipeline()
+    self.pipeline.run(None if render else 'estimates')
+    # print(datetime.now() - starttime)
+
+  def render(self, output_dir: Optional[Path] = None) -> None:
+    # matplotlib is only imported by the graphing modules once something is drawn. Files are rendered on a
+    # process pool, figures to show one after another.
+    self.y_window = self.config.graph['y_window']
+    timelines = list(filter(lambda f: f is not None, [self.full_plot(output_dir)])) + self.plots(output_dir)
+    prediction_error = list(filter(lambda f: f is not None, [self.plot_prediction_error(output_dir)]))
+    keys = {}
+    if output_dir is not None and self.use_cache:
+      # Files whose window and options did not change since they were last rendered are copied from the cache
+      if self.plot_cache is None:
+        self.plot_cache = PlotCache()
+      keys = dict(map(lambda f: (f['save_to'], self.plot_cache.figure_key(f, self.decimation)),
+                      timelines + prediction_error))
+      changed = lambda f: not self.plot_cache.restore(keys[f['save_to']], f['save_to'])
+      timelines, prediction_error = list(filter(changed, timelines)), list(filter(changed, prediction_error))
+    if output_dir is None and self.decimation is not None:
+      # Shown figures keep the whole timeline, so zooming out works, and decimate whatever is visible
+      figures = list(map(lambda f: dict(f, zoom=True), timelines))
+    elif output_dir is None or self.decimation == 'lttb':
+      figures = list(map(lambda f: self.decimate(slice_to_window(f)), timelines))
+    else:
+      # The windows of the files are saved from one figure per process, decimated by the min/max pyramids of the
+      # zoom view, only their limits, ticks and titles change in between
+      figures = share_figures(list(map(lambda f: dict(f, zoom=self.decimation is not None), timelines)),
+                              self.render_jobs)
+    figures += prediction_error
+    if output_dir is not None:
+      from graphing.render import render_figures
+      for save_to in render_figures(figures, self.render_jobs):
+        if save_to in keys:
+          self.plot_cache.store(keys[save_to], save_to)
+    else:
+      from graphing.plot import plot_drugs
+      for figure in figures:
+        plot_drugs(**figure)
+
+  def decimate(self, figure: Dict[str, Any]) -> Dict[str, Any]:
+    # Down to about two samples per pixel column. The kept samples only depend on the statistics and the window,
+    # so redrawing after e.g. a change of the y_window reuses them.
+    if self.decimation is None:
+      return figure
+    return self.decimation_cache.decimate(figure, figure_buckets(figure['dpi']), self.decimation,
+                                          (self.pipeline.keys.get('statistics'), figure['x_window']))
+
+  def config_values(self, section: str, keys: List[str]) -> Dict[str, Any]:
+    values = getattr(self.config, section)
+    return dict(map(lambda k: (k, values[k]), keys))
+
+  def build_pipeline(self) -> Pipeline:
+    # Every stage declares the configuration values it reads, so e.g. a change of the y_window only redraws the
+    # plots and new labs don't touch the timeline
+    pipeline = Pipeline()
+    pipeline.add_stage('timeline', self.update_timeline,
+                       {'drugs':  lambda: self.config.drugs,
+                        'model':  lambda: self.config_values('model', ['start_date', 'timedelta', 'days_into_future']),
+                        'doses':  lambda: self.config.dose_columns,
+                        'today':  date.today})
+    pipeline.add_stage('factors', lambda _: self.estimate_factors(),
+                       {'labs':   lambda: self.config.labs,
+                        'model':  lambda: self.config_values('model', ['events', 'corrected_std_dev', 'track_factor']),
+                        'graph':  lambda: self.config_values('graph', ['two_std_dev_in_band'])},
+                       ['timeline'])
+    pipeline.add_stage('statistics', lambda _: self.calculate_statistics(self.parallel),
+                       {'graph':  lambda: self.config_values('graph', ['units', 'x_offset', 'use_x_date', 'confidence'])},
+                       ['factors'])
+    pipeline.add_stage('estimates', lambda _: self.print_estimates(),
+                       {'print_estimates': lambda: self.config.print_estimates},
+                       ['factors'])
+    pipeline.add_stage('export', lambda _: self.write_export(),
+                       {'path':   lambda: self.export_path},
+                       ['statistics'])
+    pipeline.add_stage('plots', lambda _: self.redraw(),
+                       {'graph':  lambda: self.config.graph},
+                       ['statistics'])
+    return pipeline
+
+  def update_timeline(self, changed: List[str]) -> None:
+    # Doses added to the end of the lists or logs are simulated on top of the calculated timeline
+    if changed != ['doses'] or not self.add_appended_doses(self.model_doses):
+      self.setup_model()
+    self.model_doses = dict(self.config.dose_columns)
+
+  def setup_model(self) -> None:
     self.initialize_drugs(self.config)
-    self.get_std_dev_vars(self.config)
     self.model = BodyModel(self.config.model['start_date'],
                            self.config.model['timedelta'])
+    self.model.step_days = STEP_DAYS
+    if self.use_cache:
+      self.model.result_cache = ResultCache()
 
-    self.add_drugs(self.model, self.drugs)
+    self.add_drugs(self.model, self.drugs, self.drug_factors)
     self.add_doses(self.model, self.config)
-    self.get_lab_data(self.model, self.config)
-    self.add_events(self.model, self.config)
 
     self.days_into_future = self.config.model['days_into_future']
     self.model.calculate_timeline(date.today() + timedelta(days=self.days_into_future))
 
-    if len(self.lab_data_list) > 0:
+  def estimate_factors(self) -> None:
+    self.get_std_dev_vars(self.config)
+    self.model.track_factor = self.config.model['track_factor']
+    self.model.events = []
+    self.add_events(self.model, self.config)
+    self.get_lab_data(self.model, self.config)
+    if len(self.model.lab_table) > 0:
       self.model.estimate_blood_levels(corrected_std_dev=self.config.model['corrected_std_dev'])
       self.print_drug_data(self.model, self.drugs)
 
+  def calculate_statistics(self, parallel: bool = True) -> None:
     self.now = self.calculate_now()
     self.duration_factor = self.model.step / self.config.graph['units']
     self.duration = self.model.duration * self.duration_factor
@@ -65,33 +191,101 @@ class HormoneLevels:
     # three_months_ago  = duration - (90+days_into_future)*24
     # half_year_ago     = duration - (183+days_into_future)*24
 
-    self.y_window = self.config.graph['y_window']
-
-    self.model.step_days = STEP_DAYS
-    self.data, self.confidence = self.get_data()
+    self.data, self.confidence = self.get_data(parallel)
     self.avg_levels, self.lab_levels = self.calculate_lab_levels()
 
-    self.print_estimates()
     self.calculate_xticks()
     self.start_model = datetime.combine(self.config.model['start_date'], time())
 
     if not self.config.graph['confidence']:
       self.confidence = None
 
-    self.full_plot()
-    self.plots()
-    self.plot_prediction_error()
-    # print(datetime.now() - starttime)
+  def write_export(self) -> None:
+    if self.export_path is not None:
+      path = export_timelines(self.model, self.export_path, self.std_dev_count)
+      print(f"Exported timelines to {path}")
+
+  def export(self, path: Path) -> None:
+    self.export_path = path
+    self.pipeline.run('export')
+
+  def redraw(self) -> None:
+    from graphing.plot import close_plots
+    close_plots()
+    self.render(self.output_dir)
+
+  def add_appended_doses(self, old_columns: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> bool:
+    # Extends the model by the doses added after old_columns, False if the doses changed in any other way
+    new_columns = self.config.dose_columns
+    if set(new_columns.keys()) != set(old_columns.keys()):
+      return False
+    appended = {}
+    for drug_key, (times, amounts) in new_columns.items():
+      known_times, known_amounts = old_columns[drug_key]
+      known = len(known_times)
+      if len(times) < known or not np.array_equal(times[:known], known_times) or \
+         not np.array_equal(amounts[:known], known_amounts):
+        return False
+      appended[drug_key] = (times[known:], amounts[known:])
+    for drug_key, (times, amounts) in appended.items():
+      if len(times) > 0:
+        self.model.extend_doses(drug_key, times, amounts)
+    return True
+
+  def update_journals(self, until: Optional[str] = 'estimates') -> List[str]:
+    # Reads what was appended to the CSV dose logs and reruns the stages after the timeline, which only gets
+    # the new doses added. Returns the stages that ran.
+    for drug_key, (file_name, _) in self.config.dose_logs.items():
+      self.config.dose_columns[drug_key] = DoseJournal(Path(file_name)).read()
+      self.config.dose_logs[drug_key] = (file_name, YAMLparser.dose_log_stat(Path(file_name)))
+    return self.pipeline.run(until)
+
+  def reload(self, until: Optional[str] = None) -> List[str]:
+    # Parses the configuration again and reruns the stages whose inputs changed. Returns the stages that ran.
+    self.config = YAMLparser(self.config_file, self.use_cache)
+    return self.pipeline.run(until)
+
+  def watched_files(self) -> Dict[str, Optional[Tuple[int, int]]]:
+    files = [self.config_file] + list(map(lambda log: Path(log[0]), self.config.dose_logs.values()))
+    return dict(map(lambda f: (str(f), YAMLparser.dose_log_stat(f)), files))
+
+  def watch(self, interval: float = 1.0, output_dir: Optional[Path] = None) -> None:
+    # Polls the configuration and its dose logs, keeping the model and the figures between changes
+    from graphing.plot import interactive_plots, wait_for_plots
+    if output_dir is None:
+      interactive_plots()
+    self.output_dir = output_dir
+    self.pipeline.run()
+    stats = self.watched_files()
+    print(f"Watching {self.config_file} for changes, press Ctrl+C to stop")
+    try:
+      while True:
+        wait_for_plots(interval)
+        current = self.watched_files()
+        if current == stats:
+          continue
+        stats = current
+        started = datetime.now()
+        try:
+          stages = self.reload()
+        except Exception as e:
+          # Keep watching, the file was probably saved in the middle of an edit
+          print(f"WARNING: {e}")
+          continue
+        if len(stages) > 0:
+          print(f"Updated {', '.join(stages)} in {(datetime.now() - started).total_seconds():.2f}s")
+    except KeyboardInterrupt:
+      pass
 
   def initialize_drugs(self, config: YAMLparser) -> None:
     self.drugs = {}
+    self.drug_factors = {}
     for drug_key, drug_obj in config.drugs.items():
       drug_name = drug_obj['name']
-      drug_factor = drug_obj['factor']
-      drug_class = drug_db(drug_name)
-      if drug_class is not None:
-        self.drugs[drug_key] = drug_class()
-        self.drugs[drug_key].factor = drug_factor
+      drug_definition = drug_db(drug_name)
+      if drug_definition is not None:
+        self.drugs[drug_key] = drug_definition()
+        self.drug_factors[drug_key] = drug_obj['factor']
       else:
         print(f"WARNING: Cannot find drug {drug_name} in database")
 
@@ -103,24 +297,18 @@ class HormoneLevels:
       self.p_confidence = ".046"
 
   @staticmethod
-  def add_drugs(model: BodyModel, drugs: Dict[str, Drug]) -> None:
-    for drug_key, drug_class in drugs.items():
-      model.add_drugs(drug_key, drug_class)
+  def add_drugs(model: BodyModel, drugs: Dict[str, Drug], factors: Dict[str, float]) -> None:
+    for drug_key, drug in drugs.items():
+      model.add_drugs(drug_key, drug, factors[drug_key])
 
   @staticmethod
   def add_doses(model: BodyModel, config: YAMLparser) -> None:
-    for drug_name, doses in config.doses.items():
-      for dose in doses:
-        model.add_dose(drug_name, dose['dose'], dose['date'])
-
-  def get_lab_data(self, model: BodyModel, config: YAMLparser):
-    self.lab_data_list = []
-    for lab in config.labs:
-      lab_values = {}
-      for drug_key, value in lab['values'].items():
-        lab_values[drug_key] = value
-      self.lab_data_list.append(LabData(lab['date'], lab_values))
-    model.add_lab_data(self.lab_data_list)
+    for drug_name, (times, amounts) in config.dose_columns.items():
+      model.add_dose_array(drug_name, times, amounts)
+
+  @staticmethod
+  def get_lab_data(model: BodyModel, config: YAMLparser):
+    model.lab_table = config.lab_table
 
   @staticmethod
   def add_events(model: BodyModel, config: YAMLparser) -> None:
@@ -142,7 +330,7 @@ class HormoneLevels:
     seconds_since_start = float((datetime.today() - datetime.combine(self.model.starting_date, time())).total_seconds())
     return seconds_since_start / (3600.0 * float(self.config.graph['units'] / self.config.model['timedelta']))
 
-  def get_data(self) -> Tuple[Tuple[np.ndarray, Dict[str, plot_data_type]], float]:
+  def get_data(self, parallel: bool = True) -> Tuple[Tuple[np.ndarray, Dict[str, plot_data_type]], float]:
     if self.std_dev_count == 1:
       # 68% confidence at a single standard deviation
       confidence = 68
@@ -150,7 +338,8 @@ class HormoneLevels:
                                       True,
                                       color=True,
                                       offset=self.config.graph['x_offset'],
-                                      use_x_date=self.config.graph['use_x_date'])
+                                      use_x_date=self.config.graph['use_x_date'],
+                                      parallel=parallel)
     elif self.std_dev_count == 2:
       # 95% Confidence at twice the standard deviation
       confidence = 95.5
@@ -159,7 +348,8 @@ class HormoneLevels:
                                       stddev_multiplier=2,
                                       color=True,
                                       offset=self.config.graph['x_offset'],
-                                      use_x_date=self.config.graph['use_x_date'])
+                                      use_x_date=self.config.graph['use_x_date'],
+                                      parallel=parallel)
     else:
       raise Exception("Can only have one or two standard deviations as banding options")
     return data, confidence
@@ -168,7 +358,7 @@ class HormoneLevels:
                                           Dict[str, Tuple[List[Union[int, datetime]], List[float]]]
                                           ]:
     avg_levels = {}
-    if len(self.lab_data_list) > 0:
+    if len(self.model.lab_table) > 0:
       for n, drug_key in enumerate(self.config.drugs.keys()):
         stats = self.model.get_statistical_data(drug_key)
         if stats is not None:
@@ -198,32 +388,44 @@ class HormoneLevels:
     while self.duration > self.xticks * 20:
       self.xticks *= 2
 
-  def full_plot(self) -> None:
-    if not self.config.graph['deactivate_full_plot']:
-      if self.config.graph['use_x_date']:
-        x_win = (self.start_model, self.start_model + self.config.graph['units'] * self.duration)
-        self.now = datetime.now()
-      else:
-        x_win = (0, self.duration)
-      plot_drugs(data=self.data,
-                 x_window=x_win,
-                 y_window=self.y_window,
-                 x_label=self.config.graph['x_label'],
-                 y_label=self.config.graph['y_label'],
-                 lab_data=self.lab_levels,
-                 confidence_val=self.confidence,
-                 now=self.now,
-                 title="Full view",
-                 x_ticks=self.xticks,
-                 avg_levels=self.avg_levels,
-                 plot_dates=self.config.graph['use_x_date'],
-                 moving_average=self.model.running_average,
-                 moving_deviation=self.model.running_stddev,
-                 avg_length=STEP_DAYS,
-                 )
-
-  def plots(self) -> None:
-    for plot in self.config.graph['plots']:
+  def plot_file(self, output_dir: Optional[Path], n: int, title: Optional[str]) -> Optional[Path]:
+    if output_dir is None:
+      return None
+    if title is None:
+      title = "plot"
+    slug = re.sub(r"[^a-z0-9]+", "_", title.lower()).strip("_")
+    return output_dir / f"{self.config_file.stem}_{n:02d}_{slug}.{self.plot_format}"
+
+  def full_plot(self, output_dir: Optional[Path] = None) -> Optional[Dict[str, Any]]:
+    if self.config.graph['deactivate_full_plot']:
+      return None
+    if self.config.graph['use_x_date']:
+      x_win = (self.start_model, self.start_model + self.config.graph['units'] * self.duration)
+      self.now = datetime.now()
+    else:
+      x_win = (0, self.duration)
+    return dict(data=self.data,
+                x_window=x_win,
+                y_window=self.y_window,
+                x_label=self.config.graph['x_label'],
+                y_label=self.config.graph['y_label'],
+                lab_data=self.lab_levels,
+                confidence_val=self.confidence,
+                now=self.now,
+                title="Full view",
+                x_ticks=self.xticks,
+                avg_levels=self.avg_levels,
+                plot_dates=self.config.graph['use_x_date'],
+                moving_average=self.model.running_average,
+                moving_deviation=self.model.running_stddev,
+                avg_length=STEP_DAYS,
+                dpi=self.dpi,
+                save_to=self.plot_file(output_dir, 0, "Full view"),
+                )
+
+  def plots(self, output_dir: Optional[Path] = None) -> List[Dict[str, Any]]:
+    figures = []
+    for n, plot in enumerate(self.config.graph['plots']):
       if plot['time_absolute']:
         past_window = plot['begin_day']
         future_window = plot['end_day']
@@ -240,24 +442,119 @@ class HormoneLevels:
         self.now = datetime.now()
       else:
         x_win = (past_window, future_window)
-      plot_drugs(data=self.data,
-                 x_window=x_win,
-                 y_window=y_win,
-                 x_ticks=plot['x_ticks'],
-                 x_label=self.config.graph['x_label'],
-                 y_label=self.config.graph['y_label'],
-                 lab_data=self.lab_levels,
-                 confidence_val=self.confidence,
-                 now=self.now,
-                 title=plot['title'],
-                 avg_levels=self.avg_levels,
-                 plot_dates=self.config.graph['use_x_date'],
-                 moving_average=self.model.running_average,
-                 moving_deviation=self.model.running_stddev,
-                 avg_length=STEP_DAYS,
-                 )
-
-  def plot_prediction_error(self) -> None:
+      figures.append(dict(data=self.data,
+                          x_window=x_win,
+                          y_window=y_win,
+                          x_ticks=plot['x_ticks'],
+                          x_label=self.config.graph['x_label'],
+                          y_label=self.config.graph['y_label'],
+                          lab_data=self.lab_levels,
+                          confidence_val=self.confidence,
+                          now=self.now,
+                          title=plot['title'],
+                          avg_levels=self.avg_levels,
+                          plot_dates=self.config.graph['use_x_date'],
+                          moving_average=self.model.running_average,
+                          moving_deviation=self.model.running_stddev,
+                          avg_length=STEP_DAYS,
+                          dpi=self.dpi,
+                          save_to=self.plot_file(output_dir, n + 1, plot['title']),
+                          ))
+    return figures
+
+  def calculate_prediction_errors(self) -> Dict[str, List[Tuple[datetime, float, float, float]]]:
+    errors = {}
+    for lab in self.config.labs:
+      for drug_key, lab_val in lab['values'].items():
+        if drug_key not in self.model.drugs_timeline:
+          continue
+        predicted = self.model.get_blood_level_at_timepoint(drug_key, lab['date'])
+        predicted = predicted[0] * predicted[1]
+        if drug_key not in errors:
+          errors[drug_key] = []
+        # print(f"{predicted} -> {lab_val}")
+        errors[drug_key].append((lab['date'], lab_val, predicted, ((lab_val - predicted) / lab_val) * 100))
+    return errors
+
+  def get_current_estimates(self) -> Dict[str, Tuple[float, float, float]]:
+    estimates = {}
+    for drug_key in self.drugs.keys():
+      if drug_key in self.model.lab_levels:
+        estimates[drug_key] = self.model.get_blood_level_at_timepoint(drug_key, datetime.now())
+    return estimates
+
+  def fit_parameters(self, starts: int = 16) -> List[FitResult]:
+    results = []
+    doses = self.config.dose_columns
+    events = list(map(lambda e: e['event_date'], self.config.model['events']))
+    for drug_key in self.model.lab_levels.keys():
+      for parent in doses.keys():
+        result = fit_drug_parameters(self.model.drugs, self.model.drugs_by_name, doses,
+                                     self.model.lab_levels[drug_key], events,
+                                     self.model.starting_date, self.model.step,
+                                     parent, drug_key, starts)
+        if result is not None:
+          print(result.message())
+          results.append(result)
+    return results
+
+  def detect_drift(self, window: int = 4) -> Dict[str, List[ChangePoint]]:
+    results = {}
+    for drug_key in self.model.lab_levels.keys():
+      change_points = detect_drift(self.model, drug_key, window)
+      results[drug_key] = change_points
+      if len(change_points) == 0:
+        print(f"No significant shift in metabolism found for {self.model.drugs[drug_key].name_blood}")
+        continue
+      for change_point in change_points:
+        print(change_point.message())
+      print("Suggested events for the model section:\n  events:")
+      for change_point in change_points:
+        print(change_point.event_yaml())
+    return results
+
+  def plan_doses(self) -> Optional[DosePlan]:
+    plan = self.config.plan
+    if plan is None:
+      print("WARNING: no plan section in the configuration, nothing to plan")
+      return None
+    dose_plan = plan_doses(self.model, plan['drug'], plan['target'], plan['band'],
+                           plan['doses'], plan['intervals'], plan['hour'])
+    if dose_plan is not None:
+      print(dose_plan.message())
+      print(dose_plan.yaml())
+    return dose_plan
+
+  def summary(self) -> Dict[str, Any]:
+    out = {'config': str(self.config_file), 'drugs': {}}
+    estimates = self.get_current_estimates()
+    errors = self.calculate_prediction_errors()
+    for drug_key, drug in self.drugs.items():
+      drug_summary: Dict[str, Any] = {'name': drug.name_blood}
+      if drug_key in estimates:
+        drug_amount, factor_avg, factor_stddev = estimates[drug_key]
+        drug_summary['estimate'] = drug_amount * factor_avg
+        drug_summary['estimate_stddev'] = factor_stddev
+        drug_summary['factor'] = factor_avg
+      if drug.name in self.avg_levels:
+        drug_summary['average'] = self.avg_levels[drug.name][0]
+        drug_summary['average_stddev'] = self.avg_levels[drug.name][1]
+      if drug_key in errors:
+        drug_summary['prediction_errors'] = [
+          {'date': lab_date.isoformat(), 'lab': lab_val, 'predicted': predicted, 'error': error}
+          for lab_date, lab_val, predicted, error in errors[drug_key]
+        ]
+        drug_summary['mean_abs_error'] = sum(map(lambda x: abs(x[3]), errors[drug_key])) / len(errors[drug_key])
+      out['drugs'][drug_key] = drug_summary
+    return out
+
+  def print_prediction_errors(self) -> None:
+    for drug_key, errors in self.calculate_prediction_errors().items():
+      for lab_date, lab_val, predicted, error in errors:
+        print(f"Prediction for {self.model.drugs[drug_key].name_blood} at {lab_date}: {predicted:6.2f} ng/l, "
+              f"lab {lab_val:6.2f} ng/l ({error:+6.1f}%)")
+
+  def plot_prediction_error(self, output_dir: Optional[Path] = None) -> Optional[Dict[str, Any]]:
     if self.config.graph['prediction_error']:
       times = []
       prediction_data = {}
@@ -270,37 +567,23 @@ class HormoneLevels:
         max_t = 0
       magnitude = 0.0
       x_window = (0, 0)
-      for lab in self.config.labs:
-        lab_date = lab['date']
-        lab_value = lab['values']
-        plot_start = datetime.combine(self.config.model['start_date'], time(0, 0, 0))
-        if self.config.graph['use_x_date']:
-          lab_time = lab_date
-          min_t = min(min_t, lab_time)
-          max_t = max(max_t, lab_time)
-          # if lab_time < min_t:
-          #   min_t = lab_time
-          # if lab_time > max_t:
-          #   max_t = lab_time
-          x_window = (min_t - timedelta(days=7), max_t + timedelta(days=7))
-        else:
-          lab_time = (lab_date - plot_start).total_seconds() / self.config.graph['units'].total_seconds()
-          min_t = min(min_t, lab_time)
-          max_t = max(max_t, lab_time)
-          x_window = (max(min_t - 7, 0), min(max_t + 7, self.duration))
-
-        times.append(lab_time)
-        for drug_key, lab_val in lab_value.items():
-          predicted = self.model.get_blood_level_at_timepoint(drug_key, lab_date)
-          predicted = predicted[0] * predicted[1]
-          if drug_key not in prediction_data:
-            prediction_data[drug_key] = []
-          # print(f"{predicted} -> {lab_val}")
-          val = ((lab_val - predicted) / lab_val) * 100
-          if val >= 0:
-            magnitude = max(magnitude, val)
+      plot_start = datetime.combine(self.config.model['start_date'], time(0, 0, 0))
+      for drug_key, errors in self.calculate_prediction_errors().items():
+        prediction_data[drug_key] = []
+        for lab_date, _, _, val in errors:
+          if self.config.graph['use_x_date']:
+            lab_time = lab_date
+            min_t = min(min_t, lab_time)
+            max_t = max(max_t, lab_time)
+            x_window = (min_t - timedelta(days=7), max_t + timedelta(days=7))
           else:
-            magnitude = max(magnitude, -val)
+            lab_time = (lab_date - plot_start).total_seconds() / self.config.graph['units'].total_seconds()
+            min_t = min(min_t, lab_time)
+            max_t = max(max_t, lab_time)
+            x_window = (max(min_t - 7, 0), min(max_t + 7, self.duration))
+          if lab_time not in times:
+            times.append(lab_time)
+          magnitude = max(magnitude, abs(val))
           prediction_data[drug_key].append(val)
       for drug_key, data in prediction_data.items():
         arrays[drug_key] = (np.array(data), np.array(data), np.array(data))
@@ -314,17 +597,94 @@ class HormoneLevels:
         delta *= 2
         tick_count = math.floor(duration_labs / delta)
 
-      plot_drugs(data=(np.array(times), arrays),
-                 x_window=x_window,
-                 y_window=(-magnitude * 1.2, magnitude * 1.2),
-                 x_ticks=delta,
-                 x_label=self.config.graph['x_label'],
-                 y_label="Deviation of estimation (%)",
-                 title="Prediction accuracy",
-                 plot_markers=True,
-                 plot_dates=self.config.graph['use_x_date'],
-                 )
+      return dict(data=(np.array(times), arrays),
+                  x_window=x_window,
+                  y_window=(-magnitude * 1.2, magnitude * 1.2),
+                  x_ticks=delta,
+                  x_label=self.config.graph['x_label'],
+                  y_label="Deviation of estimation (%)",
+                  title="Prediction accuracy",
+                  plot_markers=True,
+                  plot_dates=self.config.graph['use_x_date'],
+                  dpi=self.dpi,
+                  save_to=self.plot_file(output_dir, len(self.config.graph['plots']) + 1, "Prediction accuracy"),
+                  )
+    return None
+
+
+def parse_arguments() -> argparse.Namespace:
+  arg_parser = argparse.ArgumentParser(description="Compute and graph hormone levels")
+  arg_parser.add_argument('config', type=Path, help="YAML configuration file")
+  arg_parser.add_argument('--no-cache', action='store_true', help="always parse the configuration from scratch")
+  arg_parser.add_argument('--fit', action='store_true',
+                          help="fit half-life and absorption of the dosed drugs against the labs")
+  arg_parser.add_argument('--fit-starts', type=int, default=16, help="number of starting points for --fit")
+  arg_parser.add_argument('--drift', action='store_true',
+                          help="look for shifts in metabolism in the lab history and suggest events")
+  arg_parser.add_argument('--drift-window', type=int, default=4, help="labs on each side of a shift for --drift")
+  arg_parser.add_argument('--plan', action='store_true',
+                          help="search future doses keeping the level inside the band of the plan section")
+  arg_parser.add_argument('--output', type=Path, default=None,
+                          help="save the plots as image files into this directory instead of showing them")
+  arg_parser.add_argument('--format', choices=['png', 'svg'], default='png', help="image format for --output")
+  arg_parser.add_argument('--dpi', type=int, default=800, help="resolution of the plots")
+  arg_parser.add_argument('--decimate', choices=['minmax', 'lttb', 'none'], default='minmax',
+                          help="how the timelines are thinned out to the resolution of the plots")
+  arg_parser.add_argument('--jobs', type=int, default=None,
+                          help="processes rendering the plots for --output (default: core count)")
+  arg_parser.add_argument('--export', type=Path, default=None,
+                          help="write the timelines, levels and running statistics to a .npz, .parquet or .csv file")
+  arg_parser.add_argument('--query', action='store_true',
+                          help="only print the current estimates, averages and prediction errors, without plotting")
+  arg_parser.add_argument('--json', action='store_true',
+                          help="like --query, but print the results as JSON, the usual messages go to stderr")
+  arg_parser.add_argument('--watch', action='store_true',
+                          help="keep running and recalculate whenever the configuration or a dose log changes")
+  arg_parser.add_argument('--watch-interval', type=float, default=1.0,
+                          help="seconds between checks for changes with --watch")
+  args = arg_parser.parse_args()
+  if (args.query or args.json) and (args.output is not None or args.watch):
+    arg_parser.error("--query and --json don't plot, they cannot be combined with --output or --watch")
+  return args
+
+
+def headless_actions(levels: HormoneLevels, args: argparse.Namespace) -> None:
+  if args.fit:
+    levels.fit_parameters(args.fit_starts)
+  if args.drift:
+    levels.detect_drift(args.drift_window)
+  if args.plan:
+    levels.plan_doses()
+  if args.export is not None:
+    levels.export(args.export)
+
+
+def query(args: argparse.Namespace) -> None:
+  if args.json:
+    with redirect_stdout(sys.stderr):
+      levels = HormoneLevels(args.config, render=False, use_cache=not args.no_cache)
+      headless_actions(levels, args)
+    print(json.dumps(levels.summary(), indent=2))
+  else:
+    levels = HormoneLevels(args.config, render=False, use_cache=not args.no_cache)
+    headless_actions(levels, args)
+    levels.print_prediction_errors()
 
 
 if __name__ == '__main__':
-  HormoneLevels()
+  args = parse_arguments()
+  if args.query or args.json:
+    query(args)
+    sys.exit(0)
+  levels = HormoneLevels(args.config, render=False, use_cache=not args.no_cache)
+  levels.plot_format = args.format
+  levels.dpi = args.dpi
+  levels.render_jobs = args.jobs
+  levels.decimation = None if args.decimate == 'none' else args.decimate
+  headless_actions(levels, args)
+  if args.output is not None:
+    args.output.mkdir(parents=True, exist_ok=True)
+  if args.watch:
+    levels.watch(args.watch_interval, args.output)
+  else:
+    levels.render(args.output)
@@ -19,4 +19,14 @@ from .sized_pot import SizedPot
 from .group_sum import GroupSum
 from .dose import Dose
 from .lab_data import LabData
+from .dose_table import DoseTable
+from .lab_table import LabTable
+from .fitting import FitResult, fit_drug_parameters
+from .dose_planner import DosePlan, plan_doses
+from .factor_estimator import FactorStatistics, FactorKalman, OnlineFactorEstimator
+from .drift import ChangePoint, detect_drift
+from .pipeline import Stage, Pipeline
+from .result_cache import ResultCache
+from .export import export_timelines
+from .timeline_pyramid import TimelinePyramid
 
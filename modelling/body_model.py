@@ -26,13 +26,16 @@ from datetime import datetime, date, timedelta, time
 from funcy import take, map, count, drop, lmap
 
 from modelling.group_sum import GroupSum
+from modelling.kernels import metabolite_matrix
 from modelling.lab_data import LabData
-from modelling.dose import Dose
+from modelling.lab_table import LabTable
+from modelling.dose_table import DoseTable, epoch_us
+from modelling.factor_estimator import OnlineFactorEstimator
+from modelling.result_cache import ResultCache, result_key
 from modelling.sized_pot import SizedPot
+from modelling.timeline_pyramid import TimelinePyramid
 from graphing.color_list import get_color
 
-import multiprocessing as mp
-
 
 plot_data_type = Union[Tuple[np.ndarray, np.ndarray, np.ndarray],
                        Tuple[np.ndarray, np.ndarray, np.ndarray, str]]
@@ -53,52 +56,78 @@ def calculate_running_statistics(in_data: Tuple[Sequence[int], List[float], int]
   return average, std_dev
 
 
+def as_list(values: Union[Sequence, np.ndarray]) -> list:
+  # Timelines loaded from the result cache are memory mapped arrays, element wise Python code is faster on lists
+  return values.tolist() if isinstance(values, np.ndarray) else values
+
+
 class BodyModel:
   starting_date: date
   step: timedelta
   drugs: Dict[str, Drug]
-  doses_list: Dict[str, List[Dose]]
-  labs_list: List[LabData]
+  drug_factors: Dict[str, float]
+  dose_table: DoseTable
+  lab_table: LabTable
   blood_level_factors: Dict[str, List[Tuple[float, float]]]
   factors_timeline: Dict[str, List[Tuple[float, float]]]
   running_average:  Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]
   running_stddev:   Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]
+  blood_levels:     Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]
+  level_sums:       Dict[str, Tuple[np.ndarray, np.ndarray]]
+  timeline_pyramids: Dict[str, TimelinePyramid]
+  level_pyramids:    Dict[str, TimelinePyramid]
   lab_levels: Dict[str, List[Tuple[datetime, float]]]
   lab_events: Dict[str, List[List[Tuple[datetime, float]]]]
   drugs_timeline: Dict[str, List[float]]
   duration: int
+  until: Optional[date]
   real_duration: int
   doses_count: Dict[str, int]
   doses_amount: Dict[str, float]
   events: List[Tuple[date, timedelta]]
   step_days: Tuple[int, int, int]
+  factor_estimator: Optional[OnlineFactorEstimator]
+  corrected_std_dev: bool
+  track_factor: bool
+  result_cache: Optional[ResultCache]
 
   def __init__(self, starting_date: date, time_steps: timedelta):
     self.starting_date = starting_date
     self.drugs = {}
     self.drugs_by_name = {}
+    self.drug_factors = {}
     self.step = time_steps
-    self.doses_list = {}
+    self.dose_table = DoseTable()
     self.drugs_timeline = {}
     self.blood_level_factors = {}
-    self.labs_list = []
+    self.lab_table = LabTable()
     self.factor_timeline = {}
+    self.blood_levels = {}
+    self.level_sums = {}
+    self.timeline_pyramids = {}
+    self.level_pyramids = {}
     self.lab_levels = {}
     self.lab_events = {}
     self.duration = 0
+    self.until = None
     self.real_duration = 0
     self.doses_count = {}
     self.doses_amount = {}
     self.events = []
     self.step_days = (5, 30, 90)
+    self.factor_estimator = None
+    self.corrected_std_dev = True
+    self.track_factor = False
+    self.result_cache = None
 
   @staticmethod
   def delta_to_hours(td: timedelta) -> int:
     return math.ceil(td.total_seconds() / 3600.0)
 
-  def add_drugs(self, drug_name: str, drug: Drug):
+  def add_drugs(self, drug_name: str, drug: Drug, factor: float = 1.0):
     self.drugs[drug_name] = drug
     self.drugs_by_name[drug.name] = drug_name
+    self.drug_factors[drug_name] = factor
     self.doses_amount[drug_name]  = 0
     self.doses_count[drug_name]   = 0
 
@@ -107,32 +136,72 @@ class BodyModel:
     self.events.sort(key=lambda x: x[0])
 
   def add_dose(self, drug: str, amount: float, time_in: datetime):
-    dose = Dose(self.drugs[drug], amount, time_in)
-    if dose.time < datetime.combine(self.starting_date, time()):
+    self.add_dose_array(drug, np.array([time_in], dtype='datetime64[us]'), np.array([amount], dtype=float))
+
+  def add_dose_array(self, drug: str, times: np.ndarray, amounts: np.ndarray):
+    # Columnar doses (datetime64, amount) are binned into the timeline in one go instead of one Dose per entry
+    times = times.astype('datetime64[s]').astype('datetime64[us]')
+    if len(times) > 0 and times.min() < np.datetime64(datetime.combine(self.starting_date, time()), 'us'):
       raise Exception("Doses cannot be before starting date")
-    if drug not in self.doses_list:
-      self.doses_list[drug] = []
-    for d in dose.get_partial_doses():
-      self.doses_list[drug].append(d)
-    self.doses_list[drug].sort(key=lambda x: x.time)
+    amounts = np.asarray(amounts, dtype=float)
+    self.dose_table.append(drug, times, amounts)
     if drug not in self.doses_count:
       self.doses_count[drug] = 0
     if drug not in self.doses_amount:
       self.doses_amount[drug] = 0.0
-    if time_in <= datetime.now():
-      self.doses_count[drug] += 1
-      self.doses_amount[drug] += amount
+    taken = times <= np.datetime64(datetime.now(), 'us')
+    self.doses_count[drug] += int(np.count_nonzero(taken))
+    self.doses_amount[drug] += float(np.sum(amounts[taken]))
+
+  def __dose_input(self, drug: str) -> List[float]:
+    # Amount entering the body at each step, a dose at time x is added at the first step not before x
+    dose_input = np.zeros(self.duration)
+    d = self.drugs[drug]
+    start = int(epoch_us(datetime.combine(self.starting_date, time())))
+    step_us = self.step / timedelta(microseconds=1)
+    for subdose in (False, True):
+      if d.flood_in is None or subdose:
+        offsets, fractions = np.zeros(1), np.ones(1)
+      else:
+        offsets = np.arange(len(d.flood_in)) * (d.flood_in_timedelta / timedelta(microseconds=1))
+        fractions = np.asarray(d.flood_in, dtype=float)
+      rows = self.dose_table.rows(drug, subdose)
+      partial_times = (self.dose_table.times[rows] - start)[:, np.newaxis] + offsets[np.newaxis, :]
+      steps = np.ceil(partial_times / step_us).astype(np.int64)
+      values = self.dose_table.amounts[rows][:, np.newaxis] * fractions[np.newaxis, :]
+      in_range = steps < self.duration
+      np.add.at(dose_input, steps[in_range], values[in_range])
+    return dose_input.tolist()
+
+  def extend_doses(self, drug: str, times: np.ndarray, amounts: np.ndarray):
+    # Levels are linear in the doses, so appended doses are simulated on their own from their first step on
+    # and added to the calculated timeline, instead of calculating the whole timeline again
+    self.add_dose_array(drug, times, amounts)
+    if self.until is None or len(times) == 0:
+      return
+    start = np.datetime64(datetime.combine(self.starting_date, time()), 'us')
+    first_step = int(np.ceil((times.astype('datetime64[us]').min() - start) / np.timedelta64(self.step)))
+    if first_step >= self.duration:
+      return
+    appended = BodyModel(self.starting_date, self.step)
+    appended.drugs = self.drugs
+    appended.drugs_by_name = self.drugs_by_name
+    appended.dose_table.append(drug, times.astype('datetime64[s]').astype('datetime64[us]'), amounts)
+    appended.calculate_timeline(self.until, first_step)
+    for d, timeline in appended.drugs_timeline.items():
+      if d not in self.drugs_timeline:
+        self.drugs_timeline[d] = [0.0] * self.duration
+      self.drugs_timeline[d] = list(self.drugs_timeline[d][:first_step]) + \
+        lmap(lambda x: x[0] + x[1], zip(self.drugs_timeline[d][first_step:], timeline[first_step:]))
+      if d in self.timeline_pyramids:
+        self.timeline_pyramids[d].update(self.drugs_timeline[d], first_step)
 
   def add_lab_data(self, data_in: Union[LabData, List[LabData]]):
-    if type(data_in) is type(LabData):
-      data = [data_in]
-    else:
-      data = data_in
-    for d in data:
-      self.labs_list.append(d)
+    data = [data_in] if isinstance(data_in, LabData) else data_in
+    self.lab_table.extend(map(lambda d: (d.time, d.labs), data))
 
-  def calculate_timeline(self, until: date):
-    drugs = set(self.doses_list.keys())
+  def calculate_timeline(self, until: date, from_step: int = 0):
+    drugs = set(self.dose_table.drugs)
     while True:
       start_len = len(drugs)
       new_drugs = set()
@@ -144,30 +213,47 @@ class BodyModel:
       if len(drugs) == start_len:
         break
     for drug in drugs:
-      self.drugs_timeline[drug] = []
+      self.drugs_timeline[drug] = [0.0] * from_step
+    self.timeline_pyramids = {}
+    self.until = until
     self.duration = math.ceil((until - self.starting_date).total_seconds() / self.step.total_seconds())
     self.real_duration = math.ceil((date.today() - self.starting_date).total_seconds() / self.step.total_seconds())
-    for t in range(self.duration):
-      time_t = datetime.combine(self.starting_date, time()) + self.step * t
+    key = None
+    if self.result_cache is not None and from_step == 0:
+      key = result_key('timeline', (self.starting_date, self.step, until,
+                                    sorted(map(lambda d: (d, self.drugs[d]), drugs)),
+                                    self.dose_table.key()))
+      cached = self.result_cache.get(key)
+      if cached is not None:
+        for n, drug in enumerate(sorted(drugs)):
+          self.drugs_timeline[drug] = cached['timeline'][n]
+        return
+    dose_input = {d: self.__dose_input(d) for d in drugs}
+    keys = sorted(drugs)
+    decay, fractions = metabolite_matrix(tuple(map(lambda d: self.drugs[d], keys)), self.step)
+    decay = dict(zip(keys, decay))
+    metabolites = dict(map(lambda n: (keys[n], lmap(lambda m: (keys[m], float(fractions[n, m])),
+                                                    np.flatnonzero(fractions[n]))),
+                           range(len(keys))))
+    # Metabolised amounts enter their drug once it is next visited, in this step or the next one
+    pending = dict.fromkeys(keys, 0.0)
+    for t in range(from_step, self.duration):
       for d in drugs:
-        if t > 0:
+        if t > from_step:
           last_val = self.drugs_timeline[d][-1]
-          curr_val = last_val * self.drugs[d].get_metabolism_factor(self.step)
+          curr_val = last_val * decay[d]
           self.drugs_timeline[d].append(curr_val)
-          metabolites = self.drugs[d].get_metabolites(last_val - curr_val)
-          for drug, amount in metabolites:
-            if drug not in self.doses_list:
-              self.doses_list[self.drugs_by_name[drug]] = []
-            self.doses_list[self.drugs_by_name[drug]].insert(0, Dose(self.drugs[self.drugs_by_name[drug]],
-                                                             amount, time_t, True))
+          for drug, fraction in metabolites[d]:
+            pending[drug] += (last_val - curr_val) * fraction
         else:
           self.drugs_timeline[d].append(0.0)
-        while d in self.doses_list and \
-                self.doses_list[d] and \
-                len(self.doses_list[d]) > 0 and \
-                self.doses_list[d][0].time <= time_t:
-          dose = self.doses_list[d].pop(0)
-          self.drugs_timeline[d][t] += dose.amount
+        if pending[d] != 0.0:
+          self.drugs_timeline[d][t] += pending[d]
+          pending[d] = 0.0
+        self.drugs_timeline[d][t] += dose_input[d][t]
+    if key is not None:
+      self.result_cache.put(key, {'timeline': np.array(lmap(lambda d: self.drugs_timeline[d], sorted(drugs)),
+                                                       dtype=float).reshape(len(drugs), self.duration)})
 
   def __get_timepoint(self, t: datetime) -> int:
     timepoint = datetime(t.year, t.month, t.day, t.hour)
@@ -182,6 +268,9 @@ class BodyModel:
     timepoint   = self.__get_timepoint(t)
     # avg = 0.0
     # stddev = 0.0
+    if self.track_factor and d in self.blood_level_factors:
+      tracked = self.get_tracked_factor(d, t)
+      return timeline[timepoint], tracked[0], timeline[timepoint] * tracked[1]
     if d in self.blood_level_factors:
       if len(self.events) > 0:
         # events_max = len(self.events)-1
@@ -213,6 +302,71 @@ class BodyModel:
       stddev = timeline[timepoint]
     return timeline[timepoint], avg, stddev
 
+  def step_offsets(self, times: np.ndarray) -> np.ndarray:
+    # Vectorized __get_timepoint
+    start = np.datetime64(datetime.combine(self.starting_date, time()), 'h')
+    hours = (np.asarray(times, dtype='datetime64[h]') - start).astype(np.int64)
+    return np.floor_divide(hours * 3600, int(self.step.total_seconds()))
+
+  def step_indices(self, times: np.ndarray) -> np.ndarray:
+    # -1 for the times outside of the timeline
+    steps = self.step_offsets(times)
+    return np.where((steps >= 0) & (steps < self.duration), steps, -1)
+
+  def get_blood_levels(self, d: str, times: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    # Amounts, blood levels and their standard deviations at many times at once, NaN outside of the timeline.
+    # Needs the blood levels of get_plot_data(adjusted=True).
+    if d not in self.blood_levels:
+      return None
+    indices = self.step_indices(times)
+    return tuple(map(lambda values: np.where(indices >= 0, values[indices], np.nan), self.blood_levels[d]))
+
+  def get_running_average(self, d: str, times: np.ndarray, window: timedelta) \
+          -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    # Average and standard deviation of the blood level over the window ending at each of the times, from prefix
+    # sums built once per drug
+    if d not in self.blood_levels:
+      return None
+    if d not in self.level_sums:
+      levels = self.blood_levels[d][1]
+      self.level_sums[d] = (np.concatenate(([0.0], np.cumsum(levels))),
+                            np.concatenate(([0.0], np.cumsum(levels * levels))))
+    sums, sums_sq = self.level_sums[d]
+    width   = max(int(math.ceil(window.total_seconds() / self.step.total_seconds())), 1)
+    indices = self.step_indices(times)
+    high    = indices + 1
+    low     = np.maximum(high - width, 0)
+    count   = np.maximum(high - low, 1)
+    average = (sums[high] - sums[low]) / count
+    std_dev = np.sqrt(np.maximum((sums_sq[high] - sums_sq[low]) / count - average * average, 0.0))
+    return np.where(indices >= 0, average, np.nan), np.where(indices >= 0, std_dev, np.nan)
+
+  def timeline_pyramid(self, d: str) -> TimelinePyramid:
+    # Built on first use, extend_doses() updates it from the first step that changed
+    if d not in self.timeline_pyramids:
+      self.timeline_pyramids[d] = TimelinePyramid(self.drugs_timeline[d])
+    return self.timeline_pyramids[d]
+
+  def level_pyramid(self, d: str) -> Optional[TimelinePyramid]:
+    if d not in self.blood_levels:
+      return None
+    if d not in self.level_pyramids:
+      self.level_pyramids[d] = TimelinePyramid(self.blood_levels[d][1])
+    return self.level_pyramids[d]
+
+  def get_range_statistics(self, d: str, start: datetime, end: datetime, blood_level: bool = True) \
+          -> Optional[Tuple[float, float, float, float]]:
+    # Minimum, maximum, average and standard deviation of the blood level, or of the amount in the body, from
+    # start to end. None if there is no blood level for d or no step in between.
+    pyramid = self.level_pyramid(d) if blood_level else self.timeline_pyramid(d)
+    if pyramid is None:
+      return None
+    first, last = self.step_offsets(np.array([start, end], dtype='datetime64[us]'))
+    first, last = max(int(first), 0), min(int(last), self.duration - 1)
+    if last < first:
+      return None
+    return pyramid.statistics(first, last + 1)
+
   def get_current_blood_level_message(self, d: str,
                                       std_dev_count: int = 2,
                                       p_confidence: str = ".046") -> Optional[str]:
@@ -225,52 +379,44 @@ class BodyModel:
     return None
 
   def estimate_blood_levels(self, corrected_std_dev: bool = True):
+    self.corrected_std_dev = corrected_std_dev
+    self.factor_estimator = OnlineFactorEstimator(self.events)
+    self.blood_level_factors = {}
+    self.lab_levels = {}
     self.lab_events = {}
-    for lab_data in self.labs_list:
-      for d in lab_data.labs.keys():
-        self.lab_levels[d] = []
-        self.lab_events[d] = []
+    for lab_time, d, val in self.lab_table:
+      self.__estimate_lab(lab_time, d, val)
 
-    for lab_data in self.labs_list:
+  def add_lab_value(self, lab_data: LabData):
+    # Incremental version of estimate_blood_levels for a single new lab, after the timeline has been calculated
+    self.lab_table.add(lab_data.time, lab_data.labs)
+    if self.factor_estimator is not None:
       for d, val in lab_data.labs.items():
-        self.lab_levels[d].append((lab_data.time, val))
-        if len(self.events) > 0:
-          for x in range(len(self.events)+1):
-            self.lab_events[d].append([])
-          for n, event in enumerate(self.events):
-            if n == 0 and lab_data.time < datetime.combine(event[0], time()):
-              self.lab_events[d][0].append((lab_data.time, val))
-              break
-            if lab_data.time > datetime.combine(event[0], time()):
-              self.lab_events[d][n+1].append((lab_data.time, val))
-              break
-        else:
-          if len(self.lab_events[d]) == 0:
-            self.lab_events[d].append([])
-          self.lab_events[d][0].append((lab_data.time, val))
-
-    drugs = set(self.lab_levels.keys())
-    for d in drugs:
-      if d in self.lab_levels:
-        if d not in self.blood_level_factors:
-          self.blood_level_factors[d] = []
-          for _ in range(len(self.events) + 1):
-            self.blood_level_factors[d].append((0.0, 0.0))
-
-        for event_num in range(len(self.events)+1):
-          level_matcher = list(map(lambda x: (x[1], self.get_drug_at_timepoint(d, x[0])),
-                                   self.lab_events[d][event_num]))
-          estimates = list(map(lambda x: (x[0] / x[1]), level_matcher))
-          average_est = sum(map(lambda x: x / len(estimates), estimates))
-          levels = list(map(lambda x: (x[0], x[1] * average_est), level_matcher))
-          if len(estimates) > 1 and corrected_std_dev:
-            std_dev = math.sqrt(sum(map(lambda x: (x[0] - x[1])**2, levels)) / (len(levels)-1.5))
-            # std_dev = math.sqrt(sum(map(lambda x: (x - average_est)**2, estimates)) / (len(estimates)-1))
-          else:
-            std_dev = math.sqrt(sum(map(lambda x: (x[0] - x[1]) ** 2, levels)) / len(levels))
-            # std_dev = math.sqrt(sum(map(lambda x: (x - average_est)**2, estimates)) / len(estimates))
+        self.__estimate_lab(lab_data.time, d, val)
+
+  def __estimate_lab(self, lab_time: datetime, d: str, val: float):
+    if d not in self.lab_levels:
+      self.lab_levels[d] = []
+      self.lab_events[d] = [[] for _ in range(len(self.events) + 1)]
+    self.lab_levels[d].append((lab_time, val))
+    segment = self.factor_estimator.add(d, lab_time, self.get_drug_at_timepoint(d, lab_time), val)
+    self.lab_events[d][segment].append((lab_time, val))
+    self.blood_level_factors[d] = self.factor_estimator.factors(d, self.corrected_std_dev)
+
+  def get_tracked_factor(self, d: str, t: datetime) -> Optional[Tuple[float, float]]:
+    # Continuously tracked factor and its standard deviation, instead of the per event averages
+    if self.factor_estimator is None or d not in self.factor_estimator.trackers:
+      return None
+    state = self.factor_estimator.trackers[d].at(t)
+    if state is None:
+      return None
+    return state[0], math.sqrt(state[1])
 
-          self.blood_level_factors[d][event_num] = (average_est, std_dev)
+  def plot_name(self, drug: str) -> str:
+    drug_name = self.drugs[drug].name_blood
+    if self.drug_factors.get(drug, 1.0) != 1.0:
+      drug_name += f" (x{self.drug_factors[drug]})"
+    return drug_name
 
   def get_plot_data(self,
                     plot_delta: timedelta = timedelta(days=1),
@@ -278,7 +424,8 @@ class BodyModel:
                     stddev_multiplier: float = 1.0,
                     offset: float = 0.0,
                     color: bool = False,
-                    use_x_date: bool = False) -> \
+                    use_x_date: bool = False,
+                    parallel: bool = True) -> \
           Tuple[np.ndarray, Dict[str, plot_data_type]]:
     t_arr = take(self.duration,
                  map(lambda x: x * (self.step.total_seconds()/plot_delta.total_seconds()) + offset,
@@ -299,63 +446,29 @@ class BodyModel:
 
     self.running_average = {}
     self.running_stddev  = {}
+    self.blood_levels    = {}
+    self.level_sums      = {}
+    self.level_pyramids  = {}
 
     for n, drug in enumerate(drugs):
       # print(f"{n}: {drug}")
       timeline = self.drugs_timeline[drug]
-      drug_name = self.drugs[drug].name_blood
+      drug_name = self.plot_name(drug)
       # print(f"{steps}/{len(timeline)}")
 
-      if self.drugs[drug].factor != 1.0:
-        drug_name += f" (x{self.drugs[drug].factor})"
-
       if adjusted and drug in self.blood_level_factors and len(self.blood_level_factors[drug]) > 0:
-        # print(self.blood_level_factors)
-        factor_timeline = []
-        ev_num = 0
-        for t in range(len(timeline)):
-          t_time = datetime.combine(self.starting_date, time()) + t * self.step
-          if len(self.events) > 0:
-            if len(self.blood_level_factors[drug]) > ev_num + 1:
-              if datetime.combine(self.events[ev_num][0], time())+self.events[ev_num][1] > \
-                      t_time > datetime.combine(self.events[ev_num][0], time()):
-                factor: timedelta = t_time - datetime.combine(self.events[ev_num][0], time())
-                factor: float = factor / self.events[ev_num][1]
-                factor_timeline.append((self.blood_level_factors[drug][ev_num+1][0] * factor +
-                                        self.blood_level_factors[drug][ev_num][0] * (1-factor),
-                                        self.blood_level_factors[drug][ev_num+1][1] * factor +
-                                        self.blood_level_factors[drug][ev_num][1] * (1 - factor)
-                                        ))
-              elif datetime.combine(self.events[ev_num][0], time()) + self.events[ev_num][1] <= t_time:
-                ev_num += 1
-                factor_timeline.append(self.blood_level_factors[drug][ev_num])
-              else:
-                factor_timeline.append(self.blood_level_factors[drug][ev_num])
-            else:
-              factor_timeline.append(self.blood_level_factors[drug][ev_num])
-          else:
-            factor_timeline.append(self.blood_level_factors[drug][0])
+        factor_timeline, running_average, running_std_dev = self.__cached_statistics(drug, steps, parallel)
         self.factor_timeline[drug] = factor_timeline
 
-        list_avg     = lmap(lambda x: x[0] * x[1][0], zip(timeline, factor_timeline))
-        arr_avg = np.array(list_avg)
-        arr_min = np.array(lmap(
-              lambda x: x[0] * x[1][0] - x[1][1] * stddev_multiplier,
-              zip(timeline, factor_timeline)))
-        arr_max = np.array(lmap(
-              lambda x: x[0] * x[1][0] + x[1][1] * stddev_multiplier,
-              zip(timeline, factor_timeline)))
-
-        mp_ctx = mp.get_context('fork')
-        statistics_data: List[Tuple[Sequence[int], List[float], int]]
-        statistics_data = [(steps, list_avg, i) for i in range(3)]
-        with mp_ctx.Pool(3) as mp_pool:
-          statistics_results = mp_pool.map(calculate_running_statistics, statistics_data)
+        factors = np.asarray(factor_timeline, dtype=float)
+        amounts = np.asarray(timeline, dtype=float)
+        arr_avg = amounts * factors[:, 0]
+        self.blood_levels[drug] = (amounts, arr_avg, factors[:, 1])
+        arr_min = arr_avg - factors[:, 1] * stddev_multiplier
+        arr_max = arr_avg + factors[:, 1] * stddev_multiplier
 
-        running_average, running_std_dev = tuple(map(list, list(zip(*statistics_results))))
-
-        self.running_average[drug_name] = tuple(map(np.array, running_average))
-        self.running_stddev[drug_name]  = tuple(map(np.array, running_std_dev))
+        self.running_average[drug_name] = tuple(map(np.asarray, running_average))
+        self.running_stddev[drug_name]  = tuple(map(np.asarray, running_std_dev))
 
         if color:
           # print(f"{drug}: {n} => {get_color(n)}")
@@ -363,7 +476,7 @@ class BodyModel:
         else:
           out[drug_name] = (arr_avg, arr_min, arr_max)
       else:
-        arr = np.array(timeline) * self.drugs[drug].factor
+        arr = np.array(timeline) * self.drug_factors.get(drug, 1.0)
         if color:
           out[drug_name] = (arr, arr, arr, get_color(n))
         else:
@@ -371,6 +484,80 @@ class BodyModel:
       # print(f't_arr.size({drug.name})={len(out[drug.name])}')
     return t_arr, out
 
+  def __cached_statistics(self, drug: str, steps: Tuple[int, int, int], parallel: bool = True) \
+          -> Tuple[Sequence[Tuple[float, float]], Sequence[Sequence[float]], Sequence[Sequence[float]]]:
+    key = None
+    if self.result_cache is not None:
+      # Values are hashed as float arrays, they are numpy scalars when the timeline came from the cache
+      tracker = None
+      if self.track_factor and drug in self.factor_estimator.trackers:
+        tracker = (self.factor_estimator.trackers[drug].times,
+                   np.asarray(self.factor_estimator.trackers[drug].states, dtype=float).tobytes(),
+                   self.factor_estimator.trackers[drug].priors)
+      key = result_key('statistics', (np.asarray(self.drugs_timeline[drug], dtype=float).tobytes(),
+                                      np.asarray(self.blood_level_factors[drug], dtype=float).tobytes(),
+                                      self.events, self.starting_date, self.step, steps, tracker))
+      cached = self.result_cache.get(key)
+      if cached is not None:
+        return cached['factor_timeline'], cached['running_average'], cached['running_stddev']
+    factor_timeline, running_average, running_std_dev = self.__calculate_statistics(drug, steps, parallel)
+    if key is not None:
+      self.result_cache.put(key, {'factor_timeline':  np.array(factor_timeline, dtype=float),
+                                  'running_average':  np.array(running_average, dtype=float),
+                                  'running_stddev':   np.array(running_std_dev, dtype=float)})
+    return factor_timeline, running_average, running_std_dev
+
+  def __calculate_statistics(self, drug: str, steps: Tuple[int, int, int], parallel: bool = True) \
+          -> Tuple[List[Tuple[float, float]], List[List[float]], List[List[float]]]:
+    timeline = self.drugs_timeline[drug]
+
+    factor_timeline = []
+    ev_num = 0
+    for t in range(len(timeline)):
+      t_time = datetime.combine(self.starting_date, time()) + t * self.step
+      if len(self.events) > 0:
+        if len(self.blood_level_factors[drug]) > ev_num + 1:
+          if datetime.combine(self.events[ev_num][0], time())+self.events[ev_num][1] > \
+                  t_time > datetime.combine(self.events[ev_num][0], time()):
+            factor: timedelta = t_time - datetime.combine(self.events[ev_num][0], time())
+            factor: float = factor / self.events[ev_num][1]
+            factor_timeline.append((self.blood_level_factors[drug][ev_num+1][0] * factor +
+                                    self.blood_level_factors[drug][ev_num][0] * (1-factor),
+                                    self.blood_level_factors[drug][ev_num+1][1] * factor +
+                                    self.blood_level_factors[drug][ev_num][1] * (1 - factor)
+                                    ))
+          elif datetime.combine(self.events[ev_num][0], time()) + self.events[ev_num][1] <= t_time:
+            ev_num += 1
+            factor_timeline.append(self.blood_level_factors[drug][ev_num])
+          else:
+            factor_timeline.append(self.blood_level_factors[drug][ev_num])
+        else:
+          factor_timeline.append(self.blood_level_factors[drug][ev_num])
+      else:
+        factor_timeline.append(self.blood_level_factors[drug][0])
+    if self.track_factor and drug in self.factor_estimator.trackers:
+      start_day = datetime.combine(self.starting_date, time()).timestamp() / 86400.0
+      step_days = self.step.total_seconds() / 86400.0
+      factors, variances = self.factor_estimator.trackers[drug].state_array(start_day +
+                                                                            np.arange(len(timeline)) * step_days)
+      # The band is the uncertainty of the tracked factor, scaled to blood levels
+      std_devs = np.asarray(timeline, dtype=float) * np.sqrt(variances)
+      factor_timeline = list(zip(factors.tolist(), std_devs.tolist()))
+
+    list_avg = lmap(lambda x: x[0] * x[1][0], zip(timeline, factor_timeline))
+    statistics_data: List[Tuple[Sequence[int], List[float], int]]
+    statistics_data = [(steps, list_avg, i) for i in range(3)]
+    if parallel:
+      import multiprocessing as mp
+      mp_ctx = mp.get_context('fork')
+      with mp_ctx.Pool(3) as mp_pool:
+        statistics_results = mp_pool.map(calculate_running_statistics, statistics_data)
+    else:
+      statistics_results = lmap(calculate_running_statistics, statistics_data)
+
+    running_average, running_std_dev = tuple(map(list, list(zip(*statistics_results))))
+    return factor_timeline, running_average, running_std_dev
+
   def get_statistical_data(self, drug: str) -> Optional[Tuple[float, float]]:
     # print(list(self.blood_level_factors.keys()))
     # print(drug)
@@ -379,7 +566,8 @@ class BodyModel:
     blood_levels   = list(drop(7*24,
                                take(self.real_duration,
                                     map(lambda x: x[0] * x[1][0],
-                                        zip(self.drugs_timeline[drug], self.factor_timeline[drug])))))
+                                        zip(as_list(self.drugs_timeline[drug]),
+                                            as_list(self.factor_timeline[drug]))))))
     levels_avg     = sum(blood_levels) / len(blood_levels)
     sq_delta       = list(map(lambda x: (x - levels_avg)**2, blood_levels))
     levels_std_dev = math.sqrt(sum(sq_delta) / len(blood_levels))
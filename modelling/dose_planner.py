@@ -0,0 +1,136 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+from datetime import datetime, time, timedelta
+from typing import Tuple, Optional, Sequence
+
+import numpy as np
+
+from modelling.body_model import BodyModel
+from modelling.kernels import drug_response, metabolite_path, convolve
+
+
+class DosePlan(object):
+  drug:           str
+  amount:         float
+  interval:       timedelta
+  first_dose:     datetime
+  count:          int
+  in_band:        float
+  level_range:    Tuple[float, float]
+
+  def __init__(self, drug: str, amount: float, interval: timedelta, first_dose: datetime, count: int,
+               in_band: float, level_range: Tuple[float, float]):
+    self.drug         = drug
+    self.amount       = amount
+    self.interval     = interval
+    self.first_dose   = first_dose
+    self.count        = count
+    self.in_band      = in_band
+    self.level_range  = level_range
+
+  def yaml_interval(self) -> str:
+    # The largest unit the interval is a whole number of, so the repeat gives back the planned schedule
+    for unit, length in (('days', timedelta(days=1)), ('hours', timedelta(hours=1)), ('minutes', timedelta(minutes=1))):
+      if self.interval % length == timedelta(0):
+        return f"unit: {unit}, value: {self.interval // length}"
+    return f"unit: seconds, value: {self.interval.total_seconds():g}"
+
+  def yaml(self) -> str:
+    entry = f"    - {{ date: {self.first_dose.date().isoformat()}, time: \"{self.first_dose.time().isoformat()}\", " \
+            f"dose: {self.amount:g}"
+    if self.count > 1:
+      entry += f",\n        repeat: {{ count: {self.count - 1}, {self.yaml_interval()} }}"
+    return f"doses:\n  {self.drug}:\n{entry} }}"
+
+  def message(self) -> str:
+    return f"Best schedule: {self.amount:g}mg every {self.interval} starting {self.first_dose} " \
+           f"({self.count} doses), {self.in_band * 100:5.1f}% of the time in band, " \
+           f"predicted range {self.level_range[0]:6.2f} - {self.level_range[1]:6.2f}"
+
+
+def first_dose_time(now: datetime, hour: int) -> datetime:
+  first = datetime.combine(now.date(), time(hour=hour))
+  if first < now:
+    first += timedelta(days=1)
+  return first
+
+
+def plan_doses(model: BodyModel,
+               drug: str,
+               target: str,
+               band: Tuple[float, float],
+               amounts: Sequence[float],
+               intervals: Sequence[timedelta],
+               hour: int = 9,
+               now: Optional[datetime] = None) -> Optional[DosePlan]:
+  # Levels are linear in the doses, so every candidate is the already logged timeline plus a scaled,
+  # precomputed response to a dose train. All candidates are scored at once as (amounts x trains x steps).
+  if now is None:
+    now = datetime.now()
+  unknown = list(filter(lambda d: d not in model.drugs, (drug, target)))
+  if len(unknown) > 0:
+    print(f"WARNING: {', '.join(unknown)} not in the drugs of the model, cannot plan")
+    return None
+  path = metabolite_path(model.drugs, model.drugs_by_name, drug, target)
+  if path is None or target not in model.drugs_timeline:
+    print(f"WARNING: {model.drugs[drug].name} does not end up as {model.drugs[target].name}, cannot plan")
+    return None
+  start = datetime.combine(model.starting_date, time())
+  first = first_dose_time(now, hour)
+  now_step = int(math.ceil((now - start) / model.step))
+  first_step = int(math.ceil((first - start) / model.step))
+  horizon = model.duration - now_step
+  if horizon <= 0:
+    print("WARNING: days_into_future needs to be positive to plan doses")
+    return None
+
+  _, factor, _ = model.get_blood_level_at_timepoint(target, now)
+  baseline = np.asarray(model.drugs_timeline[target][now_step:model.duration], dtype=float) * factor
+  response = drug_response(model.drugs, model.drugs_by_name, path, model.step, horizon) * factor
+
+  trains = []
+  schedules = []
+  offset_step = timedelta(days=1)
+  for interval in intervals:
+    interval_steps = interval / model.step
+    offsets = range(max(1, int(interval / offset_step))) if interval >= offset_step else [0]
+    for offset in offsets:
+      dose_steps = np.arange(first_step - now_step + (offset * offset_step) / model.step, horizon, interval_steps)
+      dose_steps = np.ceil(dose_steps - 1e-9).astype(int)
+      dose_steps = dose_steps[dose_steps < horizon]
+      impulses = np.zeros(horizon)
+      np.add.at(impulses, dose_steps, 1.0)
+      trains.append(convolve(impulses, response, horizon))
+      schedules.append((interval, first + offset * offset_step, len(dose_steps)))
+
+  amounts_arr = np.asarray(amounts, dtype=float)
+  levels = baseline[np.newaxis, np.newaxis, :] + \
+    amounts_arr[:, np.newaxis, np.newaxis] * np.array(trains)[np.newaxis, :, :]
+  low, high = band
+  outside = np.maximum(low - levels, 0.0) + np.maximum(levels - high, 0.0)
+  cost = np.mean(outside ** 2, axis=2)
+  best_amount, best_train = np.unravel_index(int(np.argmin(cost)), cost.shape)
+  best_levels = levels[best_amount, best_train]
+  interval, first_dose, count = schedules[best_train]
+  return DosePlan(drug=drug,
+                  amount=float(amounts_arr[best_amount]),
+                  interval=interval,
+                  first_dose=first_dose,
+                  count=count,
+                  in_band=float(np.mean(outside[best_amount, best_train] == 0.0)),
+                  level_range=(float(best_levels.min()), float(best_levels.max())))
@@ -0,0 +1,111 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+# datetime64 array or anything np.datetime64 takes
+time_type = Union[np.ndarray, np.datetime64, datetime]
+
+
+def epoch_us(times: time_type) -> np.ndarray:
+  return np.asarray(times, dtype='datetime64[us]').astype(np.int64)
+
+
+class DoseTable(object):
+  # Doses of all drugs as columns sorted by time: the id of the drug in drugs, the time in microseconds since the
+  # epoch, the amount and whether it is a partial dose already, which is not spread by the flood in of the drug
+  # again. Rows of equal time keep the order they were appended in.
+  drugs:    List[str]
+  drug_ids: np.ndarray
+  times:    np.ndarray
+  amounts:  np.ndarray
+  subdose:  np.ndarray
+  indexes:  Dict[str, np.ndarray]
+
+  def __init__(self):
+    self.drugs    = []
+    self.drug_ids = np.zeros(0, dtype=np.int32)
+    self.times    = np.zeros(0, dtype=np.int64)
+    self.amounts  = np.zeros(0, dtype=float)
+    self.subdose  = np.zeros(0, dtype=bool)
+    self.indexes  = {}
+
+  @classmethod
+  def from_columns(cls, columns: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> 'DoseTable':
+    table = cls()
+    for drug, (times, amounts) in columns.items():
+      table.append(drug, times, amounts)
+    return table
+
+  def __len__(self) -> int:
+    return len(self.times)
+
+  def drug_id(self, drug: str) -> int:
+    if drug not in self.drugs:
+      self.drugs.append(drug)
+    return self.drugs.index(drug)
+
+  def append(self, drug: str, times: time_type, amounts: np.ndarray, subdose: bool = False) -> None:
+    # Drugs appended without any doses are still known, their timelines are all zero
+    drug_id = self.drug_id(drug)
+    times = np.atleast_1d(epoch_us(times))
+    if len(times) == 0:
+      return
+    self.drug_ids = np.concatenate((self.drug_ids, np.full(len(times), drug_id, dtype=np.int32)))
+    self.amounts  = np.concatenate((self.amounts, np.atleast_1d(np.asarray(amounts, dtype=float))))
+    self.subdose  = np.concatenate((self.subdose, np.full(len(times), subdose, dtype=bool)))
+    self.times    = np.concatenate((self.times, times))
+    if np.any(np.diff(self.times) < 0):
+      order = np.argsort(self.times, kind='stable')
+      self.drug_ids, self.times, self.amounts, self.subdose = \
+        self.drug_ids[order], self.times[order], self.amounts[order], self.subdose[order]
+    self.indexes = {}
+
+  def rows(self, drug: str, subdose: Optional[bool] = None) -> np.ndarray:
+    # Rows of the drug in time order, optionally only the partial doses or only the whole ones
+    if drug not in self.indexes:
+      drug_id = self.drugs.index(drug) if drug in self.drugs else -1
+      self.indexes[drug] = np.flatnonzero(self.drug_ids == drug_id)
+    rows = self.indexes[drug]
+    if subdose is None:
+      return rows
+    return rows[self.subdose[rows] == subdose]
+
+  def drug_doses(self, drug: str, subdose: Optional[bool] = None) -> Tuple[np.ndarray, np.ndarray]:
+    rows = self.rows(drug, subdose)
+    return self.times[rows].astype('datetime64[us]'), self.amounts[rows]
+
+  def between(self, start: Optional[time_type] = None, end: Optional[time_type] = None) -> 'DoseTable':
+    # Doses from start up to but not including end, sharing the ids of the drugs
+    first = 0 if start is None else int(np.searchsorted(self.times, epoch_us(start), side='left'))
+    last = len(self.times) if end is None else int(np.searchsorted(self.times, epoch_us(end), side='left'))
+    table = DoseTable()
+    table.drugs    = list(self.drugs)
+    table.drug_ids = self.drug_ids[first:last]
+    table.times    = self.times[first:last]
+    table.amounts  = self.amounts[first:last]
+    table.subdose  = self.subdose[first:last]
+    return table
+
+  def columns(self) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    return dict(map(lambda d: (d, self.drug_doses(d)), self.drugs))
+
+  def key(self) -> Tuple:
+    return (tuple(self.drugs), self.drug_ids.tobytes(), self.times.tobytes(), self.amounts.tobytes(),
+            self.subdose.tobytes())
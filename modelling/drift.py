@@ -0,0 +1,145 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from modelling.body_model import BodyModel
+from modelling.factor_estimator import FactorStatistics
+
+
+def _beta_continued_fraction(a: float, b: float, x: float) -> float:
+  tiny = 1e-300
+  c = 1.0
+  d = 1.0 - (a + b) * x / (a + 1.0)
+  d = 1.0 / (d if abs(d) > tiny else tiny)
+  h = d
+  for m in range(1, 200):
+    for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                      -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+      d = 1.0 + numerator * d
+      d = 1.0 / (d if abs(d) > tiny else tiny)
+      c = 1.0 + numerator / c
+      c = c if abs(c) > tiny else tiny
+      h *= d * c
+    if abs(d * c - 1.0) < 1e-12:
+      break
+  return h
+
+
+def incomplete_beta(a: float, b: float, x: float) -> float:
+  if x <= 0.0:
+    return 0.0
+  if x >= 1.0:
+    return 1.0
+  front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log(1.0 - x))
+  if x < (a + 1.0) / (a + b + 2.0):
+    return front * _beta_continued_fraction(a, b, x) / a
+  return 1.0 - front * _beta_continued_fraction(b, a, 1.0 - x) / b
+
+
+def welch_test(left: FactorStatistics, right: FactorStatistics) -> Tuple[float, float]:
+  # Two sided Welch t-test on the lab/amount ratios of two windows, returns (t, p)
+  var_left = left.ratio_variance() / left.count
+  var_right = right.ratio_variance() / right.count
+  spread = var_left + var_right
+  difference = right.factor() - left.factor()
+  if spread <= 0.0:
+    return (math.inf, 0.0) if difference != 0.0 else (0.0, 1.0)
+  t = difference / math.sqrt(spread)
+  df = spread ** 2 / (var_left ** 2 / max(left.count - 1, 1) + var_right ** 2 / max(right.count - 1, 1))
+  return t, incomplete_beta(df / 2.0, 0.5, df / (df + t * t))
+
+
+class ChangePoint(object):
+  before:         datetime
+  after:          datetime
+  factor_before:  float
+  factor_after:   float
+  residual:       Tuple[float, float]
+  t:              float
+  p:              float
+
+  def __init__(self, before: datetime, after: datetime, factor_before: float, factor_after: float,
+               residual: Tuple[float, float], t: float, p: float):
+    self.before         = before
+    self.after          = after
+    self.factor_before  = factor_before
+    self.factor_after   = factor_after
+    self.residual       = residual
+    self.t              = t
+    self.p              = p
+
+  def event_yaml(self) -> str:
+    # Suggested event: starting halfway between the two labs, transitioning over the gap between them
+    gap = self.after - self.before
+    start = self.before + gap / 2
+    days = max(1, int(round(gap / timedelta(days=1))))
+    return f"    - {{ start: {start.date().isoformat()}, transition: {{ unit: days, value: {days} }} }}"
+
+  def message(self) -> str:
+    return f"Metabolism shift between {self.before.date()} and {self.after.date()}: " \
+           f"factor {self.factor_before:8.1f} -> {self.factor_after:8.1f} " \
+           f"(residuals ± {self.residual[0]:6.2f} / ± {self.residual[1]:6.2f} ng/l, t={self.t:5.2f}, p={self.p:.4f})"
+
+
+def detect_drift(model: BodyModel, drug: str, window: int = 4, alpha: float = 0.05) -> List[ChangePoint]:
+  # Compares the window of labs before each lab with the window starting at it. Moving the split by one lab
+  # moves one lab from the right window into the left one and adds/removes one at the ends, so the whole
+  # scan is linear in the number of labs.
+  if drug not in model.lab_levels:
+    return []
+  labs = sorted(model.lab_levels[drug], key=lambda x: x[0])
+  if len(labs) < 2 * window or window < 2:
+    return []
+  amounts = list(map(lambda x: model.get_drug_at_timepoint(drug, x[0]), labs))
+  left = FactorStatistics()
+  right = FactorStatistics()
+  for n in range(window):
+    left.add(amounts[n], labs[n][1])
+    right.add(amounts[n + window], labs[n + window][1])
+
+  tests = []
+  for split in range(window, len(labs) - window + 1):
+    if split > window:
+      left.remove(amounts[split - window - 1], labs[split - window - 1][1])
+      left.add(amounts[split - 1], labs[split - 1][1])
+      right.remove(amounts[split - 1], labs[split - 1][1])
+      right.add(amounts[split + window - 1], labs[split + window - 1][1])
+    t, p = welch_test(left, right)
+    tests.append((split, t, p, left.factor(), right.factor(),
+                  (left.std_dev(model.corrected_std_dev), right.std_dev(model.corrected_std_dev))))
+
+  # Holm correction over all splits tested, p of the candidates is the adjusted one
+  candidates = []
+  adjusted = 0.0
+  for k, test in enumerate(sorted(tests, key=lambda c: c[2])):
+    adjusted = max(adjusted, min(1.0, (len(tests) - k) * test[2]))
+    if adjusted >= alpha:
+      break
+    candidates.append(test[:2] + (adjusted,) + test[3:])
+
+  # Neighbouring splits see mostly the same labs, only keep the most significant one within a window
+  change_points = []
+  for candidate in sorted(candidates, key=lambda c: c[2]):
+    split, t, p, factor_before, factor_after, residual = candidate
+    if any(map(lambda c: abs(c[0] - split) < window, change_points)):
+      continue
+    change_points.append(candidate)
+  change_points.sort(key=lambda c: c[0])
+  return list(map(lambda c: ChangePoint(labs[c[0] - 1][0], labs[c[0]][0], c[3], c[4], c[5], c[1], c[2]),
+                  change_points))
@@ -0,0 +1,131 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import zipfile
+from datetime import datetime, time
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+from modelling.body_model import BodyModel
+
+EXPORT_CHUNK_ROWS = 65536
+
+# (name, dtype, rows lo:hi of the column)
+column_type = Tuple[str, np.dtype, Callable[[int, int], np.ndarray]]
+
+
+def column_name(name: str) -> str:
+  return re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_").lower()
+
+
+def export_columns(model: BodyModel, stddev_multiplier: float = 1.0) -> List[column_type]:
+  # Every column is computed chunk by chunk from the timelines of the model, so no full size copies are made
+  start = np.datetime64(datetime.combine(model.starting_date, time()), 's')
+  step = np.timedelta64(int(model.step.total_seconds()), 's')
+  columns = [('time', np.dtype('datetime64[s]'), lambda lo, hi: start + step * np.arange(lo, hi))]
+  for drug in sorted(model.drugs_timeline.keys(), key=lambda d: model.drugs[d].name):
+    name = column_name(model.drugs[drug].name)
+    timeline = model.drugs_timeline[drug]
+    columns.append((f"{name}_amount", np.dtype(float),
+                    lambda lo, hi, timeline=timeline: np.asarray(timeline[lo:hi], dtype=float)))
+    if drug not in model.factor_timeline:
+      continue
+    name_blood = column_name(model.drugs[drug].name_blood)
+    factors = model.factor_timeline[drug]
+
+    def level(lo: int, hi: int, timeline=timeline, factors=factors, side: float = 0.0) -> np.ndarray:
+      factor = np.asarray(factors[lo:hi], dtype=float)
+      return np.asarray(timeline[lo:hi], dtype=float) * factor[:, 0] + side * factor[:, 1] * stddev_multiplier
+    columns.append((f"{name_blood}_level", np.dtype(float), level))
+    columns.append((f"{name_blood}_min", np.dtype(float), lambda lo, hi, level=level: level(lo, hi, side=-1.0)))
+    columns.append((f"{name_blood}_max", np.dtype(float), lambda lo, hi, level=level: level(lo, hi, side=1.0)))
+    plot_name = model.plot_name(drug)
+    if plot_name in model.running_average:
+      for n, days in enumerate(model.step_days):
+        for kind, statistics in (('avg', model.running_average), ('std', model.running_stddev)):
+          columns.append((f"{name_blood}_{kind}_{days}d", np.dtype(float),
+                          lambda lo, hi, values=statistics[plot_name][n]: np.asarray(values[lo:hi], dtype=float)))
+  return columns
+
+
+def chunks(rows: int, chunk_rows: int):
+  return map(lambda lo: (lo, min(lo + chunk_rows, rows)), range(0, rows, chunk_rows))
+
+
+def write_npz(path: Path, columns: List[column_type], rows: int, chunk_rows: int) -> None:
+  # One .npy member per column, streamed into the compressed archive, readable with np.load()
+  with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+    for name, dtype, column in columns:
+      with archive.open(f"{name}.npy", 'w', force_zip64=True) as member:
+        np.lib.format.write_array_header_1_0(member, {'descr':          np.lib.format.dtype_to_descr(dtype),
+                                                      'fortran_order':  False,
+                                                      'shape':          (rows,)})
+        for lo, hi in chunks(rows, chunk_rows):
+          member.write(np.ascontiguousarray(column(lo, hi), dtype=dtype).tobytes())
+
+
+def write_parquet(path: Path, columns: List[column_type], rows: int, chunk_rows: int) -> None:
+  writer = None
+  try:
+    for lo, hi in chunks(rows, chunk_rows):
+      table = pyarrow.table(dict(map(lambda c: (c[0], c[2](lo, hi)), columns)))
+      if writer is None:
+        writer = pyarrow.parquet.ParquetWriter(str(path), table.schema, compression='zstd')
+      writer.write_table(table)
+  finally:
+    if writer is not None:
+      writer.close()
+
+
+def write_csv(path: Path, columns: List[column_type], rows: int, chunk_rows: int) -> None:
+  with path.open('w') as csv_file:
+    csv_file.write(",".join(map(lambda c: c[0], columns)) + "\n")
+    for lo, hi in chunks(rows, chunk_rows):
+      fields = []
+      for _, dtype, column in columns:
+        values = column(lo, hi)
+        if np.issubdtype(dtype, np.datetime64):
+          fields.append(np.datetime_as_string(values, unit='s'))
+        else:
+          fields.append(np.char.mod("%.9g", values))
+      csv_file.write("\n".join(map(",".join, zip(*fields))) + "\n")
+
+
+def export_timelines(model: BodyModel, path: Path, stddev_multiplier: float = 1.0,
+                     chunk_rows: int = EXPORT_CHUNK_ROWS) -> Path:
+  # The format follows the suffix, .parquet needs pyarrow and falls back to CSV without it
+  columns = export_columns(model, stddev_multiplier)
+  suffix = path.suffix.lower()
+  if suffix == '.parquet' and pyarrow is None:
+    path = path.with_suffix('.csv')
+    print(f"WARNING: pyarrow is not installed, exporting to {path} instead")
+    suffix = '.csv'
+  if suffix == '.npz':
+    write_npz(path, columns, model.duration, chunk_rows)
+  elif suffix == '.parquet':
+    write_parquet(path, columns, model.duration, chunk_rows)
+  else:
+    write_csv(path, columns, model.duration, chunk_rows)
+  return path
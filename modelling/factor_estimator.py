@@ -0,0 +1,212 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+from bisect import bisect_right
+from datetime import datetime, date, time, timedelta
+from typing import List, Dict, Tuple, Optional, Sequence
+
+import numpy as np
+
+
+class FactorStatistics(object):
+  # Sufficient statistics for the blood level factor of a set of labs: the factor is the average ratio of lab
+  # value and drug amount, the standard deviation is taken from the residuals of the scaled amounts.
+  count:          int
+  sum_ratio:      float
+  sum_ratio_sq:   float
+  sum_lab_sq:     float
+  sum_lab_amount: float
+  sum_amount_sq:  float
+
+  def __init__(self):
+    self.count          = 0
+    self.sum_ratio      = 0.0
+    self.sum_ratio_sq   = 0.0
+    self.sum_lab_sq     = 0.0
+    self.sum_lab_amount = 0.0
+    self.sum_amount_sq  = 0.0
+
+  def add(self, amount: float, lab: float, weight: int = 1):
+    self.count          += weight
+    self.sum_ratio      += weight * lab / amount
+    self.sum_ratio_sq   += weight * (lab / amount) ** 2
+    self.sum_lab_sq     += weight * lab * lab
+    self.sum_lab_amount += weight * lab * amount
+    self.sum_amount_sq  += weight * amount * amount
+
+  def remove(self, amount: float, lab: float):
+    self.add(amount, lab, -1)
+
+  def factor(self) -> float:
+    if self.count <= 0:
+      return 0.0
+    return self.sum_ratio / self.count
+
+  def ratio_variance(self) -> float:
+    if self.count <= 1:
+      return 0.0
+    return max(self.sum_ratio_sq - self.sum_ratio ** 2 / self.count, 0.0) / (self.count - 1)
+
+  def residual_sum(self) -> float:
+    factor = self.factor()
+    return max(self.sum_lab_sq - 2 * factor * self.sum_lab_amount + factor * factor * self.sum_amount_sq, 0.0)
+
+  def std_dev(self, corrected: bool = True) -> float:
+    if self.count <= 0:
+      return 0.0
+    if self.count > 1 and corrected:
+      return math.sqrt(self.residual_sum() / (self.count - 1.5))
+    return math.sqrt(self.residual_sum() / self.count)
+
+
+class FactorKalman(object):
+  # Random walk Kalman filter on the factor: the factor may drift by process_noise (relative, per day) between
+  # labs, every lab measures lab/amount with a relative error of measurement_noise. Between labs the state is
+  # taken from the Rauch-Tung-Striebel smoothed states of the labs around it, after the last lab it is the
+  # filtered state with its variance growing by the process noise.
+  process_noise:      float
+  measurement_noise:  float
+  times:              List[datetime]
+  states:             List[Tuple[float, float]]
+  priors:             List[float]
+  smoothed_states:    Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]]
+
+  def __init__(self, process_noise: float = 0.01, measurement_noise: float = 0.15):
+    self.process_noise      = process_noise
+    self.measurement_noise  = measurement_noise
+    self.times              = []
+    self.states             = []
+    self.priors             = []
+    self.smoothed_states    = None
+
+  def predict(self, t: datetime, extra_variance: float = 0.0) -> Optional[Tuple[float, float]]:
+    if len(self.times) == 0:
+      return None
+    factor, variance = self.states[-1]
+    days = max((t - self.times[-1]).total_seconds() / 86400.0, 0.0)
+    return factor, variance + (self.process_noise * factor) ** 2 * days + extra_variance * factor ** 2
+
+  def update(self, t: datetime, amount: float, lab: float, extra_variance: float = 0.0) -> Tuple[float, float]:
+    measured = lab / amount
+    noise = (self.measurement_noise * measured) ** 2
+    predicted = self.predict(t, extra_variance)
+    if predicted is None:
+      state = (measured, noise)
+      prior = math.inf
+    else:
+      factor, prior = predicted
+      gain = prior / (prior + noise)
+      state = (factor + gain * (measured - factor), (1.0 - gain) * prior)
+    self.times.append(t)
+    self.states.append(state)
+    self.priors.append(prior)
+    self.smoothed_states = None
+    return state
+
+  def smoothed(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # (times, filtered factors, filtered variances, smoothed factors, smoothed variances) of the labs
+    if self.smoothed_states is None:
+      factors = np.array(list(map(lambda s: s[0], self.states)), dtype=float)
+      variances = np.array(list(map(lambda s: s[1], self.states)), dtype=float)
+      smoothed_factors = factors.copy()
+      smoothed_variances = variances.copy()
+      for n in range(len(self.states) - 2, -1, -1):
+        gain = variances[n] / self.priors[n + 1] if self.priors[n + 1] > 0.0 else 1.0
+        smoothed_factors[n] = factors[n] + gain * (smoothed_factors[n + 1] - factors[n])
+        smoothed_variances[n] = variances[n] + gain ** 2 * (smoothed_variances[n + 1] - self.priors[n + 1])
+      self.smoothed_states = (self.time_array(), factors, variances, smoothed_factors, smoothed_variances)
+    return self.smoothed_states
+
+  def state_array(self, t: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Factors and their variances at t, in days since the epoch of time_array(). The variance added between two
+    # labs, including the jump allowed at an event, is spread evenly over the gap.
+    times, factors, variances, smoothed_factors, smoothed_variances = self.smoothed()
+    t = np.asarray(t, dtype=float)
+    index = np.clip(np.searchsorted(times, t, side='right') - 1, 0, len(times) - 1)
+    following = np.minimum(index + 1, len(times) - 1)
+    priors = np.array(self.priors + [math.inf], dtype=float)[index + 1]
+    gaps = times[following] - times[index]
+    elapsed = np.maximum(t - times[index], 0.0)
+    between = (index < len(times) - 1) & (t >= times[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+      rate = np.where(between & (gaps > 0.0), (priors - variances[index]) / gaps, 0.0)
+      predicted = variances[index] + rate * elapsed
+      gain = np.where(between & (priors > 0.0), predicted / priors, 1.0)
+      out_factors = np.where(between, factors[index] + gain * (smoothed_factors[following] - factors[index]),
+                             smoothed_factors[index])
+      out_variances = np.where(between, predicted + gain ** 2 * (smoothed_variances[following] - priors),
+                               smoothed_variances[index])
+    # After the last lab only the process noise is added
+    after = t >= times[-1]
+    growth = (self.process_noise * factors[-1]) ** 2 * np.maximum(t - times[-1], 0.0)
+    out_variances = np.where(after, variances[-1] + growth, out_variances)
+    return out_factors, out_variances
+
+  def at(self, t: datetime) -> Optional[Tuple[float, float]]:
+    if len(self.times) == 0:
+      return None
+    factors, variances = self.state_array(np.array([t.timestamp() / 86400.0]))
+    return float(factors[0]), float(variances[0])
+
+  def time_array(self) -> np.ndarray:
+    return np.array(list(map(lambda x: x.timestamp() / 86400.0, self.times)))
+
+
+class OnlineFactorEstimator(object):
+  events:         List[datetime]
+  event_noise:    float
+  segments:       Dict[str, List[FactorStatistics]]
+  trackers:       Dict[str, FactorKalman]
+
+  def __init__(self, events: Sequence[Tuple[date, timedelta]], event_noise: float = 0.25):
+    self.events       = sorted(map(lambda e: datetime.combine(e[0], time()), events))
+    self.event_noise  = event_noise
+    self.segments     = {}
+    self.trackers     = {}
+
+  def segment_of(self, t: datetime) -> int:
+    return bisect_right(self.events, t)
+
+  def add(self, drug: str, t: datetime, amount: float, lab: float) -> int:
+    if drug not in self.segments:
+      self.segments[drug] = [FactorStatistics() for _ in range(len(self.events) + 1)]
+      self.trackers[drug] = FactorKalman()
+    segment = self.segment_of(t)
+    self.segments[drug][segment].add(amount, lab)
+    tracker = self.trackers[drug]
+    if len(tracker.times) > 0 and t < tracker.times[-1]:
+      print(f"WARNING: lab at {t} is older than the last one, only used for the per event factors")
+    else:
+      # A declared event is a known change in metabolism, so the factor is allowed to jump there
+      extra_variance = 0.0
+      if len(tracker.times) > 0 and self.segment_of(tracker.times[-1]) != segment:
+        extra_variance = self.event_noise ** 2
+      tracker.update(t, amount, lab, extra_variance)
+    return segment
+
+  def factors(self, drug: str, corrected_std_dev: bool = True) -> List[Tuple[float, float]]:
+    # Segments without labs take the factor of the closest segment before them (or after, for the first ones)
+    out: List[Optional[Tuple[float, float]]] = []
+    for statistics in self.segments[drug]:
+      if statistics.count > 0:
+        out.append((statistics.factor(), statistics.std_dev(corrected_std_dev)))
+      elif len(out) > 0:
+        out.append(out[-1])
+      else:
+        out.append(None)
+    first = next(filter(lambda x: x is not None, out), (0.0, 0.0))
+    return list(map(lambda x: first if x is None else x, out))
@@ -0,0 +1,265 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import math
+from bisect import bisect_right
+from datetime import datetime, date, time, timedelta
+from typing import Tuple, Dict, Optional, Sequence
+
+import numpy as np
+
+from drugs.drug import Drug
+from modelling.kernels import response_chain_type, parametric_response, drug_chain, drug_response, \
+  flood_in_profile, metabolite_path, to_steps
+
+
+def to_step_index(t: datetime, start: datetime, step: timedelta, rounding=math.ceil) -> int:
+  return int(rounding((t - start).total_seconds() / step.total_seconds()))
+
+
+class ResponseEvaluator(object):
+  # Predicts lab values from the response of the measured drug to a unit dose of the dosed drug. All the
+  # bookkeeping (which dose lies how far before which lab) is done once, so that evaluating a new response
+  # is a single gather and a few reductions over (labs x doses).
+  lab_values:         np.ndarray
+  background:         np.ndarray
+  segments:           np.ndarray
+  segment_count:      int
+  lag_index:          np.ndarray
+  dose_amounts:       np.ndarray
+  max_length:         int
+  metabolite_chain:   response_chain_type
+
+  def __init__(self,
+               dose_steps:       np.ndarray,
+               dose_amounts:     np.ndarray,
+               lab_steps:        np.ndarray,
+               lab_values:       np.ndarray,
+               segments:         np.ndarray,
+               metabolite_chain: response_chain_type,
+               background:       Optional[np.ndarray] = None):
+    self.lab_values       = lab_values
+    self.segments         = segments
+    self.segment_count    = int(segments.max()) + 1 if len(segments) > 0 else 1
+    self.dose_amounts     = dose_amounts
+    self.metabolite_chain = metabolite_chain
+    self.background       = np.zeros(len(lab_values)) if background is None else background
+    lags = lab_steps[:, np.newaxis] - dose_steps[np.newaxis, :]
+    self.max_length = max(1, int(lags.max()) + 1) if lags.size > 0 else 1
+    # Lags before the dose point at the zero padding behind the end of the response
+    self.lag_index  = np.where(lags >= 0, lags, self.max_length)
+
+  def predict_amounts(self, response: np.ndarray) -> np.ndarray:
+    padded = np.zeros(self.max_length + 1)
+    length = min(len(response), self.max_length)
+    padded[:length] = response[:length]
+    return padded[self.lag_index] @ self.dose_amounts + self.background
+
+  def errors(self, response: np.ndarray) -> np.ndarray:
+    # Same factor estimate as BodyModel.estimate_blood_levels: average ratio of lab value and amount per event
+    amounts = self.predict_amounts(response)
+    if np.any(amounts <= 0.0):
+      return np.full(len(amounts), np.inf)
+    ratios = self.lab_values / amounts
+    factors = np.bincount(self.segments, ratios, self.segment_count) / \
+      np.maximum(np.bincount(self.segments, minlength=self.segment_count), 1)
+    return (self.lab_values - amounts * factors[self.segments]) / self.lab_values * 100
+
+  def error(self, response: np.ndarray) -> float:
+    return float(np.sqrt(np.mean(self.errors(response) ** 2)))
+
+  def parametric_error(self, parameters: Sequence[float]) -> float:
+    half_life, peak, shape = parameters
+    return self.error(parametric_response(round(half_life, 6), round(peak, 6), round(shape, 6),
+                                          self.metabolite_chain, self.max_length))
+
+
+class FitResult(object):
+  parent:             str
+  drug:               str
+  half_life:          Tuple[timedelta, timedelta]
+  absorption_peak:    Tuple[timedelta, timedelta]
+  absorption_shape:   float
+  error:              Tuple[float, float]
+
+  def __init__(self, parent: str, drug: str,
+               half_life: Tuple[timedelta, timedelta],
+               absorption_peak: Tuple[timedelta, timedelta],
+               absorption_shape: float,
+               error: Tuple[float, float]):
+    self.parent           = parent
+    self.drug             = drug
+    self.half_life        = half_life
+    self.absorption_peak  = absorption_peak
+    self.absorption_shape = absorption_shape
+    self.error            = error
+
+  def message(self) -> str:
+    return f"Fitted {self.parent} against {self.drug} labs:\n" \
+           f"  half-life:         {self.half_life[0]} -> {self.half_life[1]}\n" \
+           f"  absorption peak:   {self.absorption_peak[0]} -> {self.absorption_peak[1]}" \
+           f" (gamma shape {self.absorption_shape:.2f})\n" \
+           f"  prediction error:  {self.error[0]:6.2f}% -> {self.error[1]:6.2f}% RMS"
+
+
+def nelder_mead(f, x0: np.ndarray, lower: np.ndarray, upper: np.ndarray,
+                max_iterations: int = 400, tolerance: float = 1e-6) -> Tuple[np.ndarray, float]:
+  def clipped(x: np.ndarray) -> float:
+    return f(np.clip(x, lower, upper))
+
+  n = len(x0)
+  simplex = [np.clip(x0, lower, upper)]
+  for i in range(n):
+    x = simplex[0].copy()
+    x[i] += 0.1 * (upper[i] - lower[i])
+    if x[i] > upper[i]:
+      x[i] -= 0.2 * (upper[i] - lower[i])
+    simplex.append(x)
+  values = [clipped(x) for x in simplex]
+  for _ in range(max_iterations):
+    order = np.argsort(values)
+    simplex = [simplex[i] for i in order]
+    values = [values[i] for i in order]
+    if abs(values[-1] - values[0]) < tolerance:
+      break
+    centroid = np.mean(simplex[:-1], axis=0)
+    reflected = centroid + (centroid - simplex[-1])
+    f_reflected = clipped(reflected)
+    if f_reflected < values[0]:
+      expanded = centroid + 2.0 * (centroid - simplex[-1])
+      f_expanded = clipped(expanded)
+      if f_expanded < f_reflected:
+        simplex[-1], values[-1] = expanded, f_expanded
+      else:
+        simplex[-1], values[-1] = reflected, f_reflected
+    elif f_reflected < values[-2]:
+      simplex[-1], values[-1] = reflected, f_reflected
+    else:
+      contracted = centroid + 0.5 * (simplex[-1] - centroid)
+      f_contracted = clipped(contracted)
+      if f_contracted < values[-1]:
+        simplex[-1], values[-1] = contracted, f_contracted
+      else:
+        for i in range(1, n + 1):
+          simplex[i] = simplex[0] + 0.5 * (simplex[i] - simplex[0])
+          values[i] = clipped(simplex[i])
+  best = int(np.argmin(values))
+  return np.clip(simplex[best], lower, upper), values[best]
+
+
+_worker_evaluator: Optional[ResponseEvaluator] = None
+
+
+def _set_worker_evaluator(evaluator: ResponseEvaluator) -> None:
+  global _worker_evaluator
+  _worker_evaluator = evaluator
+
+
+def _local_search(search: Tuple[np.ndarray, np.ndarray, np.ndarray]) -> Tuple[np.ndarray, float]:
+  start, lower, upper = search
+  evaluator = _worker_evaluator
+
+  def objective(log_parameters: np.ndarray) -> float:
+    return evaluator.parametric_error(np.exp(log_parameters))
+
+  return nelder_mead(objective, start, lower, upper)
+
+
+# Parameters are searched in log space, as (half-life, absorption peak, absorption shape) in model steps
+def multi_start_search(evaluator: ResponseEvaluator,
+                       initial: np.ndarray,
+                       lower: np.ndarray,
+                       upper: np.ndarray,
+                       starts: int = 16,
+                       processes: Optional[int] = None,
+                       seed: int = 0) -> Tuple[np.ndarray, float]:
+  log_lower, log_upper = np.log(lower), np.log(upper)
+  rng = np.random.default_rng(seed)
+  start_points = [np.log(initial)] + list(rng.uniform(log_lower, log_upper, (max(starts - 1, 0), len(initial))))
+  with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                              initializer=_set_worker_evaluator,
+                                              initargs=(evaluator,)) as pool:
+    results = list(pool.map(_local_search, map(lambda s: (s, log_lower, log_upper), start_points)))
+  best_parameters, best_error = min(results, key=lambda r: r[1])
+  return np.exp(best_parameters), best_error
+
+
+def round_to_minutes(td: timedelta) -> timedelta:
+  return timedelta(minutes=round(td.total_seconds() / 60.0))
+
+
+def dose_arrays(doses: Tuple[np.ndarray, np.ndarray], start: datetime, step: timedelta) \
+        -> Tuple[np.ndarray, np.ndarray]:
+  times, amounts = doses
+  offsets = (times.astype('datetime64[us]') - np.datetime64(start, 'us')).astype(np.int64)
+  steps = np.ceil(offsets / (step / timedelta(microseconds=1))).astype(np.int64)
+  return steps, np.asarray(amounts, dtype=float)
+
+
+def fit_drug_parameters(drugs: Dict[str, Drug],
+                        drugs_by_name: Dict[str, str],
+                        doses: Dict[str, Tuple[np.ndarray, np.ndarray]],
+                        labs: Sequence[Tuple[datetime, float]],
+                        events: Sequence[date],
+                        starting_date: date,
+                        step: timedelta,
+                        parent: str,
+                        drug: str,
+                        starts: int = 16,
+                        processes: Optional[int] = None) -> Optional[FitResult]:
+  start = datetime.combine(starting_date, time())
+  path = metabolite_path(drugs, drugs_by_name, parent, drug)
+  if path is None or len(labs) == 0 or parent not in doses:
+    return None
+  event_times = sorted(map(lambda e: datetime.combine(e, time()), events))
+  lab_steps = np.array(list(map(lambda lab: to_step_index(datetime(lab[0].year, lab[0].month, lab[0].day,
+                                                                   lab[0].hour),
+                                                          start, step, math.floor), labs)), dtype=np.int64)
+  lab_values = np.array(list(map(lambda lab: lab[1], labs)), dtype=float)
+  segments = np.array(list(map(lambda lab: bisect_right(event_times, lab[0]), labs)), dtype=np.int64)
+  chain = drug_chain(drugs, drugs_by_name, path, step)
+
+  # Other dosed drugs that end up as the measured one keep their parameters and are a fixed background
+  background = np.zeros(len(labs))
+  for other, other_doses in doses.items():
+    other_path = metabolite_path(drugs, drugs_by_name, other, drug)
+    if other == parent or other_path is None or len(other_doses[0]) == 0:
+      continue
+    other_steps, other_amounts = dose_arrays(other_doses, start, step)
+    other_evaluator = ResponseEvaluator(other_steps, other_amounts, lab_steps, lab_values, segments, ())
+    background += other_evaluator.predict_amounts(drug_response(drugs, drugs_by_name, other_path, step,
+                                                                other_evaluator.max_length))
+
+  dose_steps, dose_amounts = dose_arrays(doses[parent], start, step)
+  evaluator = ResponseEvaluator(dose_steps, dose_amounts, lab_steps, lab_values, segments, chain[1:], background)
+  error_before = evaluator.error(drug_response(drugs, drugs_by_name, path, step, evaluator.max_length))
+
+  half_life = chain[0][0]
+  profile = flood_in_profile(drugs[parent], step)
+  peak = max(float(np.argmax(profile)) + 0.5, 0.5)
+  initial = np.array([half_life, peak, 3.0])
+  lower = np.array([half_life / 4.0, 0.25, 1.1])
+  upper = np.array([half_life * 4.0, max(peak * 8.0, to_steps(timedelta(days=2), step)), 40.0])
+  parameters, error_after = multi_start_search(evaluator, np.clip(initial, lower, upper), lower, upper,
+                                               starts, processes)
+  fitted_half_life, fitted_peak, fitted_shape = parameters
+  return FitResult(parent=drugs[parent].name,
+                   drug=drugs[drug].name_blood,
+                   half_life=(drugs[parent].half_life, round_to_minutes(step * float(fitted_half_life))),
+                   absorption_peak=(round_to_minutes(step * peak), round_to_minutes(step * float(fitted_peak))),
+                   absorption_shape=float(fitted_shape),
+                   error=(error_before, error_after))
@@ -0,0 +1,154 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+from datetime import timedelta
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from drugs.drug import Drug, decay_factor
+
+
+# Number of half-lives after which a response is considered to have decayed completely (2**-24 < 1e-7)
+DECAY_HALF_LIVES = 24
+
+# Chain of (half-life in steps, fraction passed on from the previous drug) from the dosed drug to the
+# measured one; the first entry's fraction is always 1.0
+response_chain_type = Tuple[Tuple[float, float], ...]
+
+
+def to_steps(td: timedelta, step: timedelta) -> float:
+  return td.total_seconds() / step.total_seconds()
+
+
+@lru_cache(maxsize=256)
+def decay_curve(half_life_steps: float, length: int) -> np.ndarray:
+  curve = 2.0 ** (-np.arange(length, dtype=float) / half_life_steps)
+  curve.flags.writeable = False
+  return curve
+
+
+def convolve(signal: np.ndarray, kernel: np.ndarray, length: int) -> np.ndarray:
+  if min(len(signal), len(kernel)) < 64:
+    return np.convolve(signal, kernel)[:length]
+  size = 1 << (len(signal) + len(kernel) - 1).bit_length()
+  return np.fft.irfft(np.fft.rfft(signal, size) * np.fft.rfft(kernel, size), size)[:length]
+
+
+@lru_cache(maxsize=256)
+def flood_in_profile(drug: Drug, step: timedelta) -> np.ndarray:
+  # Partial doses are released at the first model step that is not before their time, like in BodyModel
+  if drug.flood_in is None:
+    profile = np.ones(1)
+  else:
+    offsets = np.ceil(np.arange(len(drug.flood_in)) * to_steps(drug.flood_in_timedelta, step) - 1e-9).astype(int)
+    profile = np.zeros(offsets[-1] + 1)
+    np.add.at(profile, offsets, drug.flood_in)
+  profile.flags.writeable = False
+  return profile
+
+
+@lru_cache(maxsize=256)
+def metabolite_matrix(drugs: Tuple[Drug, ...], step: timedelta) -> Tuple[Tuple[float, ...], np.ndarray]:
+  # Fraction of every drug left after a step, and the fractions of what is metabolised of drugs[n] that turn into
+  # drugs[m] at [n, m]
+  names = dict(map(lambda n: (drugs[n].name, n), range(len(drugs))))
+  fractions = np.zeros((len(drugs), len(drugs)))
+  for n, drug in enumerate(drugs):
+    for metabolite, fraction in drug.metabolites:
+      if metabolite in names:
+        fractions[n, names[metabolite]] += fraction
+  fractions.flags.writeable = False
+  return tuple(map(lambda d: decay_factor(d, step), drugs)), fractions
+
+
+def gamma_profile(peak_steps: float, shape: float) -> np.ndarray:
+  # Parametric absorption curve: gamma distribution with the given mode, sampled on the step grid
+  scale = peak_steps / (shape - 1.0)
+  support = max(1, int(math.ceil(shape * scale + 6.0 * math.sqrt(shape) * scale)))
+  t = np.arange(support, dtype=float) + 0.5
+  profile = np.exp((shape - 1.0) * np.log(t / scale) - t / scale)
+  total = profile.sum()
+  if not total > 0.0:
+    return np.ones(1)
+  return profile / total
+
+
+def response_length(chain: response_chain_type, profile_length: int, max_length: int) -> int:
+  return min(max_length, profile_length + int(math.ceil(DECAY_HALF_LIVES * sum(map(lambda c: c[0], chain)))))
+
+
+def chain_response(profile: np.ndarray, chain: response_chain_type, length: int) -> np.ndarray:
+  # Amount of the last drug in the chain at every step after a unit dose of the first one at step 0
+  amount = convolve(profile, decay_curve(chain[0][0], length), length)
+  for (parent_half_life, _), (half_life, fraction) in zip(chain, chain[1:]):
+    metabolised = np.zeros(length)
+    metabolised[1:] = amount[:-1] * (fraction * (1.0 - 2.0 ** (-1.0 / parent_half_life)))
+    amount = convolve(metabolised, decay_curve(half_life, length), length)
+  if len(amount) < length:
+    amount = np.concatenate((amount, np.zeros(length - len(amount))))
+  return amount
+
+
+@lru_cache(maxsize=1024)
+def parametric_response(half_life_steps: float,
+                        peak_steps: float,
+                        shape: float,
+                        metabolite_chain: response_chain_type,
+                        max_length: int) -> np.ndarray:
+  chain = ((half_life_steps, 1.0),) + metabolite_chain
+  profile = gamma_profile(peak_steps, shape)
+  response = chain_response(profile, chain, response_length(chain, len(profile), max_length))
+  response.flags.writeable = False
+  return response
+
+
+def metabolite_path(drugs: Dict[str, Drug],
+                    drugs_by_name: Dict[str, str],
+                    source: str,
+                    target: str) -> Optional[List[str]]:
+  if source == target:
+    return [source]
+  for metabolite_name, _ in drugs[source].metabolites:
+    if metabolite_name in drugs_by_name:
+      path = metabolite_path(drugs, drugs_by_name, drugs_by_name[metabolite_name], target)
+      if path is not None:
+        return [source] + path
+  return None
+
+
+def drug_chain(drugs: Dict[str, Drug],
+               drugs_by_name: Dict[str, str],
+               path: Sequence[str],
+               step: timedelta) -> response_chain_type:
+  chain = [(to_steps(drugs[path[0]].half_life, step), 1.0)]
+  for parent, child in zip(path, path[1:]):
+    fraction = sum(map(lambda m: m[1],
+                       filter(lambda m: drugs_by_name.get(m[0]) == child, drugs[parent].metabolites)))
+    chain.append((to_steps(drugs[child].half_life, step), fraction))
+  return tuple(chain)
+
+
+def drug_response(drugs: Dict[str, Drug],
+                  drugs_by_name: Dict[str, str],
+                  path: Sequence[str],
+                  step: timedelta,
+                  max_length: int) -> np.ndarray:
+  chain = drug_chain(drugs, drugs_by_name, path, step)
+  profile = flood_in_profile(drugs[path[0]], step)
+  return chain_response(profile, chain, response_length(chain, len(profile), max_length))
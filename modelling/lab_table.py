@@ -0,0 +1,100 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from modelling.dose_table import epoch_us, time_type
+
+
+class LabTable(object):
+  # Lab values of all drugs as columns sorted by time: the time in microseconds since the epoch, the id of the drug
+  # in drugs and the value. Values of equal time keep the order they were added in.
+  drugs:    List[str]
+  times:    np.ndarray
+  drug_ids: np.ndarray
+  values:   np.ndarray
+  indexes:  Dict[str, np.ndarray]
+
+  def __init__(self):
+    self.drugs    = []
+    self.times    = np.zeros(0, dtype=np.int64)
+    self.drug_ids = np.zeros(0, dtype=np.int32)
+    self.values   = np.zeros(0, dtype=float)
+    self.indexes  = {}
+
+  @classmethod
+  def from_labs(cls, labs: Iterable[Dict[str, Any]]) -> 'LabTable':
+    # Labs as parsed from a configuration, dicts of the date and the values of the drugs
+    table = cls()
+    table.extend(map(lambda lab: (lab['date'], lab['values']), labs))
+    return table
+
+  def __len__(self) -> int:
+    return len(self.times)
+
+  def __iter__(self) -> Iterator[Tuple[datetime, str, float]]:
+    return iter(self.rows_of(np.arange(len(self.times))))
+
+  def drug_id(self, drug: str) -> int:
+    if drug not in self.drugs:
+      self.drugs.append(drug)
+    return self.drugs.index(drug)
+
+  def add(self, time: datetime, values: Dict[str, float]) -> None:
+    self.extend([(time, values)])
+
+  def extend(self, labs: Iterable[Tuple[datetime, Dict[str, float]]]) -> None:
+    times, drug_ids, values = [], [], []
+    for time, lab_values in labs:
+      for drug, value in lab_values.items():
+        times.append(time)
+        drug_ids.append(self.drug_id(drug))
+        values.append(value)
+    self.times    = np.concatenate((self.times, epoch_us(np.array(times, dtype='datetime64[us]'))))
+    self.drug_ids = np.concatenate((self.drug_ids, np.array(drug_ids, dtype=np.int32)))
+    self.values   = np.concatenate((self.values, np.array(values, dtype=float)))
+    if np.any(np.diff(self.times) < 0):
+      order = np.argsort(self.times, kind='stable')
+      self.times, self.drug_ids, self.values = self.times[order], self.drug_ids[order], self.values[order]
+    self.indexes = {}
+
+  def rows(self, drug: str) -> np.ndarray:
+    if drug not in self.indexes:
+      drug_id = self.drugs.index(drug) if drug in self.drugs else -1
+      self.indexes[drug] = np.flatnonzero(self.drug_ids == drug_id)
+    return self.indexes[drug]
+
+  def rows_of(self, rows: np.ndarray) -> List[Tuple[datetime, str, float]]:
+    return list(zip(self.times[rows].astype('datetime64[us]').astype(datetime).tolist(),
+                    map(self.drugs.__getitem__, self.drug_ids[rows].tolist()),
+                    self.values[rows].tolist()))
+
+  def drug_labs(self, drug: str) -> List[Tuple[datetime, float]]:
+    return list(map(lambda r: (r[0], r[2]), self.rows_of(self.rows(drug))))
+
+  def between(self, start: Optional[time_type] = None, end: Optional[time_type] = None) -> 'LabTable':
+    # Values from start up to but not including end, sharing the ids of the drugs
+    first = 0 if start is None else int(np.searchsorted(self.times, epoch_us(start), side='left'))
+    last = len(self.times) if end is None else int(np.searchsorted(self.times, epoch_us(end), side='left'))
+    table = LabTable()
+    table.drugs    = list(self.drugs)
+    table.times    = self.times[first:last]
+    table.drug_ids = self.drug_ids[first:last]
+    table.values   = self.values[first:last]
+    return table
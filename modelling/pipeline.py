@@ -0,0 +1,79 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import pickle
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+
+def value_hash(value: Any) -> str:
+  return hashlib.blake2b(pickle.dumps(value, protocol=4), digest_size=16).hexdigest()
+
+
+class Stage(object):
+  name:     str
+  run:      Callable[[List[str]], None]
+  inputs:   Dict[str, Callable[[], Any]]
+  upstream: List[str]
+
+  def __init__(self, name: str, run: Callable[[List[str]], None], inputs: Dict[str, Callable[[], Any]],
+               upstream: Sequence[str]):
+    self.name     = name
+    self.run      = run
+    self.inputs   = inputs
+    self.upstream = list(upstream)
+
+
+class Pipeline(object):
+  # Stages in dependency order. A stage runs again only if the hash of one of its inputs or the key of one of the
+  # stages it depends on changed since it last ran, and is called with the names of the changed inputs.
+  stages:       List[Stage]
+  keys:         Dict[str, str]
+  input_hashes: Dict[str, Dict[str, str]]
+
+  def __init__(self):
+    self.stages       = []
+    self.keys         = {}
+    self.input_hashes = {}
+
+  def add_stage(self, name: str, run: Callable[[List[str]], None], inputs: Dict[str, Callable[[], Any]],
+                upstream: Sequence[str] = ()) -> None:
+    known = list(map(lambda s: s.name, self.stages))
+    for dependency in upstream:
+      if dependency not in known:
+        raise Exception(f"ERROR: Stage {name} depends on {dependency}, which has to be added before it")
+    self.stages.append(Stage(name, run, inputs, upstream))
+
+  def run(self, until: Optional[str] = None) -> List[str]:
+    ran = []
+    for stage in self.stages:
+      hashes = dict(map(lambda i: (i[0], value_hash(i[1]())), stage.inputs.items()))
+      for dependency in stage.upstream:
+        hashes[f"stage {dependency}"] = self.keys[dependency]
+      key = value_hash(sorted(hashes.items()))
+      if self.keys.get(stage.name) != key:
+        previous = self.input_hashes.get(stage.name, {})
+        stage.run(list(filter(lambda i: previous.get(i) != hashes[i], hashes.keys())))
+        self.keys[stage.name] = key
+        self.input_hashes[stage.name] = hashes
+        ran.append(stage.name)
+      if stage.name == until:
+        break
+    return ran
+
+  def invalidate(self, name: str) -> None:
+    self.keys.pop(name, None)
+    self.input_hashes.pop(name, None)
@@ -0,0 +1,110 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Optional, List, Tuple, Any, Sequence
+
+import numpy as np
+
+import version
+from cache_paths import cache_directory
+from modelling.pipeline import value_hash
+
+# Bump whenever what is stored for a key changes
+RESULT_VERSION = 1
+RESULT_CACHE_SIZE = 512 * 1024 * 1024
+
+
+def result_key(kind: str, inputs: Any) -> str:
+  return value_hash((kind, RESULT_VERSION, version.PROGRAM_VERSION, inputs))
+
+
+class ResultCache(object):
+  # Content addressed store for computed arrays. Every entry is a directory of .npy files named by the hash of
+  # everything it was computed from, the SQLite index keeps size and last use of the entries so the least
+  # recently used ones can be evicted once the total size goes over max_bytes, or once they were not used for
+  # max_age seconds. Entries are loaded memory mapped.
+  directory:  Path
+  index_path: Path
+  max_bytes:  int
+  max_age:    Optional[float]
+
+  def __init__(self, max_bytes: int = RESULT_CACHE_SIZE, name: str = 'results', max_age: Optional[float] = None):
+    self.directory  = cache_directory(name)
+    self.index_path = self.directory / "index.sqlite"
+    self.max_bytes  = max_bytes
+    self.max_age    = max_age
+    self.execute("CREATE TABLE IF NOT EXISTS entries "
+                 "(key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+
+  def execute(self, query: str, parameters: Sequence[Any] = ()) -> List[Tuple]:
+    connection = sqlite3.connect(str(self.index_path), timeout=30)
+    try:
+      with connection:
+        return connection.execute(query, parameters).fetchall()
+    finally:
+      connection.close()
+
+  def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+    if len(self.execute("SELECT key FROM entries WHERE key = ?", (key,))) == 0:
+      return None
+    try:
+      arrays = dict(map(lambda f: (f.stem, np.load(f, mmap_mode='r')), (self.directory / key).glob("*.npy")))
+    except (OSError, ValueError):
+      arrays = {}
+    if len(arrays) == 0:
+      self.remove([key])
+      return None
+    self.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+    return arrays
+
+  def put(self, key: str, arrays: Dict[str, np.ndarray]) -> None:
+    temp_path = self.directory / f"{key}.{os.getpid()}.tmp"
+    try:
+      temp_path.mkdir(exist_ok=True)
+      for name, array in arrays.items():
+        np.save(temp_path / f"{name}.npy", np.ascontiguousarray(array), allow_pickle=False)
+      size = sum(map(lambda f: f.stat().st_size, temp_path.iterdir()))
+      try:
+        os.rename(temp_path, self.directory / key)
+      except OSError:
+        # Another process stored the same result first
+        shutil.rmtree(temp_path, ignore_errors=True)
+    except OSError as e:
+      shutil.rmtree(temp_path, ignore_errors=True)
+      print(f"WARNING: Cannot write result cache {self.directory}: {e}")
+      return
+    self.execute("INSERT OR REPLACE INTO entries (key, size, last_used) VALUES (?, ?, ?)", (key, size, time.time()))
+    self.evict()
+
+  def evict(self) -> None:
+    total = 0
+    stale = []
+    oldest = time.time() - self.max_age if self.max_age is not None else None
+    for key, size, last_used in self.execute("SELECT key, size, last_used FROM entries ORDER BY last_used DESC"):
+      total += size
+      if total > self.max_bytes or (oldest is not None and last_used < oldest):
+        stale.append(key)
+    self.remove(stale)
+
+  def remove(self, keys: List[str]) -> None:
+    for key in keys:
+      shutil.rmtree(self.directory / key, ignore_errors=True)
+      self.execute("DELETE FROM entries WHERE key = ?", (key,))
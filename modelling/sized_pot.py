@@ -1,26 +1,34 @@
-from typing import List
-from funcy import map
+from collections import deque
+from typing import Deque
 from math import sqrt
 
 
 class SizedPot(object):
+  # Keeps the sum and the sum of squares of the window, so the spread around any average is O(1)
   size: int
-  data: List[float]
+  data: Deque[float]
   sum: float
+  sum_sq: float
 
   def __init__(self, size: int):
     self.size = size
-    self.data = []
+    self.data = deque()
+    self.sum = 0.0
+    self.sum_sq = 0.0
 
   def add_data(self, point: float):
     self.data.append(point)
+    self.sum += point
+    self.sum_sq += point * point
     while len(self.data) > self.size:
-      self.data.pop(0)
+      old = self.data.popleft()
+      self.sum -= old
+      self.sum_sq -= old * old
 
   def calc_std_dev(self, average: float) -> float:
-    sqsum = sum(map(lambda x: (x - average)**2, self.data))
     if len(self.data) <= 1:
       return 0.0
+    sqsum = max(self.sum_sq - 2 * average * self.sum + len(self.data) * average * average, 0.0)
     size_factor = 1 / (len(self.data) - 1.5)
     return sqrt(size_factor * sqsum)
 
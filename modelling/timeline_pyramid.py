@@ -0,0 +1,118 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import math
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+
+
+class TimelinePyramid(object):
+  # Aggregates of the blocks of 2**level samples of a timeline for every level: index of the smallest and largest
+  # sample, sum and sum of squares. Any range is covered by at most two blocks per level, so its aggregates take
+  # O(log n), and the level with about one block per pixel column gives the samples to draw for it.
+  values:   np.ndarray
+  argmin:   List[np.ndarray]
+  argmax:   List[np.ndarray]
+  sums:     List[np.ndarray]
+  sums_sq:  List[np.ndarray]
+
+  def __init__(self, values: Union[Sequence[float], np.ndarray]):
+    self.values  = np.zeros(0)
+    self.argmin  = []
+    self.argmax  = []
+    self.sums    = []
+    self.sums_sq = []
+    self.update(values)
+
+  def update(self, values: Union[Sequence[float], np.ndarray], from_index: int = 0) -> None:
+    # Values changed from from_index on, or were appended. Only the blocks covering them are calculated again.
+    values = np.asarray(values, dtype=float)
+    from_index = min(from_index, len(self.values), len(values))
+    self.values = values
+    low = high = np.arange(from_index, len(values))
+    sums = values[from_index:]
+    sums_sq = sums * sums
+    level = 0
+    while True:
+      if level == len(self.argmin):
+        self.argmin.append(low)
+        self.argmax.append(high)
+        self.sums.append(sums)
+        self.sums_sq.append(sums_sq)
+      else:
+        self.argmin[level]  = np.concatenate((self.argmin[level][:from_index], low))
+        self.argmax[level]  = np.concatenate((self.argmax[level][:from_index], high))
+        self.sums[level]    = np.concatenate((self.sums[level][:from_index], sums))
+        self.sums_sq[level] = np.concatenate((self.sums_sq[level][:from_index], sums_sq))
+      if len(self.argmin[level]) <= 1:
+        del self.argmin[level + 1:], self.argmax[level + 1:], self.sums[level + 1:], self.sums_sq[level + 1:]
+        return
+      # The blocks of the next level start at an even block of this one
+      from_index = from_index // 2
+      low, high = self.argmin[level][2 * from_index:], self.argmax[level][2 * from_index:]
+      sums, sums_sq = self.sums[level][2 * from_index:], self.sums_sq[level][2 * from_index:]
+      if len(low) % 2 == 1:
+        low, high = np.append(low, low[-1]), np.append(high, high[-1])
+        sums, sums_sq = np.append(sums, 0.0), np.append(sums_sq, 0.0)
+      low     = np.where(values[low[0::2]] <= values[low[1::2]], low[0::2], low[1::2])
+      high    = np.where(values[high[0::2]] >= values[high[1::2]], high[0::2], high[1::2])
+      sums    = sums[0::2] + sums[1::2]
+      sums_sq = sums_sq[0::2] + sums_sq[1::2]
+      level += 1
+
+  def aggregate(self, first: int, last: int) -> Tuple[float, float, float, float]:
+    # Minimum, maximum, sum and sum of squares of the samples first:last
+    first, last = max(first, 0), min(last, len(self.values))
+    if last <= first:
+      raise Exception(f"ERROR: Empty range {first}:{last} of a timeline with {len(self.values)} samples")
+    smallest, largest = first, first
+    total, total_sq = 0.0, 0.0
+    level = 0
+    while first < last:
+      blocks = []
+      if first % 2 == 1:
+        blocks.append(first)
+        first += 1
+      if last % 2 == 1:
+        last -= 1
+        blocks.append(last)
+      for block in blocks:
+        if self.values[self.argmin[level][block]] < self.values[smallest]:
+          smallest = self.argmin[level][block]
+        if self.values[self.argmax[level][block]] > self.values[largest]:
+          largest = self.argmax[level][block]
+        total    += self.sums[level][block]
+        total_sq += self.sums_sq[level][block]
+      first //= 2
+      last  //= 2
+      level += 1
+    return float(self.values[smallest]), float(self.values[largest]), float(total), float(total_sq)
+
+  def statistics(self, first: int, last: int) -> Tuple[float, float, float, float]:
+    # Minimum, maximum, mean and standard deviation of the samples first:last
+    smallest, largest, total, total_sq = self.aggregate(first, last)
+    count = min(last, len(self.values)) - max(first, 0)
+    mean = total / count
+    return smallest, largest, mean, math.sqrt(max(total_sq / count - mean * mean, 0.0))
+
+  def extreme_indices(self, first: int, last: int, buckets: int) -> np.ndarray:
+    # Indices of the smallest and largest sample of every block from the level with about buckets blocks in
+    # first:last, what has to be drawn at a width of buckets pixel columns
+    level = min(max(int(math.floor(math.log2(max((last - first) / buckets, 1.0)))), 0), len(self.argmin) - 1)
+    blocks = slice(first >> level, ((last - 1) >> level) + 1)
+    return np.concatenate((self.argmin[level][blocks], self.argmax[level][blocks]))
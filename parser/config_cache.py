@@ -0,0 +1,118 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import pickle
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, Optional, List, Tuple
+
+import numpy as np
+
+from cache_paths import cache_directory
+
+
+# Top level sections in the order they have to be parsed, with the alternative spellings the parser accepts
+SECTIONS = ('drugs', 'model', 'graph', 'labs', 'doses', 'print_estimates', 'plan')
+SECTION_ALIASES = {
+  'drug':             'drugs',
+  'graphs':           'graph',
+  'lab':              'labs',
+  'dose':             'doses',
+  'print-estimates':  'print_estimates',
+}
+# Sections whose parsed result depends on other sections, e.g. doses are only kept for known drugs
+SECTION_DEPENDENCIES = {
+  'doses':  ('drugs',),
+  'plan':   ('drugs',),
+}
+
+section_parser = re.compile(r"^([A-Za-z_][\w-]*)[ \t]*:", re.MULTILINE)
+
+dose_columns_type = Dict[str, Tuple[np.ndarray, np.ndarray]]
+
+
+def content_hash(data: str) -> str:
+  return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def split_sections(text: str) -> Dict[str, str]:
+  sections = {}
+  matches = list(section_parser.finditer(text))
+  for match, next_match in zip(matches, matches[1:] + [None]):
+    end = len(text) if next_match is None else next_match.start()
+    name = SECTION_ALIASES.get(match.group(1), match.group(1))
+    sections[name] = sections.get(name, "") + text[match.start():end]
+  return sections
+
+
+def section_hashes(sections: Dict[str, str]) -> Dict[str, str]:
+  return dict(map(lambda s: (s[0], content_hash(s[1])), sections.items()))
+
+
+def changed_sections(hashes: Dict[str, str], cached_hashes: Optional[Dict[str, str]]) -> List[str]:
+  if cached_hashes is None:
+    return list(SECTIONS)
+  changed = set(filter(lambda s: hashes.get(s) != cached_hashes.get(s), SECTIONS))
+  for section, dependencies in SECTION_DEPENDENCIES.items():
+    if any(map(lambda d: d in changed, dependencies)):
+      changed.add(section)
+  return list(filter(lambda s: s in changed, SECTIONS))
+
+
+def columns_to_doses(columns: dose_columns_type) -> Dict[str, List[Dict[str, Any]]]:
+  doses = {}
+  for drug, (dates, amounts) in columns.items():
+    doses[drug] = list(map(lambda d: {'date': d[0], 'dose': d[1]}, zip(dates.astype(datetime).tolist(),
+                                                                        amounts.tolist())))
+  return doses
+
+
+class ConfigCache(object):
+  # Binary image of a parsed configuration, keyed by the path of the file. The content hashes of the whole
+  # file and of every top level section decide whether all, some or none of it can be reused.
+  path:     Path
+  version:  str
+
+  def __init__(self, file: Path, version: str):
+    self.version = version
+    key = hashlib.blake2b(str(file.resolve()).encode('utf-8'), digest_size=16).hexdigest()
+    self.path = cache_directory('config') / f"{key}.pickle"
+
+  def load(self) -> Optional[Dict[str, Any]]:
+    # noinspection PyBroadException
+    try:
+      with self.path.open('rb') as cache_file:
+        cached = pickle.load(cache_file)
+      if cached.get('version') != self.version:
+        return None
+      return cached
+    except Exception:
+      return None
+
+  def save(self, file_hash: str, section_hashes: Dict[str, str], state: Dict[str, Any]) -> None:
+    temp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+      with temp_path.open('wb') as cache_file:
+        pickle.dump({'version':   self.version,
+                     'file_hash': file_hash,
+                     'sections':  section_hashes,
+                     'state':     state}, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_path, self.path)
+    except OSError as e:
+      print(f"WARNING: Cannot write configuration cache {self.path}: {e}")
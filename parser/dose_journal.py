@@ -0,0 +1,142 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, Any, Optional, List
+
+import numpy as np
+
+from cache_paths import cache_directory
+from parser.dose_log import dose_array_type, csv_lines, csv_header, parse_csv_lines
+
+# Bump whenever the stored state changes
+JOURNAL_VERSION = 3
+# Bytes right before the stored offset that have to be unchanged for an append
+TAIL_BYTES = 64 * 1024
+
+
+class DoseJournal(object):
+  # Append-only CSV dose log. The byte offset of the last complete line and the doses parsed up to it are kept
+  # in the cache directory, so a later read only parses what was appended since. Once the size or the modification
+  # time of the file changed, the header line and the last TAIL_BYTES before the offset are compared with the ones
+  # kept, if they changed the log was rewritten and is parsed from scratch. Edits further back are not noticed.
+  file:       Path
+  state_path: Path
+  header:     Optional[List[str]]
+  offset:     int
+  head:       bytes
+  tail:       bytes
+  times:      np.ndarray
+  amounts:    np.ndarray
+  rewritten:  bool
+
+  def __init__(self, file: Path):
+    self.file = file
+    key = hashlib.blake2b(str(file.resolve()).encode('utf-8'), digest_size=16).hexdigest()
+    self.state_path = cache_directory('journal') / f"{key}.pickle"
+    self.reset()
+    self.rewritten = False
+
+  def reset(self) -> None:
+    self.header   = None
+    self.offset   = 0
+    self.head     = b''
+    self.tail     = b''
+    self.times    = np.array([], dtype='datetime64[us]')
+    self.amounts  = np.array([], dtype=float)
+
+  def read(self) -> dose_array_type:
+    with self.file.open('rb') as journal_file:
+      state = self.load_state()
+      self.rewritten = state is not None and not self.is_append_of(journal_file, state)
+      if state is not None and not self.rewritten:
+        self.header   = state['header']
+        self.offset   = state['offset']
+        self.head     = state['head']
+        self.tail     = state['tail']
+        self.times    = state['times']
+        self.amounts  = state['amounts']
+      else:
+        self.reset()
+      journal_file.seek(self.offset)
+      data = journal_file.read()
+      end = data.rfind(b'\n') + 1
+      if end > 0:
+        self.parse_appended(data[:end].decode('utf-8'))
+        if self.offset == 0:
+          self.head = data[:data.find(b'\n') + 1]
+        self.tail = (self.tail + data[max(end - TAIL_BYTES, 0):end])[-TAIL_BYTES:]
+        self.offset += end
+        self.save_state(journal_file)
+      # The last line without a newline is parsed as well, but not stored, as it might still be being written
+      if len(data[end:].strip()) > 0:
+        self.parse_appended(data[end:].decode('utf-8'))
+    if self.header is None:
+      raise Exception(f"ERROR: Empty dose log {self.file}")
+    return self.times, self.amounts
+
+  def parse_appended(self, text: str) -> None:
+    lines = csv_lines(text)
+    if self.header is None and len(lines) > 0:
+      self.header = csv_header(self.file, lines[0])
+      lines = lines[1:]
+    times, amounts = parse_csv_lines(self.file, self.header, lines)
+    self.times    = np.concatenate((self.times, times))
+    self.amounts  = np.concatenate((self.amounts, amounts))
+
+  def is_append_of(self, journal_file, state: Dict[str, Any]) -> bool:
+    offset = state['offset']
+    stat = os.fstat(journal_file.fileno())
+    if stat.st_size < offset:
+      return False
+    if (stat.st_mtime_ns, stat.st_size) == state['stat']:
+      return True
+    journal_file.seek(0)
+    if journal_file.read(len(state['head'])) != state['head']:
+      return False
+    journal_file.seek(offset - len(state['tail']))
+    return journal_file.read(len(state['tail'])) == state['tail']
+
+  def load_state(self) -> Optional[Dict[str, Any]]:
+    # noinspection PyBroadException
+    try:
+      with self.state_path.open('rb') as state_file:
+        state = pickle.load(state_file)
+      if state.get('version') != JOURNAL_VERSION:
+        return None
+      return state
+    except Exception:
+      return None
+
+  def save_state(self, journal_file) -> None:
+    stat = os.fstat(journal_file.fileno())
+    temp_path = self.state_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+      with temp_path.open('wb') as state_file:
+        pickle.dump({'version':  JOURNAL_VERSION,
+                     'header':   self.header,
+                     'offset':   self.offset,
+                     'head':     self.head,
+                     'tail':     self.tail,
+                     'stat':     (stat.st_mtime_ns, stat.st_size),
+                     'times':    self.times,
+                     'amounts':  self.amounts}, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_path, self.state_path)
+    except OSError as e:
+      print(f"WARNING: Cannot write dose journal state {self.state_path}: {e}")
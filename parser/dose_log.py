@@ -0,0 +1,127 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+from pathlib import Path
+from typing import Dict, Tuple, Optional, List
+
+import numpy as np
+
+
+# Hour of the day a dose is taken at, if neither hour nor time is given
+DEFAULT_DOSE_HOUR = 9
+
+dose_array_type = Tuple[np.ndarray, np.ndarray]
+
+# One dose per line in flow style, as written by hand or appended by scripts:
+#   - { date: 2020-12-12, hour: 9, dose: 2.5 }
+#   - { date: 2020-01-10, time: "00:00:00", dose: 50 }
+#   - { date: 2021-12-30 15:47:00, dose: 10 }
+flow_dose_parser = re.compile(
+  r"^[ \t]*-[ \t]*\{[ \t]*date:[ \t]*(\d{4}-\d{2}-\d{2})(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}))?)?[ \t]*,"
+  r"(?:[ \t]*hour:[ \t]*(\d{1,2})[ \t]*,"
+  r"|[ \t]*time:[ \t]*([\"']?)(\d{1,2}):(\d{2}):(\d{2})\6[ \t]*,)?"
+  r"[ \t]*(?:dose|amount):[ \t]*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)[ \t]*\}[ \t]*(?:#.*)?$",
+  re.MULTILINE)
+list_item_parser = re.compile(r"^[ \t]*-", re.MULTILINE)
+drug_key_parser = re.compile(r"^([ \t]+)([^\s:#][^:#]*?)[ \t]*:[ \t]*(.*?)[ \t]*$", re.MULTILINE)
+
+
+def to_int_array(strings: List[str], default: int = 0) -> np.ndarray:
+  return np.array(list(map(lambda s: s if s != "" else str(default), strings))).astype(np.int64)
+
+
+def parse_flow_doses(block: str) -> Optional[dose_array_type]:
+  # Only homogeneous blocks are handled here, anything else (repeat, other keys, block style) returns None
+  matches = flow_dose_parser.findall(block)
+  if len(matches) == 0 or len(matches) != len(list_item_parser.findall(block)):
+    return None
+  columns = list(zip(*matches))
+  dates = np.array(columns[0], dtype='datetime64[D]').astype('datetime64[us]')
+  date_hours, date_minutes, date_seconds = to_int_array(columns[1]), to_int_array(columns[2]), \
+    to_int_array(columns[3])
+  hours = to_int_array(columns[4], DEFAULT_DOSE_HOUR)
+  time_hours, time_minutes, time_seconds = to_int_array(columns[6]), to_int_array(columns[7]), \
+    to_int_array(columns[8])
+  has_datetime = np.array(columns[1]) != ""
+  has_time = np.array(columns[6]) != ""
+  seconds = np.where(has_datetime, date_hours * 3600 + date_minutes * 60 + date_seconds,
+                     np.where(has_time, time_hours * 3600 + time_minutes * 60 + time_seconds, hours * 3600))
+  amounts = np.array(columns[9]).astype(float)
+  return dates + seconds.astype('timedelta64[s]'), amounts
+
+
+def split_drug_blocks(doses_text: str) -> Optional[Dict[str, Tuple[str, str]]]:
+  # Splits the doses section into {drug: (inline value, block)} by the keys on the first indentation level
+  lines = doses_text.split('\n', 1)
+  if len(lines) < 2 or lines[0].split(':', 1)[1].split('#')[0].strip() != "":
+    return None
+  body = lines[1]
+  keys = list(filter(lambda m: not m.group(2).startswith('-'), drug_key_parser.finditer(body)))
+  if len(keys) == 0:
+    return None
+  indent = keys[0].group(1)
+  keys = list(filter(lambda m: m.group(1) == indent, keys))
+  blocks = {}
+  for key, next_key in zip(keys, keys[1:] + [None]):
+    end = len(body) if next_key is None else next_key.start()
+    blocks[key.group(2).strip('"\'')] = (key.group(3), body[key.end():end])
+  return blocks
+
+
+def parse_csv_doses(file: Path) -> dose_array_type:
+  # date,hour,dose / date,time,dose / datetime,dose with ISO dates, a header line and one dose per line
+  with file.open('r') as csv_file:
+    lines = csv_lines(csv_file.read())
+  if len(lines) == 0:
+    raise Exception(f"ERROR: Empty dose log {file}")
+  return parse_csv_lines(file, csv_header(file, lines[0]), lines[1:])
+
+
+def csv_lines(text: str) -> List[str]:
+  return list(filter(lambda l: l.strip() != "" and not l.startswith('#'), text.splitlines()))
+
+
+def csv_header(file: Path, line: str) -> List[str]:
+  header = list(map(lambda h: h.strip().lower(), line.split(',')))
+  if not any(map(lambda f: f in header, ('date', 'datetime', 'time_stamp', 'timestamp'))) or \
+     not any(map(lambda f: f in header, ('dose', 'amount'))):
+    raise Exception(f"ERROR: Dose log {file} needs a date and a dose column, got: {line}")
+  return header
+
+
+def parse_csv_lines(file: Path, header: List[str], lines: List[str]) -> dose_array_type:
+  columns = list(zip(*map(lambda l: map(str.strip, l.split(',')), lines)))
+  if len(columns) == 0:
+    return np.array([], dtype='datetime64[us]'), np.array([], dtype=float)
+  if len(columns) != len(header):
+    raise Exception(f"ERROR: Dose log {file} needs the same number of fields in every line as in the header")
+  fields = dict(zip(header, columns))
+  date_field = next(filter(lambda f: f in fields, ('date', 'datetime', 'time_stamp', 'timestamp')))
+  amount_field = next(filter(lambda f: f in fields, ('dose', 'amount')))
+  dates = np.array(fields[date_field], dtype='datetime64[us]')
+  if 'time' in fields:
+    dates = dates + to_seconds(fields['time']).astype('timedelta64[s]')
+  elif 'hour' in fields:
+    dates = dates + to_int_array(list(fields['hour']), DEFAULT_DOSE_HOUR).astype('timedelta64[h]')
+  elif all(map(lambda d: len(d) == 10, fields[date_field])):
+    dates = dates + np.timedelta64(DEFAULT_DOSE_HOUR, 'h')
+  return dates, np.array(fields[amount_field]).astype(float)
+
+
+def to_seconds(times: Tuple[str, ...]) -> np.ndarray:
+  parts = np.array(list(map(lambda t: (t + ":0:0").split(':')[:3], times))).astype(np.int64)
+  return parts[:, 0] * 3600 + parts[:, 1] * 60 + parts[:, 2]
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Dict, Union, List, TypedDict, Optional, Tuple, Any, TypeVar
+from typing import Dict, Union, List, TypedDict, Optional, Tuple, Any, TypeVar, Iterable
 from datetime import datetime, date, timedelta, time
 
 import funcy
@@ -11,6 +11,18 @@ except ImportError:
 
 import re
 
+import version
+import numpy as np
+from parser.config_cache import ConfigCache, SECTIONS, content_hash, split_sections, section_hashes, \
+  changed_sections, columns_to_doses, dose_columns_type
+from parser.dose_log import parse_flow_doses, parse_csv_doses, split_drug_blocks, DEFAULT_DOSE_HOUR
+from parser.dose_journal import DoseJournal
+from modelling.dose_table import DoseTable
+from modelling.lab_table import LabTable
+
+# Bump whenever the parsed representation changes, so cached configurations are parsed again
+PARSER_VERSION = 4
+
 date_parser_iso = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
 date_parser_eu  = re.compile(r"^(\d{2})[./](\d{2})[./](\d{4})$")
 time_parser     = re.compile(r"^(\d{1,2}):(\d{2}):(\d{2})$")
@@ -39,6 +51,7 @@ class YAMLmodel(TypedDict):
   timedelta:          timedelta
   days_into_future:   int
   corrected_std_dev:  bool
+  track_factor:       bool
   events:             List[YAMLevent]
 
 
@@ -70,27 +83,151 @@ class YAMLgraph(TypedDict):
   use_x_date:           bool
 
 
+class YAMLplan(TypedDict):
+  drug:       str
+  target:     str
+  band:       Tuple[float, float]
+  doses:      List[float]
+  intervals:  List[timedelta]
+  hour:       int
+
+
 class YAMLparser(object):
   drugs:            Dict[str, YAMLdrug]
   model:            YAMLmodel
   graph:            YAMLgraph
   labs:             List[YAMLlabs]
-  doses:            Dict[str, List[YAMLdose]]
+  dose_columns:     dose_columns_type
   print_estimates:  List[datetime]
+  plan:             Optional[YAMLplan]
+  base_path:        Path
+  dose_logs:        Dict[str, Tuple[str, Optional[Tuple[int, int]]]]
+  use_cache:        bool
+  section_hashes:   Dict[str, str]
 
-  def __init__(self, file: Path):
+  def __init__(self, file: Path, use_cache: bool = True):
     self.drugs            = {}
     self.labs             = []
-    self.doses            = {}
+    self.dose_columns     = {}
     self.print_estimates  = []
+    self.plan             = None
+    self.base_path        = file.parent
+    self.dose_logs        = {}
+    self.use_cache        = use_cache
     with file.open('r') as yaml_file:
-      raw_yaml_data = load(yaml_file, Loader=Loader)
-      self.parse_drugs(raw_yaml_data)
-      self.parse_model(raw_yaml_data)
-      self.parse_graph(raw_yaml_data)
-      self.parse_labs(raw_yaml_data)
+      text = yaml_file.read()
+    if use_cache:
+      self.parse_cached(file, text)
+    else:
+      sections = split_sections(text)
+      self.section_hashes = section_hashes(sections)
+      self.parse_text(text, sections, SECTIONS)
+
+  @property
+  def doses(self) -> Dict[str, List[YAMLdose]]:
+    # Per dose view of dose_columns, for code that wants to walk the doses one by one
+    return columns_to_doses(self.dose_columns)
+
+  @property
+  def dose_table(self) -> DoseTable:
+    # Columnar views of the doses and the labs, as the model keeps them
+    return DoseTable.from_columns(self.dose_columns)
+
+  @property
+  def lab_table(self) -> LabTable:
+    return LabTable.from_labs(self.labs)
+
+  def parse_text(self, text: str, sections: Dict[str, str], changed: List[str]) -> None:
+    # Dose logs in the simple one-dose-per-line form are parsed straight into arrays, without the YAML loader
+    fast_doses = 'doses' in changed and 'doses' in sections
+    yaml_sections = list(filter(lambda s: s != 'doses' or not fast_doses, changed))
+    # noinspection PyBroadException
+    try:
+      raw_yaml_data = load("".join(map(lambda s: sections.get(s, ""), yaml_sections)), Loader=Loader)
+    except Exception:
+      # Sections referring to anchors in other sections can only be loaded together
+      raw_yaml_data = load(text, Loader=Loader)
+      fast_doses = False
+      yaml_sections = changed
+    self.parse_sections(raw_yaml_data, filter(lambda s: s not in ['doses', 'print_estimates', 'plan'],
+                                              yaml_sections))
+    if fast_doses and not self.parse_doses_text(sections['doses']):
+      self.parse_doses(load(sections['doses'], Loader=Loader))
+    elif 'doses' in yaml_sections:
       self.parse_doses(raw_yaml_data)
-      self.parse_print_estimates(raw_yaml_data)
+    self.parse_sections(raw_yaml_data, filter(lambda s: s in ['print_estimates', 'plan'], yaml_sections))
+
+  def parse_sections(self, raw_yaml_data: Dict[str, Any], sections: Iterable[str]) -> None:
+    parsers = {
+      'drugs':            self.parse_drugs,
+      'model':            self.parse_model,
+      'graph':            self.parse_graph,
+      'labs':             self.parse_labs,
+      'doses':            self.parse_doses,
+      'print_estimates':  self.parse_print_estimates,
+      'plan':             self.parse_plan,
+    }
+    if raw_yaml_data is None:
+      raw_yaml_data = {}
+    for section in sections:
+      parsers[section](raw_yaml_data)
+
+  def parse_cached(self, file: Path, text: str) -> None:
+    cache = ConfigCache(file, f"{PARSER_VERSION}/{version.PROGRAM_VERSION}")
+    cached = cache.load()
+    file_hash = content_hash(text)
+    logs_changed = cached is not None and \
+      any(map(lambda log: self.dose_log_stat(Path(log[0])) != log[1], cached['state']['dose_logs'].values()))
+    if cached is not None and cached['file_hash'] == file_hash and not logs_changed:
+      self.restore_sections(cached['state'], SECTIONS)
+      self.dose_logs = cached['state']['dose_logs']
+      self.section_hashes = cached['sections']
+      return
+    sections = split_sections(text)
+    hashes = section_hashes(sections)
+    self.section_hashes = hashes
+    changed = changed_sections(hashes, None if cached is None else cached['sections'])
+    if logs_changed and 'doses' not in changed:
+      changed = list(filter(lambda s: s in changed + ['doses'], SECTIONS))
+    if cached is not None:
+      self.restore_sections(cached['state'], filter(lambda s: s not in changed, SECTIONS))
+    self.parse_text(text, sections, changed)
+    cache.save(file_hash, hashes, self.section_state())
+
+  def section_state(self) -> Dict[str, Any]:
+    return {
+      'drugs':            self.drugs,
+      'model':            self.model,
+      'graph':            self.graph,
+      'labs':             self.labs,
+      'doses':            self.dose_columns,
+      'print_estimates':  self.print_estimates,
+      'plan':             self.plan,
+      'dose_logs':        self.dose_logs,
+    }
+
+  @staticmethod
+  def dose_log_stat(file: Path) -> Optional[Tuple[int, int]]:
+    try:
+      stat = file.stat()
+      return stat.st_mtime_ns, stat.st_size
+    except OSError:
+      return None
+
+  def read_dose_log(self, drug: str, file_name: str) -> Tuple[np.ndarray, np.ndarray]:
+    file = self.base_path / file_name
+    self.dose_logs[drug] = (str(file), self.dose_log_stat(file))
+    if self.use_cache:
+      return DoseJournal(file).read()
+    return parse_csv_doses(file)
+
+  def restore_sections(self, state: Dict[str, Any], sections: Iterable[str]) -> None:
+    for section in sections:
+      if section == 'doses':
+        self.dose_columns = state['doses']
+        self.dose_logs = state['dose_logs']
+      else:
+        setattr(self, section, state[section])
 
   @staticmethod
   def __general_parser(data: Dict[str, Any],
@@ -275,6 +412,42 @@ class YAMLparser(object):
         pr_est_date = self._parse_date(est, 'date', hour)
         self.print_estimates.append(pr_est_date)
 
+  def parse_plan(self, raw_data: Dict[str, Any]) -> None:
+    if "plan" not in raw_data:
+      return
+    plan = raw_data['plan']
+    if not isinstance(plan, dict):
+      raise Exception("ERROR: plan needs to be a dictionary")
+    drug = self._parse_str(plan, 'drug')
+    if drug is None or drug not in self.drugs:
+      raise Exception(f"ERROR: plan needs a drug from the drugs section, got: {plan}")
+    target = self._parse_str(plan, ['target', 'measured'], drug)
+    if target not in self.drugs:
+      raise Exception(f"ERROR: plan needs a target from the drugs section, got: {target}")
+    band = self._parse_tuple(plan, ['band', 'target_band', 'target-band'], 2, check_type=[float, int])
+    if band is None:
+      raise Exception(f"ERROR: plan needs a target band of two values, got: {plan}")
+    doses = plan.get('doses', plan.get('dose'))
+    if not isinstance(doses, list) or len(doses) == 0:
+      raise Exception(f"ERROR: plan needs a list of allowed doses, got: {plan}")
+    intervals = []
+    raw_intervals = plan.get('intervals', plan.get('interval'))
+    if isinstance(raw_intervals, dict):
+      raw_intervals = [raw_intervals]
+    if isinstance(raw_intervals, list):
+      for interval in raw_intervals:
+        td = self._parse_timedelta({'interval': interval}, 'interval', None)
+        if td is not None:
+          intervals.append(td)
+    if len(intervals) == 0:
+      raise Exception(f"ERROR: plan needs a list of allowed intervals, got: {plan}")
+    self.plan = YAMLplan(drug=drug,
+                         target=target,
+                         band=(float(band[0]), float(band[1])),
+                         doses=list(map(float, doses)),
+                         intervals=intervals,
+                         hour=self._parse_int(plan, 'hour', 9))
+
   def parse_drugs(self, raw_data: Dict[str, Any]) -> None:
     if "drugs" in raw_data:
       drugs = raw_data['drugs']
@@ -312,6 +485,7 @@ class YAMLparser(object):
         time_d = self._parse_timedelta(model)
         days_into_future = self._parse_int(model, 'days_into_future', 90)
         corrected_std_dev = self._parse_bool(model, ['corrected_std_dev', 'corrected-std-dev'])
+        track_factor = self._parse_bool(model, ['track_factor', 'track-factor'], False)
         events = None
         if "event" in model:
           events = model['event']
@@ -335,6 +509,7 @@ class YAMLparser(object):
                                timedelta=time_d,
                                days_into_future=days_into_future,
                                corrected_std_dev=corrected_std_dev,
+                               track_factor=track_factor,
                                events=event_list)
       else:
         raise Exception("ERROR: start_date is needed in model!")
@@ -482,6 +657,30 @@ class YAMLparser(object):
           if lb is not None:
             self.labs.append(lb)
 
+  def parse_doses_text(self, doses_text: str) -> bool:
+    blocks = split_drug_blocks(doses_text)
+    if blocks is None:
+      return False
+    self.dose_logs = {}
+    columns = {}
+    for drug, (inline, block) in blocks.items():
+      if drug not in self.drugs:
+        continue
+      if inline.strip('"\'').lower().endswith('.csv') and block.strip() == "":
+        columns[drug] = self.read_dose_log(drug, inline.strip('"\''))
+        continue
+      if inline != "":
+        return False
+      drug_columns = parse_flow_doses(block)
+      if drug_columns is None:
+        return False
+      columns[drug] = drug_columns
+    # Unknown drugs and empty logs get the usual warnings and errors from the generic parser
+    if len(columns) != len(blocks) or sum(map(lambda c: len(c[1]), columns.values())) == 0:
+      return False
+    self.dose_columns = columns
+    return True
+
   def parse_doses(self, raw_data: Dict[str, Any]) -> None:
     drug_doses = None
     if 'doses' in raw_data:
@@ -492,18 +691,24 @@ class YAMLparser(object):
       raise Exception("ERROR: Doses is a mandatory field")
     if not isinstance(drug_doses, dict):
       raise Exception("ERROR: Doses needs to be a dict of drugs with a list of doses as value")
+    self.dose_columns = {}
+    self.dose_logs = {}
     for drug, doses in drug_doses.items():
       if drug not in self.drugs:
         print(f"WARNING: Could not find reference {drug} in the drugs section, skipping")
         continue
+      if isinstance(doses, str) and doses.lower().endswith('.csv'):
+        self.dose_columns[drug] = self.read_dose_log(drug, doses)
+        continue
       if not isinstance(doses, list):
         print(f"WARNING: Doses must be in a list, skipping.\n"
               f"         got: {doses[0:max(80, len(doses))]}")
         continue
-      self.doses[drug] = []
+      dates: List[datetime] = []
+      amounts: List[float] = []
       for dose in doses:
         if 'date' in dose:
-          hour = self._parse_int(dose, 'hour', 9)
+          hour = self._parse_int(dose, 'hour', DEFAULT_DOSE_HOUR)
           hour = self._parse_time(dose, 'time', hour)
           dose_date = self._parse_date(dose, 'date', hour)
           if dose_date is not None:
@@ -513,9 +718,11 @@ class YAMLparser(object):
               if repeat is not None:
                 count  = self._parse_int(dose['repeat'], 'count', 1) + 1
                 for n in range(count):
-                  self.doses[drug].append(YAMLdose(date=dose_date+(n*repeat), dose=dose_amount))
+                  dates.append(dose_date+(n*repeat))
+                  amounts.append(dose_amount)
               else:
-                self.doses[drug].append(YAMLdose(date=dose_date, dose=dose_amount))
+                dates.append(dose_date)
+                amounts.append(dose_amount)
             else:
               print(f"WARNING: dose is a mandatory field for a dose, skipping\n"
                     f"         got {dose}")
@@ -524,8 +731,9 @@ class YAMLparser(object):
         else:
           print(f"WARNING: date is a mandatory field for a dose, skipping\n"
                 f"         got: {dose}")
+      self.dose_columns[drug] = (np.array(dates, dtype='datetime64[us]'), np.array(amounts, dtype=float))
     cumulative_length = 0
-    for doses in self.doses.values():
-      cumulative_length += len(doses)
+    for _, amounts in self.dose_columns.values():
+      cumulative_length += len(amounts)
     if cumulative_length == 0:
       raise Exception("ERROR: we need doese to do a calculation")
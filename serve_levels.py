@@ -0,0 +1,235 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from hormone_levels import HormoneLevels
+from modelling.pipeline import value_hash
+from parser.yaml_parser import YAMLparser
+
+
+MODEL_CACHE_SIZE = 16
+
+
+class ModelCache(object):
+  # Warm HormoneLevels instances in LRU order, keyed by the hash of the configuration and its dose logs. A model is
+  # built once even if many requests ask for it at the same time, the others wait for the first one to finish.
+  capacity: int
+  models:   'OrderedDict[str, HormoneLevels]'
+  building: Dict[str, threading.Event]
+  stats:    Dict[Path, Tuple[Any, str]]
+  lock:     threading.Lock
+
+  def __init__(self, capacity: int = MODEL_CACHE_SIZE):
+    self.capacity = capacity
+    self.models   = OrderedDict()
+    self.building = {}
+    self.stats    = {}
+    self.lock     = threading.Lock()
+
+  @staticmethod
+  def file_stats(config_file: Path, levels: Optional[HormoneLevels]) -> Any:
+    files = [config_file]
+    if levels is not None:
+      files += map(lambda log: Path(log[0]), levels.config.dose_logs.values())
+    return date.today(), list(map(YAMLparser.dose_log_stat, files))
+
+  def config_key(self, config_file: Path) -> str:
+    # Hashing the file is skipped as long as neither it nor its dose logs changed on disk
+    levels = None
+    with self.lock:
+      known = self.stats.get(config_file)
+      if known is not None:
+        levels = self.models.get(known[1])
+    stats = self.file_stats(config_file, levels)
+    if levels is not None and stats == known[0]:
+      return known[1]
+    return value_hash((str(config_file), stats, config_file.read_bytes()))
+
+  def get(self, config_file: Path) -> HormoneLevels:
+    key = self.config_key(config_file)
+    while True:
+      with self.lock:
+        if key in self.models:
+          self.models.move_to_end(key)
+          return self.models[key]
+        event = self.building.get(key)
+        if event is None:
+          event = threading.Event()
+          self.building[key] = event
+          break
+      event.wait()
+    try:
+      levels = HormoneLevels(config_file, render=False, parallel=False)
+      with self.lock:
+        self.models[key] = levels
+        self.stats[config_file] = (self.file_stats(config_file, levels), key)
+        # Stale models of the same file are never asked for again
+        for stale in filter(lambda k: k != key and self.models[k].config_file == config_file, list(self.models)):
+          del self.models[stale]
+        while len(self.models) > self.capacity:
+          self.models.popitem(last=False)
+      return levels
+    finally:
+      with self.lock:
+        del self.building[key]
+      event.set()
+
+
+def query_times(query: Dict[str, List[str]]) -> np.ndarray:
+  values = sum(map(lambda t: t.split(','), query.get('t', [])), [])
+  if len(values) == 0:
+    return np.array([datetime.now()], dtype='datetime64[us]')
+  return np.array(values, dtype='datetime64[us]')
+
+
+def float_list(values: np.ndarray) -> List[Optional[float]]:
+  # JSON has no NaN, times outside of the timeline are null
+  return list(map(lambda v: None if np.isnan(v) else float(v), values))
+
+
+class LevelRequestHandler(BaseHTTPRequestHandler):
+  # GET /levels?config=&drug=&t=, /average?config=&drug=&window=&t=, /range?config=&drug=&from=&to=,
+  # /errors?config= and /summary?config=. Times are ISO dates, several of them either comma separated or as repeated
+  # t parameters, default is now.
+  root:   Path
+  models: ModelCache
+
+  def do_GET(self) -> None:
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    routes = {'/levels':  self.levels,
+              '/average': self.average,
+              '/range':   self.range,
+              '/errors':  self.errors,
+              '/summary': self.summary}
+    if url.path not in routes:
+      self.reply(404, {'error': f"Unknown endpoint {url.path}"})
+      return
+    try:
+      self.reply(200, routes[url.path](query))
+    except LookupError as e:
+      self.reply(404, {'error': str(e)})
+    except ValueError as e:
+      self.reply(400, {'error': str(e)})
+    except Exception as e:
+      self.reply(500, {'error': f"{type(e).__name__}: {e}"})
+
+  def reply(self, status: int, body: Dict[str, Any]) -> None:
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def model(self, query: Dict[str, List[str]]) -> HormoneLevels:
+    if 'config' not in query:
+      raise ValueError("Missing parameter config")
+    config_file = (self.root / query['config'][0]).resolve()
+    if self.root not in config_file.parents or not config_file.is_file():
+      raise LookupError(f"Unknown configuration {query['config'][0]}")
+    return self.models.get(config_file)
+
+  @staticmethod
+  def drug(levels: HormoneLevels, query: Dict[str, List[str]]) -> str:
+    if 'drug' not in query:
+      raise ValueError("Missing parameter drug")
+    drug_key = query['drug'][0]
+    if drug_key not in levels.model.blood_levels:
+      raise LookupError(f"No estimated blood levels for {drug_key}")
+    return drug_key
+
+  def levels(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+    levels = self.model(query)
+    drug_key = self.drug(levels, query)
+    times = query_times(query)
+    amounts, blood_levels, std_devs = levels.model.get_blood_levels(drug_key, times)
+    return {'drug':     drug_key,
+            'times':    np.datetime_as_string(times, unit='s').tolist(),
+            'amount':   float_list(amounts),
+            'level':    float_list(blood_levels),
+            'stddev':   float_list(std_devs)}
+
+  def average(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+    levels = self.model(query)
+    drug_key = self.drug(levels, query)
+    times = query_times(query)
+    window = float(query.get('window', ['30'])[0])
+    average, std_dev = levels.model.get_running_average(drug_key, times, timedelta(days=window))
+    return {'drug':     drug_key,
+            'window':   window,
+            'times':    np.datetime_as_string(times, unit='s').tolist(),
+            'average':  float_list(average),
+            'stddev':   float_list(std_dev)}
+
+  def range(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+    levels = self.model(query)
+    drug_key = self.drug(levels, query)
+    if 'from' not in query or 'to' not in query:
+      raise ValueError("Missing parameter from or to")
+    start, end = datetime.fromisoformat(query['from'][0]), datetime.fromisoformat(query['to'][0])
+    statistics = levels.model.get_range_statistics(drug_key, start, end)
+    if statistics is None:
+      raise LookupError(f"No blood levels between {start} and {end}")
+    return dict(zip(('drug', 'from', 'to', 'min', 'max', 'average', 'stddev'),
+                    (drug_key, start.isoformat(), end.isoformat()) + statistics))
+
+  def errors(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+    errors = self.model(query).calculate_prediction_errors()
+    return dict(map(lambda e: (e[0], [{'date': lab_date.isoformat(), 'lab': lab_val,
+                                       'predicted': predicted, 'error': error}
+                                      for lab_date, lab_val, predicted, error in e[1]]),
+                    errors.items()))
+
+  def summary(self, query: Dict[str, List[str]]) -> Dict[str, Any]:
+    return self.model(query).summary()
+
+
+def serve(root: Path, host: str, port: int, cache_size: int) -> None:
+  handler = type('Handler', (LevelRequestHandler,), {'root': root.resolve(), 'models': ModelCache(cache_size)})
+  server = ThreadingHTTPServer((host, port), handler)
+  print(f"Serving the configurations in {root} on http://{host}:{server.server_port}/")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+def parse_arguments() -> argparse.Namespace:
+  arg_parser = argparse.ArgumentParser(description="Answer blood level queries over HTTP from warm models")
+  arg_parser.add_argument('root', type=Path, help="directory of the configuration files that can be queried")
+  arg_parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+  arg_parser.add_argument('--port', type=int, default=8080, help="port to listen on")
+  arg_parser.add_argument('--models', type=int, default=MODEL_CACHE_SIZE, help="number of models kept in memory")
+  return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+  args = parse_arguments()
+  serve(args.root, args.host, args.port, args.models)
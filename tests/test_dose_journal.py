@@ -0,0 +1,77 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pytest
+
+from parser.dose_journal import DoseJournal
+from parser.dose_log import parse_csv_doses
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+  monkeypatch.setenv('HORMONE_LEVELS_CACHE', str(tmp_path / 'cache'))
+
+
+def write_log(file: Path, text: str, mtime_ns: int) -> None:
+  file.write_text(text)
+  os.utime(file, ns=(mtime_ns, mtime_ns))
+
+
+def test_last_line_without_newline(tmp_path: Path) -> None:
+  log = tmp_path / 'doses.csv'
+  write_log(log, "date,time,dose\n2026-07-01,09:00:00,2.5\n2026-07-02,09:00:00,2.5\n2026-07-03,09:00:00,3",
+            1_000_000_000)
+  for _ in range(2):
+    times, amounts = DoseJournal(log).read()
+    assert amounts.tolist() == [2.5, 2.5, 3.0]
+  # The unfinished line is parsed again once it is completed
+  write_log(log, log.read_text() + ".5\n2026-07-04,09:00:00,1\n", 2_000_000_000)
+  times, amounts = DoseJournal(log).read()
+  assert amounts.tolist() == [2.5, 2.5, 3.5, 1.0]
+  assert np.array_equal(times, parse_csv_doses(log)[0])
+
+
+def rewrite(log: Path, lines: List[str], line: int) -> DoseJournal:
+  write_log(log, "date,time,dose\n" + "".join(lines), 1_000_000_000)
+  DoseJournal(log).read()
+  # Same size, only the modification time tells that anything changed
+  lines[line] = lines[line].replace("2.5", "9.5")
+  write_log(log, "date,time,dose\n" + "".join(lines), 2_000_000_000)
+  return DoseJournal(log)
+
+
+def test_edit_before_offset(tmp_path: Path) -> None:
+  log = tmp_path / 'doses.csv'
+  lines = list(map(lambda d: f"2026-07-{d:02d},09:00:00,2.5\n", range(1, 29))) * 100
+  journal = rewrite(log, lines, len(lines) - 10)
+  times, amounts = journal.read()
+  assert journal.rewritten
+  assert amounts.tolist() == parse_csv_doses(log)[1].tolist()
+
+
+def test_changed_header(tmp_path: Path) -> None:
+  log = tmp_path / 'doses.csv'
+  write_log(log, "date,time,dose\n2026-07-01,09:00:00,2.5\n", 1_000_000_000)
+  DoseJournal(log).read()
+  write_log(log, "time,date,dose\n09:00:00,2026-07-01,2.5\n", 2_000_000_000)
+  journal = DoseJournal(log)
+  journal.read()
+  assert journal.rewritten
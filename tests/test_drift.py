@@ -0,0 +1,50 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from modelling.drift import detect_drift
+
+
+class LabModel(object):
+  # Just what detect_drift reads from a BodyModel, with a constant amount of the drug
+  corrected_std_dev = True
+
+  def __init__(self, labs: List[Tuple[datetime, float]]):
+    self.lab_levels = {'e2': labs}
+
+  @staticmethod
+  def get_drug_at_timepoint(drug: str, t: datetime) -> float:
+    return 1.0
+
+
+def weekly_labs(seed: int, level: float, shift: float = 0.0) -> List[Tuple[datetime, float]]:
+  rng = random.Random(seed)
+  return list(map(lambda n: (datetime(2020, 1, 1) + timedelta(days=7 * n),
+                             rng.gauss(level + (shift if n >= 150 else 0.0), 0.1 * level)), range(300)))
+
+
+def test_no_drift_in_stationary_labs() -> None:
+  assert sum(map(lambda seed: len(detect_drift(LabModel(weekly_labs(seed, 200.0)), 'e2')), range(10))) <= 1
+
+
+def test_drift_found_at_shift() -> None:
+  labs = weekly_labs(0, 200.0, 100.0)
+  change_points = detect_drift(LabModel(labs), 'e2', window=8)
+  assert len(change_points) == 1
+  assert abs(change_points[0].after - labs[150][0]) <= timedelta(weeks=8)
@@ -0,0 +1,45 @@
+# HormoneLevels - Calculate Hormone levels for Hormone Replacement Therapy
+# Copyright (C) 2021  Nina Alexandra Klama
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from modelling.factor_estimator import FactorKalman
+
+
+def tracker() -> FactorKalman:
+  kalman = FactorKalman()
+  for n, lab in enumerate((100.0, 110.0, 150.0, 160.0)):
+    kalman.update(datetime(2024, 1, 1) + timedelta(days=30 * n), 1.0, lab)
+  return kalman
+
+
+def test_factor_moves_between_labs() -> None:
+  kalman = tracker()
+  days = kalman.time_array()
+  factors, variances = kalman.state_array(np.linspace(days[1], days[2], 31))
+  assert np.all(np.diff(factors) > 0.0)
+  # Halfway between two labs the factor is less certain than at either of them on average
+  assert variances[15] > (variances[0] + variances[-1]) / 2
+
+
+def test_variance_grows_after_last_lab() -> None:
+  kalman = tracker()
+  last = kalman.times[-1]
+  factors, variances = zip(*map(lambda d: kalman.at(last + timedelta(days=d)), (0, 30, 60)))
+  assert factors[0] == factors[1] == factors[2] == kalman.states[-1][0]
+  assert variances[0] == kalman.states[-1][1] < variances[1] < variances[2]